@@ -0,0 +1,227 @@
+"""Sales analytics: revenue, units and VAT per period, broken down by product,
+product type and payment method, with rankings and period-over-period growth.
+
+All aggregation is done in SQL (GROUP BY over the indexed sale.date_created
+range, RANK/LAG/SUM window functions for rankings and growth). Figures for a
+closed period never change, so they are computed once and stored in the
+sales_period_summary table; only the current period is aggregated per request.
+Realized profit comes from the unit cost snapshot stored on each sale item.
+"""
+from datetime import datetime
+
+from sqlalchemy import text, bindparam, DateTime
+
+GRANULARITIES = ('day', 'month', 'year')
+PERIOD_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}
+DIMENSIONS = {
+    'total': "''",
+    'product': 'si.product_name',
+    'product_type': 'si.product_type',
+    'payment_method': "COALESCE(s.payment_method, '')",
+}
+# Also stored, for the reorder forecast: the accessory sold, by id, or by name for items recorded without one
+SUMMARY_DIMENSIONS = dict(DIMENSIONS, accessory=(
+    "CASE WHEN si.accessory_id IS NOT NULL THEN CAST(si.accessory_id AS TEXT) "
+    "WHEN si.product_type != 'phone' THEN 'name:' || si.product_name ELSE '' END"))
+# Cancelled and rejected sales do not count
+COMPLETED_SALE = "COALESCE(s.status, '') NOT IN ('ملغي', 'مرفوض')"
+# Realized profit groupings (brand only applies to phones)
+PROFIT_DIMENSIONS = {
+    'sale': 's.id',
+    'day': "strftime('%Y-%m-%d', s.date_created)",
+    'brand': "COALESCE(p.brand, '')",
+    'category': 'si.product_type',
+}
+
+
+def period_start(moment, granularity):
+    """Start of the period containing ``moment``"""
+    if granularity == 'day':
+        return datetime(moment.year, moment.month, moment.day)
+    if granularity == 'month':
+        return datetime(moment.year, moment.month, 1)
+    return datetime(moment.year, 1, 1)
+
+
+def shift_period(start, granularity, count):
+    """Start of the period ``count`` periods after (or before) ``start``"""
+    if granularity == 'day':
+        return datetime.fromordinal(start.toordinal() + count)
+    if granularity == 'month':
+        months = start.year * 12 + start.month - 1 + count
+        return datetime(months // 12, months % 12 + 1, 1)
+    return datetime(start.year + count, 1, 1)
+
+
+def period_key(start, granularity):
+    return start.strftime(PERIOD_FORMATS[granularity])
+
+
+def _aggregate_sql(granularity, dimension):
+    return f"""
+        SELECT strftime('{PERIOD_FORMATS[granularity]}', s.date_created) AS period,
+               {SUMMARY_DIMENSIONS[dimension]} AS dim_key,
+               SUM(si.total_price) AS revenue,
+               SUM(si.quantity) AS units,
+               SUM(si.total_price) * :vat_rate AS vat,
+               COUNT(DISTINCT s.id) AS sales_count
+        FROM sale s JOIN sale_item si ON si.sale_id = s.id
+        WHERE s.date_created >= :start AND s.date_created < :end AND {COMPLETED_SALE}
+        GROUP BY period, dim_key
+    """
+
+
+def _range_params(start, end):
+    return [bindparam('start', start, type_=DateTime), bindparam('end', end, type_=DateTime)]
+
+
+def ensure_closed_periods(session, granularity, first_start, open_start, vat_rate, sales=None):
+    """Compute and store the summaries of closed periods in [first_start, open_start) not cached yet.
+
+    Sales are read from ``sales`` when given (a session that also sees archived sales), the
+    summaries are read and written with ``session``.
+    """
+    cached = {row[0] for row in session.execute(text(
+        "SELECT period FROM sales_period_summary "
+        "WHERE granularity = :granularity AND dimension = 'total' AND period >= :first AND period < :open"),
+        {'granularity': granularity, 'first': period_key(first_start, granularity),
+         'open': period_key(open_start, granularity)})}
+
+    missing = []
+    start = first_start
+    while start < open_start:
+        if period_key(start, granularity) not in cached:
+            missing.append(period_key(start, granularity))
+        start = shift_period(start, granularity, 1)
+    if not missing:
+        return
+
+    # One grouped query per dimension over the span of the missing periods
+    missing_set = set(missing)
+    span_start = datetime.strptime(missing[0], PERIOD_FORMATS[granularity])
+    span_end = shift_period(datetime.strptime(missing[-1], PERIOD_FORMATS[granularity]), granularity, 1)
+    rows = []
+    for dimension in SUMMARY_DIMENSIONS:
+        query = text(_aggregate_sql(granularity, dimension)).bindparams(*_range_params(span_start, span_end))
+        for row in (sales or session).execute(query, {'vat_rate': vat_rate}):
+            if row.period in missing_set:
+                rows.append({'granularity': granularity, 'period': row.period, 'dimension': dimension,
+                             'dim_key': row.dim_key, 'revenue': row.revenue, 'units': row.units,
+                             'vat': row.vat, 'sales_count': row.sales_count})
+    # A total row marks the period as computed, even when nothing was sold, and an
+    # accessory row as computed since that dimension was stored (see drop_outdated_periods)
+    for marker in ('total', 'accessory'):
+        present = {row['period'] for row in rows if row['dimension'] == marker}
+        for key in missing_set - present:
+            rows.append({'granularity': granularity, 'period': key, 'dimension': marker, 'dim_key': '',
+                         'revenue': 0.0, 'units': 0, 'vat': 0.0, 'sales_count': 0})
+
+    computed_at = datetime.utcnow()
+    session.execute(text(
+        "INSERT OR REPLACE INTO sales_period_summary "
+        "(granularity, period, dimension, dim_key, revenue, units, vat, sales_count, computed_at) "
+        "VALUES (:granularity, :period, :dimension, :dim_key, :revenue, :units, :vat, :sales_count, :computed_at)"
+    ).bindparams(bindparam('computed_at', type_=DateTime)), [dict(row, computed_at=computed_at) for row in rows])
+    session.commit()
+
+
+def drop_outdated_periods(session):
+    """Drop stored periods computed before the accessory dimension was; they are recomputed when next read"""
+    dropped = session.execute(text(
+        "DELETE FROM sales_period_summary WHERE (granularity, period) IN ("
+        "SELECT granularity, period FROM sales_period_summary WHERE dimension = 'total' "
+        "EXCEPT SELECT granularity, period FROM sales_period_summary WHERE dimension = 'accessory')")).rowcount
+    session.commit()
+    return dropped
+
+
+def invalidate_periods(session, moment):
+    """Drop cached summaries of every period containing ``moment`` (sales back-dated into a closed period)"""
+    for granularity in GRANULARITIES:
+        session.execute(text(
+            "DELETE FROM sales_period_summary WHERE granularity = :granularity AND period = :period"),
+            {'granularity': granularity, 'period': period_key(period_start(moment, granularity), granularity)})
+
+
+def period_series(session, granularity, periods, dimension, vat_rate, now=None, sales=None):
+    """Per-period figures for ``dimension`` over the last ``periods`` periods (newest first).
+
+    Each row carries its rank within the period, its share of the period revenue
+    and its growth against the previous period. Closed periods missing from the
+    summaries are computed from ``sales`` (see ensure_closed_periods).
+    """
+    open_start = period_start(now or datetime.utcnow(), granularity)
+    first_start = shift_period(open_start, granularity, -(periods - 1))
+    ensure_closed_periods(session, granularity, first_start, open_start, vat_rate, sales)
+
+    query = text(f"""
+        WITH live AS ({_aggregate_sql(granularity, dimension)}),
+        combined AS (
+            SELECT period, dim_key, revenue, units, vat, sales_count
+            FROM sales_period_summary
+            WHERE granularity = :granularity AND dimension = :dimension
+              AND period >= :first AND period < :open
+            UNION ALL
+            SELECT period, dim_key, revenue, units, vat, sales_count FROM live
+        )
+        SELECT period, dim_key, revenue, units, vat, sales_count,
+               RANK() OVER (PARTITION BY period ORDER BY revenue DESC) AS rank,
+               revenue / NULLIF(SUM(revenue) OVER (PARTITION BY period), 0) AS share,
+               LAG(period) OVER (PARTITION BY dim_key ORDER BY period) AS previous_period,
+               LAG(revenue) OVER (PARTITION BY dim_key ORDER BY period) AS previous_revenue
+        FROM combined
+        ORDER BY period DESC, rank
+    """).bindparams(*_range_params(open_start, shift_period(open_start, granularity, 1)))
+    result = session.execute(query, {
+        'granularity': granularity, 'dimension': dimension, 'vat_rate': vat_rate,
+        'first': period_key(first_start, granularity), 'open': period_key(open_start, granularity)})
+
+    rows = []
+    for row in result:
+        expected_previous = period_key(
+            shift_period(datetime.strptime(row.period, PERIOD_FORMATS[granularity]), granularity, -1), granularity)
+        previous_revenue = row.previous_revenue if row.previous_period == expected_previous else 0.0
+        rows.append({
+            'period': row.period, 'key': row.dim_key, 'revenue': row.revenue or 0.0, 'units': row.units or 0,
+            'vat': row.vat or 0.0, 'sales_count': row.sales_count, 'rank': row.rank, 'share': row.share or 0.0,
+            'previous_revenue': previous_revenue,
+            'growth': (row.revenue - previous_revenue) / previous_revenue if previous_revenue else None,
+        })
+    return rows
+
+
+def period_keys(granularity, periods, now=None):
+    """Keys of the last ``periods`` periods, newest first"""
+    open_start = period_start(now or datetime.utcnow(), granularity)
+    return [period_key(shift_period(open_start, granularity, -offset), granularity) for offset in range(periods)]
+
+
+def realized_profit(session, dimension=None, start=None, end=None):
+    """Revenue, cost and profit of completed sales, as one total row or per ``dimension``.
+
+    Profit only covers items with a recorded unit cost; the revenue of items
+    without one is reported as ``uncosted_revenue``.
+    """
+    key = PROFIT_DIMENSIONS[dimension] if dimension else "''"
+    conditions = [COMPLETED_SALE]
+    params = []
+    if start is not None:
+        conditions.append('s.date_created >= :start')
+        params.append(bindparam('start', start, type_=DateTime))
+    if end is not None:
+        conditions.append('s.date_created < :end')
+        params.append(bindparam('end', end, type_=DateTime))
+    phone_join = 'LEFT JOIN phone p ON p.id = si.phone_id' if dimension == 'brand' else ''
+    brand_filter = "AND si.product_type = 'phone'" if dimension == 'brand' else ''
+    query = text(f"""
+        SELECT {key} AS key,
+               COALESCE(SUM(si.total_price), 0) AS revenue,
+               COALESCE(SUM(si.unit_cost * si.quantity), 0) AS cost,
+               COALESCE(SUM(si.total_price - si.unit_cost * si.quantity), 0) AS profit,
+               COALESCE(SUM(CASE WHEN si.unit_cost IS NULL THEN si.total_price ELSE 0 END), 0) AS uncosted_revenue,
+               COALESCE(SUM(si.quantity), 0) AS units
+        FROM sale s JOIN sale_item si ON si.sale_id = s.id {phone_join}
+        WHERE {' AND '.join(conditions)} {brand_filter}
+        {'GROUP BY key ORDER BY profit DESC' if dimension else ''}
+    """).bindparams(*params)
+    return [dict(row._mapping) for row in session.execute(query)]
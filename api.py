@@ -0,0 +1,271 @@
+"""Read-only JSON API under /api/v1 for the online store and other integrations.
+
+Each resource is one table, served as a listing and a detail endpoint:
+
+- keyset pagination: rows are ordered by id and ``after=<id>`` continues after
+  the last row of the previous page (``order=-id`` walks newest first), so a
+  deep page costs the same as the first; the response carries the ``next`` URL
+- ``fields=a,b`` selects which columns are read and returned
+- filter parameters declared per resource, e.g. ``brand=Apple&price_max=3000``
+- conditional GET: ETag and Last-Modified come from the response cache's data
+  version, which every commit touching inventory or sales bumps, so a client
+  polling an unchanged listing gets a 304 before any query runs
+- listings are streamed to the client as rows come off the database cursor
+
+Requests are authenticated by a logged-in session or an ``X-API-Key`` header
+matching one of the configured API_KEYS. Key holders (the online store) get
+less: a resource's ``private`` columns (costs, suppliers, customer details)
+can be neither read nor filtered on without a session, and ``key_filters``
+narrow their listings by default (phones: only those in stock).
+"""
+import hmac
+import json
+from datetime import date, datetime, timezone
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
+from flask_login import current_user
+from sqlalchemy import select, not_
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+PAGING_PARAMS = ('fields', 'limit', 'after', 'order')
+
+
+class ApiError(Exception):
+    """Returned to the client as ``{"error": message}`` with the given status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# Filters: each turns a query-string value into a WHERE clause
+
+def equals(column):
+    return lambda value: column == _coerce(column, value)
+
+
+def at_least(column):
+    return lambda value: column >= _coerce(column, value)
+
+
+def at_most(column):
+    return lambda value: column <= _coerce(column, value)
+
+
+def before(column):
+    return lambda value: column < _coerce(column, value)
+
+
+def flag(clause):
+    """``?param=1`` keeps rows matching ``clause``, ``?param=0`` the others"""
+    return lambda value: clause if _coerce_bool(value) else not_(clause)
+
+
+def _coerce(column, value):
+    python_type = column.type.python_type
+    try:
+        if python_type is bool:
+            return _coerce_bool(value)
+        if python_type in (int, float):
+            return python_type(value)
+        if python_type in (datetime, date):
+            return datetime.fromisoformat(value)
+    except ValueError:
+        raise ApiError(f'Invalid value for {column.name}: {value}')
+    return value
+
+
+def _coerce_bool(value):
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ApiError(f'Invalid boolean: {value}')
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_json_default)
+
+
+class Resource:
+    """A table exposed by the API"""
+
+    def __init__(self, table, exclude=(), hidden=(), private=(), filters=None, key_filters=None, children=None):
+        self.table = table
+        # Columns that can be requested; ``hidden`` ones only when named in fields=
+        self.fields = {column.name: column for column in table.columns if column.name not in exclude}
+        # name -> (Resource, foreign key column): rows embedded in the detail view
+        self.children = children or {}
+        self.default_fields = [name for name in list(self.fields) + list(self.children) if name not in hidden]
+        # Columns (and filters of the same name) only a signed-in user may read
+        self.private = set(private)
+        self.filters = filters or {}
+        # filter -> value applied to API-key listings that do not pass the filter themselves
+        self.key_filters = key_filters or {}
+
+    def selected_fields(self, fields_param, signed_in=True):
+        if not fields_param:
+            return self.default_fields if signed_in else [
+                name for name in self.default_fields if name not in self.private]
+        names = [name.strip() for name in fields_param.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields and name not in self.children]
+        if unknown:
+            raise ApiError(f"Unknown fields: {', '.join(unknown)}")
+        self.check_private(names, signed_in)
+        return names
+
+    def check_private(self, names, signed_in):
+        private = [name for name in names if name in self.private]
+        if private and not signed_in:
+            raise ApiError(f"Only available to signed-in users: {', '.join(private)}", 403)
+
+    def select(self, names):
+        key = self.table.c.id
+        return select(key, *[self.fields[name] for name in names if name in self.fields and name != 'id'])
+
+
+class Api:
+    """The /api/v1 blueprint and its registered resources"""
+
+    def __init__(self, app, db, data_version, url_prefix='/api/v1'):
+        self.app = app
+        self.db = db
+        self.data_version = data_version  # () -> (version, unix time of last change)
+        self.resources = {}
+        app.config.setdefault('API_KEYS', [])
+        blueprint = Blueprint('api_v1', __name__, url_prefix=url_prefix)
+        blueprint.before_request(self._authenticate)
+        blueprint.register_error_handler(ApiError, lambda e: (jsonify({'error': e.message}), e.status))
+        blueprint.add_url_rule('/', 'index', self.index)
+        blueprint.add_url_rule('/<name>', 'list', self.list_view)
+        blueprint.add_url_rule('/<name>/<int:item_id>', 'detail', self.detail_view)
+        app.register_blueprint(blueprint)
+
+    def resource(self, name, resource):
+        self.resources[name] = resource
+        return resource
+
+    def _authenticate(self):
+        if current_user.is_authenticated:
+            return
+        key = request.headers.get('X-API-Key', '')
+        if key and any(hmac.compare_digest(key, allowed) for allowed in self.app.config['API_KEYS']):
+            return
+        raise ApiError('Authentication required', 401)
+
+    def _resource(self, name):
+        resource = self.resources.get(name)
+        if resource is None:
+            raise ApiError(f'Unknown resource: {name}', 404)
+        return resource
+
+    # Conditional GET
+
+    def _validators(self):
+        # Read before querying: a commit landing mid-query makes the next poll refetch, never miss it
+        version, changed_at = self.data_version()
+        return f'{version}-{int(changed_at or 0)}', datetime.fromtimestamp(int(changed_at or 0), timezone.utc)
+
+    def _not_modified(self, etag, last_modified):
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        if request.if_modified_since:
+            return last_modified <= request.if_modified_since
+        return False
+
+    def _respond(self, body, etag, last_modified, status=200):
+        response = Response(body, status=status, mimetype='application/json')
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    # Views
+
+    def index(self):
+        return jsonify({'resources': {name: url_for('api_v1.list', name=name, _external=True)
+                                      for name in self.resources}})
+
+    def list_view(self, name):
+        resource = self._resource(name)
+        unknown = [param for param in request.args if param not in PAGING_PARAMS and param not in resource.filters]
+        if unknown:
+            raise ApiError(f"Unknown parameters: {', '.join(unknown)}")
+        signed_in = current_user.is_authenticated
+        resource.check_private([param for param, value in request.args.items() if value], signed_in)
+        names = [field for field in resource.selected_fields(request.args.get('fields'), signed_in)
+                 if field in resource.fields]
+        limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+        if not 1 <= limit <= MAX_LIMIT:
+            raise ApiError(f'limit must be between 1 and {MAX_LIMIT}')
+        order = request.args.get('order', 'id')
+        if order not in ('id', '-id'):
+            raise ApiError('order must be id or -id')
+        after = request.args.get('after', type=int)
+
+        etag, last_modified = self._validators()
+        if self._not_modified(etag, last_modified):
+            return self._respond(None, etag, last_modified, 304)
+
+        key = resource.table.c.id
+        statement = resource.select(names)
+        for param, build in resource.filters.items():
+            value = request.args.get(param)
+            if value is None and not signed_in:
+                value = resource.key_filters.get(param)
+            if value not in (None, ''):
+                statement = statement.where(build(value))
+        if after is not None:
+            statement = statement.where(key < after if order == '-id' else key > after)
+        # One extra row tells whether there is a next page
+        statement = statement.order_by(key.desc() if order == '-id' else key).limit(limit + 1)
+        rows = self.db.session.execute(statement.execution_options(yield_per=500))
+
+        def generate():
+            yield '{"data":['
+            count, last_id = 0, None
+            try:
+                for row in rows:
+                    if count == limit:
+                        break
+                    values = row._mapping
+                    yield (',' if count else '') + dumps({field: values[field] for field in names})
+                    count, last_id = count + 1, values['id']
+            finally:
+                rows.close()
+            next_url = None
+            if count == limit and last_id is not None:
+                params = {param: value for param, value in request.args.items() if param != 'after'}
+                next_url = url_for('api_v1.list', name=name, after=last_id, **params)
+            yield f'],"next":{dumps(next_url)}}}'
+
+        return self._respond(stream_with_context(generate()), etag, last_modified)
+
+    def detail_view(self, name, item_id):
+        resource = self._resource(name)
+        signed_in = current_user.is_authenticated
+        names = resource.selected_fields(request.args.get('fields'), signed_in)
+        etag, last_modified = self._validators()
+        if self._not_modified(etag, last_modified):
+            return self._respond(None, etag, last_modified, 304)
+
+        row = self.db.session.execute(resource.select(names).where(resource.table.c.id == item_id)).first()
+        if row is None:
+            raise ApiError(f'{name} {item_id} not found', 404)
+        record = {field: row._mapping[field] for field in names if field in resource.fields}
+        for child_name, (child, foreign_key) in resource.children.items():
+            if child_name in names:
+                child_fields = child.selected_fields(None, signed_in)
+                child_rows = self.db.session.execute(child.select(child_fields).where(
+                    foreign_key == item_id).order_by(child.table.c.id))
+                record[child_name] = [{field: child_row._mapping[field] for field in child_fields}
+                                      for child_row in child_rows]
+        return self._respond(dumps(record), etag, last_modified)
@@ -1,20 +1,74 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, flash, send_file, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
-from sqlalchemy import func
-import barcode
-from barcode.writer import ImageWriter
+import csv
+import socket
+import json
+import time
+from sqlalchemy import func, inspect as sa_inspect, literal_column, MetaData, event, DDL, select, bindparam
+from sqlalchemy.orm import Session as OrmSession, selectinload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
 from io import BytesIO
 import random
-from PIL import Image
 import argparse
+import click
+from contextlib import contextmanager
+import shutil
+import zipfile
 from werkzeug.security import generate_password_hash, check_password_hash
+from response_cache import ResponseCache
+import static_assets
+import analytics
+import archive
+import inventory_reports
+import jobs
+import backups
+import audit
+import customers
+import api
+import pricing
+import gtin
+import imei
+import live_updates
+import maintenance
+import receipts
+import trigram_search
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, init is still idempotent
+    fcntl = None
+
+# barcode, PIL and forecasting (NumPy) are imported inside the functions that use
+# them: most requests never touch them and every worker would pay for the imports
 
 # VAT Configuration for Saudi Arabia
 VAT_RATE = 0.15  # 15% VAT rate
 
+# Phone lifecycle - rows are kept after a sale so purchase price and IMEI history survive
+PHONE_STATUS_IN_STOCK = 'in_stock'
+PHONE_STATUS_RESERVED = 'reserved'
+PHONE_STATUS_SOLD = 'sold'
+PHONE_STATUS_RETURNED = 'returned'
+PHONE_STATUS_REMOVED = 'removed'  # deleted from stock by staff (data entry mistakes, losses)
+SELLABLE_PHONE_STATUSES = (PHONE_STATUS_IN_STOCK, PHONE_STATUS_RESERVED)
+
+# Offline tills: sales per sync request, and how far back a queued sale's own timestamp is trusted
+SYNC_BATCH_LIMIT = 500
+OFFLINE_SALE_MAX_AGE_DAYS = 7
+
+# Hours between background recomputations of the reorder suggestions (reorder_forecast job)
+REORDER_REFRESH_HOURS = 6
+
+# Seconds before a worker reloads its TAC index (TACs learned by other workers, imports)
+TAC_INDEX_TTL = 300
+
+# Online database snapshots taken by the background jobs (backups.KEEP_SNAPSHOTS of them are kept)
+BACKUP_INTERVAL_HOURS = 6
+
 def calculate_vat(amount):
     """Calculate VAT amount for a given price"""
     return amount * VAT_RATE
@@ -36,15 +90,28 @@ def generate_invoice_number():
 
 
 
-app = Flask(__name__)
+# The database, cache, backups and archive live in the instance folder (relative SQLite paths resolve there)
+INSTANCE_PATH = os.environ.get('PHONE_SHOP_INSTANCE_PATH')
+app = Flask(__name__, instance_path=os.path.abspath(INSTANCE_PATH) if INSTANCE_PATH else None)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///phone_shop.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['BACKUP_DIR'] = os.path.join(app.instance_path, 'backups')
+# Keys accepted in the X-API-Key header of /api/v1 requests (comma separated)
+app.config['API_KEYS'] = [key for key in os.environ.get('PHONE_SHOP_API_KEYS', '').split(',') if key]
+# Thermal receipts: optional logo, the printer's raw port (host[:9100]) and its ESC t number for PC864
+app.config['RECEIPT_LOGO'] = os.path.join(app.instance_path, 'receipt_logo.png')
+app.config['RECEIPT_PRINTER'] = os.environ.get('PHONE_SHOP_RECEIPT_PRINTER', '')
+app.config['RECEIPT_CODE_PAGE'] = int(os.environ.get('PHONE_SHOP_RECEIPT_CODE_PAGE', receipts.CODE_PAGE))
+# Sales older than this many days can be moved to the archive file (flask archive-sales)
+app.config['ARCHIVE_DATABASE'] = os.path.join(app.instance_path, 'phone_shop_archive.db')
+app.config['ARCHIVE_AFTER_DAYS'] = 730
 
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+static_assets.init_app(app)
 
 # Models
 class User(UserMixin, db.Model):
@@ -52,6 +119,7 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(120), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    is_active = db.Column(db.Boolean, nullable=False, default=True, server_default='1')  # disabled users cannot log in
 
 class Phone(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -62,7 +130,7 @@ class Phone(db.Model):
     selling_price = db.Column(db.Float, nullable=False)   # سعر البيع (بدون ضريبة)
     purchase_price_with_vat = db.Column(db.Float, nullable=False)  # سعر الشراء (مع ضريبة)
     selling_price_with_vat = db.Column(db.Float, nullable=False)   # سعر البيع (مع ضريبة)
-    serial_number = db.Column(db.String(100), unique=True, nullable=False)
+    serial_number = db.Column(db.String(100), nullable=False)  # unique among active rows, see ux_phone_serial_active
     phone_number = db.Column(db.String(20), unique=True, nullable=False)  # New field for phone number
     barcode_path = db.Column(db.String(200))  # New field for barcode image path
     description = db.Column(db.Text)
@@ -77,6 +145,28 @@ class Phone(db.Model):
     phone_color = db.Column(db.String(50))     # لون الجوال
     phone_memory = db.Column(db.String(50))    # الذاكرة
     buyer_name = db.Column(db.String(100))     # اسم المشتري
+    seller_id = db.Column(db.Integer, db.ForeignKey('customer.id'))  # العميل الذي اشتري منه الهاتف المستعمل
+
+    # Lifecycle (in_stock, reserved, sold, returned, removed)
+    status = db.Column(db.String(20), nullable=False, default=PHONE_STATUS_IN_STOCK, server_default=PHONE_STATUS_IN_STOCK)
+    sold_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Inventory pages only ever look at stock on hand; this partial index keeps them
+        # as fast as before while sold history accumulates (covers the summary aggregates)
+        db.Index('ix_phone_in_stock', 'condition', 'brand', 'model', 'purchase_price', 'selling_price',
+                 sqlite_where=literal_column("status = 'in_stock'")),
+        # The same IMEI may come back as a trade-in after being sold, so uniqueness only
+        # applies to phones that are still on the shelf
+        db.Index('ux_phone_serial_active', 'serial_number', unique=True,
+                 sqlite_where=literal_column("status IN ('in_stock', 'reserved')")),
+        db.Index('ix_phone_serial_number', 'serial_number'),
+        db.Index('ix_phone_sold_at', 'sold_at', sqlite_where=literal_column("status = 'sold'")),
+        db.Index('ix_phone_seller', 'seller_id', sqlite_where=literal_column('seller_id IS NOT NULL')),
+        # Aging report: covering and already in GROUP BY order
+        db.Index('ix_phone_in_stock_age', 'brand', 'model', 'condition', 'date_added', 'purchase_price', 'selling_price',
+                 sqlite_where=literal_column("status = 'in_stock'")),
+    )
 
 class PhoneType(db.Model):
     """نموذج أنواع الهواتف - للتحكم في العلامات التجارية والموديلات"""
@@ -88,6 +178,14 @@ class PhoneType(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     date_added = db.Column(db.DateTime, default=datetime.utcnow)
     notes = db.Column(db.Text)
+    tacs = db.relationship('PhoneTypeTac', backref='phone_type', cascade='all, delete-orphan')
+
+class PhoneTypeTac(db.Model):
+    """رمز TAC (أول 8 أرقام من IMEI) ونوع الهاتف المقابل له"""
+    tac = db.Column(db.String(8), primary_key=True)
+    phone_type_id = db.Column(db.Integer, db.ForeignKey('phone_type.id'), nullable=False)
+    source = db.Column(db.String(10), nullable=False, default='intake')  # intake, import
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
 
 # Transaction model removed - replaced by Sale and SaleItem models
 
@@ -106,11 +204,31 @@ class Transaction(db.Model):
     customer_phone = db.Column(db.String(20))
     notes = db.Column(db.Text)
 
+class Customer(db.Model):
+    """نموذج العميل - سجل واحد لكل رقم جوال (انظر customers.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    phone = db.Column(db.String(20))  # الرقم بصيغة موحدة 05XXXXXXXX
+    id_number = db.Column(db.String(50))  # رقم الهوية / الإقامة (من عمليات الشراء من العملاء)
+    email = db.Column(db.String(100))
+    address = db.Column(db.Text)
+    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+
+    sales = db.relationship('Sale', backref='customer', lazy='dynamic')
+    trade_ins = db.relationship('Phone', backref='seller', lazy='dynamic')
+
+    __table_args__ = (
+        # Checkout autocomplete is a range scan on these
+        db.Index('ux_customer_phone', 'phone', unique=True),
+        db.Index('ix_customer_name', 'name'),
+        db.Index('ix_customer_id_number', 'id_number'),
+    )
+
 class Sale(db.Model):
     """نموذج عملية البيع - يمكن أن تحتوي على عدة منتجات"""
     id = db.Column(db.Integer, primary_key=True)
     sale_number = db.Column(db.String(50), unique=True, nullable=False)
-    date_created = db.Column(db.DateTime, default=datetime.utcnow)
+    date_created = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Company Information (معلومات الشركة)
     company_name = db.Column(db.String(200), nullable=False, default="شركة الهواتف الذكية")
@@ -123,6 +241,7 @@ class Sale(db.Model):
     customer_phone = db.Column(db.String(20))
     customer_email = db.Column(db.String(100))
     customer_address = db.Column(db.Text)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'))  # the fields above are the invoice's copy
     
     # Sale Details (تفاصيل البيع)
     subtotal = db.Column(db.Float, nullable=False, default=0.0)  # المبلغ قبل الضريبة
@@ -133,10 +252,19 @@ class Sale(db.Model):
     # Additional Fields
     notes = db.Column(db.Text)
     status = db.Column(db.String(20), default="مكتمل")  # مكتمل، ملغي، مرفوض
+    client_key = db.Column(db.String(64))  # مفتاح من نقطة البيع لمنع تكرار المبيعات المرسلة أكثر من مرة
     
     # Relationships
     items = db.relationship('SaleItem', backref='sale', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        # Date-range reports filter on status too; covering so the sale rows are not read
+        db.Index('ix_sale_date_status', 'date_created', 'status'),
+        db.Index('ux_sale_client_key', 'client_key', unique=True),
+        # Customer history, newest first
+        db.Index('ix_sale_customer_date', 'customer_id', 'date_created'),
+    )
+
 class AccessoryCategory(db.Model):
     """نموذج فئات الأكسسوارات - للتحكم في الفئات"""
     id = db.Column(db.Integer, primary_key=True)
@@ -160,13 +288,45 @@ class Accessory(db.Model):
     quantity_in_stock = db.Column(db.Integer, nullable=False, default=0)
     min_quantity = db.Column(db.Integer, default=5)  # الحد الأدنى للمخزون
     supplier = db.Column(db.String(200))
-    date_added = db.Column(db.DateTime, default=datetime.utcnow)
+    date_added = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     notes = db.Column(db.Text)
+    sku = db.Column(db.String(13))  # رمز المحل EAN-13 المطبوع على الملصق (انظر gtin.py)
+    ean = db.Column(db.String(13))  # رمز الشركة المصنعة إن وجد (EAN-13 / EAN-8 / UPC-A)
+    stock_alert = db.relationship('StockAlert', uselist=False, backref='accessory', cascade='all, delete-orphan')
+    reorder_suggestion = db.relationship('ReorderSuggestion', uselist=False, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        # A scan at the till is one lookup on either code
+        db.Index('ux_accessory_sku', 'sku', unique=True),
+        db.Index('ux_accessory_ean', 'ean', unique=True),
+    )
+
+    @property
+    def is_low_stock(self):
+        return self.quantity_in_stock <= (self.min_quantity or 0)
+
+class StockAlert(db.Model):
+    """تنبيه نقص المخزون - صف لكل أكسسوار وصلت كميته إلى الحد الأدنى"""
+    accessory_id = db.Column(db.Integer, db.ForeignKey('accessory.id'), primary_key=True)
+    quantity_in_stock = db.Column(db.Integer, nullable=False)
+    min_quantity = db.Column(db.Integer, nullable=False)
+    flagged_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ReorderSuggestion(db.Model):
+    """اقتراح إعادة الطلب - نتيجة توقع الطلب لكل أكسسوار (انظر forecasting.py)"""
+    accessory_id = db.Column(db.Integer, db.ForeignKey('accessory.id'), primary_key=True)
+    daily_demand = db.Column(db.Float, nullable=False, default=0.0)    # متوسط أسي للمبيعات اليومية
+    moving_average = db.Column(db.Float, nullable=False, default=0.0)  # متوسط آخر 28 يوم
+    safety_stock = db.Column(db.Float, nullable=False, default=0.0)
+    reorder_point = db.Column(db.Float, nullable=False, default=0.0)
+    suggested_quantity = db.Column(db.Integer, nullable=False, default=0, index=True)
+    days_of_cover = db.Column(db.Float)  # عدد الأيام التي يكفيها المخزون الحالي
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class SaleItem(db.Model):
     """نموذج عنصر البيع - كل منتج في عملية البيع"""
     id = db.Column(db.Integer, primary_key=True)
-    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=False)
+    sale_id = db.Column(db.Integer, db.ForeignKey('sale.id'), nullable=False, index=True)
     
     # Product Information (معلومات المنتج)
     product_type = db.Column(db.String(50), nullable=False)  # phone, accessory, charger, etc.
@@ -179,16 +339,396 @@ class SaleItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False, default=1)
     total_price = db.Column(db.Float, nullable=False)  # السعر الإجمالي للكمية
     
+    # Product reference and cost at the time of sale, for realized profit
+    phone_id = db.Column(db.Integer, db.ForeignKey('phone.id'), index=True)
+    accessory_id = db.Column(db.Integer, db.ForeignKey('accessory.id'), index=True)
+    unit_cost = db.Column(db.Float)  # سعر الشراء للوحدة قبل الضريبة (فارغ إذا لم يكن معروفاً)
+    
     # Additional Fields
     notes = db.Column(db.Text)
 
+    __table_args__ = (
+        # Profit aggregates read sale items through this index without touching the table
+        db.Index('ix_sale_item_profit', 'sale_id', 'product_type', 'phone_id', 'quantity', 'total_price',
+                 'unit_cost'),
+    )
+
 # Invoice model removed - invoices are now generated from Sale data
 
+class SalesPeriodSummary(db.Model):
+    """ملخص المبيعات لفترة مغلقة - يحسب مرة واحدة ويستخدم في التحليلات"""
+    granularity = db.Column(db.String(10), primary_key=True)  # day, month, year
+    period = db.Column(db.String(10), primary_key=True)       # 2024-05-01, 2024-05, 2024
+    dimension = db.Column(db.String(20), primary_key=True)    # total, product, product_type, payment_method, accessory
+    dim_key = db.Column(db.String(200), primary_key=True)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)  # قبل الضريبة
+    units = db.Column(db.Integer, nullable=False, default=0)
+    vat = db.Column(db.Float, nullable=False, default=0.0)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+    computed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Job(db.Model):
+    """مهمة في الخلفية (تصدير، تقارير، إعادة بناء) - انظر jobs.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text)      # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed, cancelled
+    progress = db.Column(db.Float, nullable=False, default=0.0)          # 0..1
+    message = db.Column(db.String(200))
+    checkpoint = db.Column(db.Text)  # JSON - نقطة الاستئناف بعد إعادة تشغيل العامل
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False, server_default='0')
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    worker = db.Column(db.String(100))  # host:pid
+    error = db.Column(db.Text)
+    result_path = db.Column(db.String(500))
+    result_name = db.Column(db.String(200))
+    result_mimetype = db.Column(db.String(100))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status', 'status', 'id'),
+    )
+
+class AuditLog(db.Model):
+    """سجل التعديلات (إضافة، تعديل، حذف) ومن قام بها - للإضافة فقط، انظر audit.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user_id = db.Column(db.Integer)           # no foreign key: entries outlive deleted users
+    username = db.Column(db.String(80))
+    source = db.Column(db.String(100))        # endpoint, or 'system' for jobs and CLI commands
+    action = db.Column(db.String(10), nullable=False)        # create, update, delete, reprice
+    entity_type = db.Column(db.String(50), nullable=False)   # table name
+    entity_id = db.Column(db.Integer)
+    entity_label = db.Column(db.String(200))  # IMEI / name at the time of the change
+    changes = db.Column(db.Text, nullable=False)  # JSON {column: [before, after]}
+
+    __table_args__ = (
+        db.Index('ix_audit_log_entity', 'entity_type', 'entity_id', 'id'),
+        db.Index('ix_audit_log_user', 'user_id', 'id'),
+        db.Index('ix_audit_log_created_at', 'created_at'),
+    )
 
+for statement in ('UPDATE', 'DELETE'):
+    event.listen(AuditLog.__table__, 'after_create', DDL(
+        f"CREATE TRIGGER IF NOT EXISTS audit_log_no_{statement.lower()} BEFORE {statement} ON audit_log "
+        f"BEGIN SELECT RAISE(ABORT, 'audit_log is append-only'); END"))
+
+class LiveEvent(db.Model):
+    """تغيير في أرقام لوحة التحكم يُرسل للمتصفحات المفتوحة - انظر live_updates.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    kind = db.Column(db.String(10), nullable=False)  # delta, reload
+    data = db.Column(db.Text, nullable=False)  # JSON {total: change, 'new_sales': [...]}
+
+class SearchDocument(db.Model):
+    """نص البحث التقريبي لهاتف أو إكسسوار أو عميل - انظر trigram_search.py"""
+    # AUTOINCREMENT: ids never go back, workers read the documents newer than the last they applied
+    __table_args__ = (
+        db.Index('ux_search_document_entity', 'kind', 'entity_id', unique=True),
+        {'sqlite_autoincrement': True},
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # phone, accessory, customer
+    entity_id = db.Column(db.Integer, nullable=False)
+    text = db.Column(db.Text)  # NULL: the row was deleted or left stock
+
+class ArchiveRun(db.Model):
+    """نقل المبيعات القديمة إلى ملف الأرشيف - الإجماليات المنقولة تبقى هنا (انظر archive.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    cutoff = db.Column(db.DateTime, nullable=False)  # نُقلت المبيعات قبل هذا التاريخ
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sales = db.Column(db.Integer, nullable=False, default=0)
+    items = db.Column(db.Integer, nullable=False, default=0)
+    transactions = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    subtotal = db.Column(db.Float, nullable=False, default=0.0)
+    vat_amount = db.Column(db.Float, nullable=False, default=0.0)
+    profit = db.Column(db.Float, nullable=False, default=0.0)  # الربح المحقق للمبيعات المكتملة المنقولة
+
+# Inline literal (not a bound parameter) so SQLite can match the ix_phone_in_stock partial index
+PHONE_IN_STOCK = Phone.status == literal_column("'in_stock'")
+
+def in_stock_phones():
+    """Query phones currently on the shelf"""
+    return Phone.query.filter(PHONE_IN_STOCK)
+
+# Columns the listing pages display; they are selected as plain rows instead of loading whole objects
+ACCESSORY_LIST_COLUMNS = (
+    Accessory.id, Accessory.name, Accessory.description, Accessory.category, Accessory.quantity_in_stock,
+    (Accessory.quantity_in_stock <= func.coalesce(Accessory.min_quantity, 0)).label('is_low_stock'),
+    Accessory.purchase_price, Accessory.purchase_price_with_vat, Accessory.selling_price,
+    Accessory.selling_price_with_vat, Accessory.supplier, Accessory.date_added, Accessory.sku)
+ACCESSORY_SEARCH_COLUMNS = (
+    Accessory.id, Accessory.name, Accessory.category, Accessory.quantity_in_stock, Accessory.selling_price_with_vat)
+PHONE_SEARCH_COLUMNS = (
+    Phone.id, Phone.phone_number, Phone.brand, Phone.model, Phone.condition, Phone.selling_price_with_vat)
+
+# Report pages are cached across workers until a commit touches one of these models
+response_cache = ResponseCache(app, watched_models=(Phone, PhoneType, Accessory, AccessoryCategory, Sale, SaleItem))
+
+
+# Long-running work (exports, rebuilds) runs on background threads, see jobs.py
+job_runner = jobs.JobRunner(app, db, Job)
+
+# Who changed what: before/after values of every tracked row, written in batches, see audit.py
+audit_trail = audit.AuditTrail(app, db, AuditLog, tracked_models={
+    Phone: 'phone_number', Accessory: 'name', Sale: 'sale_number', PhoneType: 'model',
+    AccessoryCategory: 'arabic_name', User: 'username', Customer: 'name'})
+
+# Dashboard totals pushed to open dashboards as deltas (Server-Sent Events), see live_updates.py
+def _phone_stock_totals(status, purchase_price, selling_price):
+    if status != PHONE_STATUS_IN_STOCK:
+        return 0, 0.0, 0.0
+    return 1, purchase_price or 0.0, selling_price or 0.0
+
+def dashboard_delta(action, obj):
+    """Change one flushed object makes to the dashboard totals"""
+    if isinstance(obj, Phone):
+        keys = ('status', 'purchase_price', 'selling_price')
+        current = [getattr(obj, key) for key in keys]
+        previous = current
+        if action == 'update':
+            # Phone columns load their old value when assigned (audit_trail), so history has it
+            state = sa_inspect(obj)
+            previous = [state.attrs[key].history.deleted[0] if state.attrs[key].history.deleted else value
+                        for key, value in zip(keys, current)]
+        after = _phone_stock_totals(*current) if action != 'delete' else (0, 0.0, 0.0)
+        before = _phone_stock_totals(*previous) if action != 'create' else (0, 0.0, 0.0)
+        if after == before:
+            return None
+        return {'phones': after[0] - before[0], 'purchase_value': after[1] - before[1],
+                'selling_value': after[2] - before[2]}
+    if isinstance(obj, Sale):
+        if action == 'create':
+            return {'sales_count': 1, 'sales_amount': obj.total_amount or 0.0, 'sales_subtotal': obj.subtotal or 0.0,
+                    'vat_amount': obj.vat_amount or 0.0,
+                    'new_sales': [{'id': obj.id, 'sale_number': obj.sale_number, 'customer_name': obj.customer_name,
+                                   'total_amount': obj.total_amount,
+                                   'date_created': obj.date_created.strftime('%Y-%m-%d %H:%M')}]}
+        state = sa_inspect(obj)
+        if action == 'delete' or any(state.attrs[key].history.has_changes()
+                                     for key in ('status', 'subtotal', 'vat_amount', 'total_amount')):
+            return live_updates.RELOAD
+    if isinstance(obj, SaleItem):
+        if action == 'create':
+            return {'profit': obj.total_price - obj.unit_cost * obj.quantity} if obj.unit_cost is not None else None
+        state = sa_inspect(obj)
+        if action == 'delete' or any(state.attrs[key].history.has_changes()
+                                     for key in ('total_price', 'unit_cost', 'quantity')):
+            return live_updates.RELOAD
+    return None
+
+live_dashboard = live_updates.LiveUpdates(app, db, LiveEvent, collector=dashboard_delta)
+
+# Typo- and script-tolerant search ("ايفون 15 برو" finds "iPhone 15 Pro"), see trigram_search.py
+def _joined(*values):
+    return ' '.join(str(value) for value in values if value)
+
+search_index = trigram_search.TrigramSearch(app, db, SearchDocument, sources={
+    Phone: ('phone', ('brand', 'model', 'phone_color', 'phone_memory', 'serial_number', 'phone_number', 'status'),
+            lambda phone: _joined(phone.brand, phone.model, phone.phone_color, phone.phone_memory,
+                                  phone.serial_number, phone.phone_number)
+            if phone.status == PHONE_STATUS_IN_STOCK else None),
+    Accessory: ('accessory', ('name', 'category', 'sku', 'ean'),
+                lambda accessory: _joined(accessory.name, accessory.category, accessory.sku, accessory.ean)),
+    Customer: ('customer', ('name', 'phone'), lambda customer: _joined(customer.name, customer.phone)),
+})
+
+# Sales past ARCHIVE_AFTER_DAYS live in a separate file, attached only for reports reaching back that far
+sales_archive = archive.SalesArchive(app, db, ArchiveRun, Sale, SaleItem, Transaction)
+
+# Read-only JSON API (/api/v1) for the online store and other integrations, see api.py
+rest_api = api.Api(app, db, data_version=response_cache.version_info)
+phone_table = Phone.__table__
+rest_api.resource('phones', api.Resource(
+    phone_table, exclude=('barcode_path', 'customer_name', 'customer_id', 'buyer_name', 'seller_id'),
+    hidden=('purchase_price', 'purchase_price_with_vat'),
+    private=('purchase_price', 'purchase_price_with_vat', 'serial_number'),
+    filters={'status': api.equals(phone_table.c.status), 'brand': api.equals(phone_table.c.brand),
+             'model': api.equals(phone_table.c.model), 'condition': api.equals(phone_table.c.condition),
+             'color': api.equals(phone_table.c.phone_color), 'memory': api.equals(phone_table.c.phone_memory),
+             'price_min': api.at_least(phone_table.c.selling_price_with_vat),
+             'price_max': api.at_most(phone_table.c.selling_price_with_vat),
+             'added_since': api.at_least(phone_table.c.date_added)},
+    key_filters={'status': PHONE_STATUS_IN_STOCK}))
+accessory_table = Accessory.__table__
+rest_api.resource('accessories', api.Resource(
+    accessory_table, hidden=('purchase_price', 'purchase_price_with_vat', 'supplier'),
+    private=('purchase_price', 'purchase_price_with_vat', 'supplier', 'notes'),
+    filters={'category': api.equals(accessory_table.c.category),
+             'in_stock': api.flag(accessory_table.c.quantity_in_stock > 0),
+             'low_stock': api.flag(
+                 accessory_table.c.quantity_in_stock <= func.coalesce(accessory_table.c.min_quantity, 0)),
+             'price_min': api.at_least(accessory_table.c.selling_price_with_vat),
+             'price_max': api.at_most(accessory_table.c.selling_price_with_vat),
+             'added_since': api.at_least(accessory_table.c.date_added)}))
+sale_table = Sale.__table__
+rest_api.resource('sales', api.Resource(
+    sale_table, exclude=('client_key',),
+    hidden=('company_name', 'company_vat_number', 'company_address', 'company_phone'),
+    private=('customer_name', 'customer_phone', 'customer_email', 'customer_address', 'customer_id', 'notes'),
+    filters={'status': api.equals(sale_table.c.status), 'payment_method': api.equals(sale_table.c.payment_method),
+             'customer_phone': api.equals(sale_table.c.customer_phone),
+             'customer_id': api.equals(sale_table.c.customer_id),
+             'from': api.at_least(sale_table.c.date_created), 'to': api.before(sale_table.c.date_created)},
+    children={'items': (api.Resource(SaleItem.__table__, hidden=('unit_cost',),
+                                     private=('unit_cost', 'serial_number', 'notes')),
+                        SaleItem.__table__.c.sale_id)}))
+rest_api.resource('phone-types', api.Resource(
+    PhoneType.__table__, filters={'brand': api.equals(PhoneType.__table__.c.brand),
+                                  'category': api.equals(PhoneType.__table__.c.category),
+                                  'is_active': api.equals(PhoneType.__table__.c.is_active)}))
+rest_api.resource('accessory-categories', api.Resource(
+    AccessoryCategory.__table__, filters={'is_active': api.equals(AccessoryCategory.__table__.c.is_active)}))
+
+# Per-worker cache of logged-in users, so login_required routes (AJAX calls, barcode
+# images) do not pay a DB round-trip just to authenticate. Other workers pick up
+# password changes and disabled accounts within USER_CACHE_TTL seconds.
+USER_CACHE_TTL = 60
+_user_cache = {}  # user id -> (expires_at, CachedUser)
+
+class CachedUser(UserMixin):
+    """Detached snapshot of a User, safe to share between requests"""
+    __slots__ = ('id', 'username', 'is_admin', 'active')
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.is_admin = user.is_admin
+        self.active = user.is_active
+
+    @property
+    def is_active(self):
+        return self.active
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
+    user_id = int(user_id)
+    entry = _user_cache.get(user_id)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    user = db.session.get(User, user_id)
+    if user is None or not user.is_active:
+        _user_cache.pop(user_id, None)
+        return None
+    cached = CachedUser(user)
+    _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, cached)
+    return cached
+
+@event.listens_for(OrmSession, 'after_flush')
+def _collect_changed_users(session, flush_context):
+    changed = [obj.id for obj in list(session.dirty) + list(session.deleted) if isinstance(obj, User)]
+    if changed:
+        session.info.setdefault('changed_user_ids', set()).update(changed)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _evict_changed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        _user_cache.pop(user_id, None)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
+
+
+# Low-stock alerts are kept in step with every accessory insert/update, so the
+# navbar badge and the reorder page only read the few flagged rows
+@event.listens_for(OrmSession, 'before_flush')
+def _track_low_stock(session, flush_context, instances):
+    for accessory in list(session.new) + list(session.dirty):
+        if not isinstance(accessory, Accessory) or accessory in session.deleted:
+            continue
+        state = sa_inspect(accessory)
+        if not state.pending and not (state.attrs.quantity_in_stock.history.has_changes()
+                                      or state.attrs.min_quantity.history.has_changes()):
+            continue
+        if not accessory.is_low_stock:
+            accessory.stock_alert = None
+        elif accessory.stock_alert is None:
+            accessory.stock_alert = StockAlert(quantity_in_stock=accessory.quantity_in_stock,
+                                               min_quantity=accessory.min_quantity or 0)
+        else:
+            accessory.stock_alert.quantity_in_stock = accessory.quantity_in_stock
+            accessory.stock_alert.min_quantity = accessory.min_quantity or 0
+
+def sync_stock_alerts():
+    """Rebuild the alerts from the accessory table (existing databases and out-of-band changes)"""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            'DELETE FROM stock_alert WHERE accessory_id NOT IN '
+            '(SELECT id FROM accessory WHERE quantity_in_stock <= COALESCE(min_quantity, 0))')
+        conn.exec_driver_sql(
+            'INSERT OR REPLACE INTO stock_alert (accessory_id, quantity_in_stock, min_quantity, flagged_at) '
+            'SELECT a.id, a.quantity_in_stock, COALESCE(a.min_quantity, 0), '
+            '       COALESCE(sa.flagged_at, CURRENT_TIMESTAMP) '
+            'FROM accessory a LEFT JOIN stock_alert sa ON sa.accessory_id = a.id '
+            'WHERE a.quantity_in_stock <= COALESCE(a.min_quantity, 0)')
+
+def backfill_accessory_skus():
+    """Give accessories added before SKUs existed their shop code"""
+    with db.engine.begin() as conn:
+        ids = [row[0] for row in conn.execute(select(Accessory.id).where(Accessory.sku.is_(None)))]
+        if ids:
+            conn.execute(Accessory.__table__.update().where(Accessory.__table__.c.id == bindparam('accessory_id')),
+                         [{'accessory_id': accessory_id, 'sku': gtin.sku_for(accessory_id)} for accessory_id in ids])
+            print(f"SKUs assigned to {len(ids)} accessories")
+
+def backfill_customers():
+    """Create customers from the details copied into sales and trade-ins before the directory existed"""
+    customer_table = Customer.__table__
+    with db.engine.begin() as conn:
+        # Newest first, so a customer is created with their latest details
+        sales = conn.execute(
+            select(Sale.id, Sale.customer_name, Sale.customer_phone, Sale.customer_email, Sale.customer_address)
+            .where(Sale.customer_id.is_(None), Sale.customer_phone.isnot(None), Sale.customer_phone != '')
+            .order_by(Sale.date_created.desc())).all()
+        trade_ins = conn.execute(
+            select(Phone.id, Phone.customer_name, Phone.customer_id)
+            .where(Phone.seller_id.is_(None), Phone.condition == 'used', Phone.customer_id.isnot(None),
+                   Phone.customer_id != '')
+            .order_by(Phone.date_added.desc())).all()
+        if not sales and not trade_ins:
+            return
+        by_phone = dict(conn.execute(select(Customer.phone, Customer.id).where(Customer.phone.isnot(None))).all())
+        by_id_number = dict(conn.execute(
+            select(Customer.id_number, Customer.id).where(Customer.id_number.isnot(None))).all())
+        created = 0
+        sale_links = []
+        for sale_id, name, phone, email, address in sales:
+            phone = customers.normalize_phone(phone)
+            if not phone:
+                continue
+            if phone not in by_phone:
+                name = name if name and name != customers.WALK_IN else phone
+                by_phone[phone] = conn.execute(customer_table.insert().values(
+                    name=name, phone=phone, email=email or None, address=address or None,
+                    date_added=datetime.utcnow())).inserted_primary_key[0]
+                created += 1
+            sale_links.append({'row_id': sale_id, 'customer_id': by_phone[phone]})
+        phone_links = []
+        for phone_id, name, id_number in trade_ins:
+            id_number = id_number.strip()
+            if id_number not in by_id_number:
+                by_id_number[id_number] = conn.execute(customer_table.insert().values(
+                    name=name or id_number, id_number=id_number, date_added=datetime.utcnow())).inserted_primary_key[0]
+                created += 1
+            phone_links.append({'row_id': phone_id, 'seller_id': by_id_number[id_number]})
+        if sale_links:
+            conn.execute(Sale.__table__.update().where(Sale.__table__.c.id == bindparam('row_id')), sale_links)
+        if phone_links:
+            conn.execute(Phone.__table__.update().where(Phone.__table__.c.id == bindparam('row_id')), phone_links)
+    if created:
+        print(f"Customers created from past sales and trade-ins: {created}")
+
+@app.context_processor
+def inject_low_stock_count():
+    if not current_user.is_authenticated:
+        return {}
+    return {'low_stock_count': db.session.query(func.count(StockAlert.accessory_id)).scalar()}
 
 # Create admin user if not exists
 def create_admin_user():
@@ -384,6 +924,96 @@ def create_default_accessory_categories():
         db.session.rollback()
         print(f"Error creating default accessory categories: {e}")
 
+def upgrade_schema():
+    """Bring an existing database up to date with the models.
+
+    db.create_all() only creates missing tables, so new columns and indexes on
+    existing tables are added here. Safe to run on every startup.
+    """
+    # Background jobs read while requests write; WAL lets readers and the writer overlap
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+    
+    inspector = sa_inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    # phone.serial_number used to be globally unique, which SQLite can only drop by rebuilding the table
+    if 'phone' in existing_tables and any(
+            uc['column_names'] == ['serial_number'] for uc in inspector.get_unique_constraints('phone')):
+        rebuild_table(Phone.__table__)
+        inspector = sa_inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            columns = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}')
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def rebuild_table(table):
+    """Recreate a table from its model definition, keeping all rows (SQLite cannot drop constraints)"""
+    metadata = MetaData()
+    for referred in {foreign_key.column.table for foreign_key in table.foreign_keys}:
+        referred.to_metadata(metadata)  # so the copy's foreign keys resolve
+    new_table = table.to_metadata(metadata, name=f'{table.name}_new')
+    old_columns = {col['name'] for col in sa_inspect(db.engine).get_columns(table.name)}
+    shared = ', '.join(f'"{col.name}"' for col in table.columns if col.name in old_columns)
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS "{new_table.name}"')
+        # Create the bare table first; indexes keep their names and are created after the rename
+        new_table.indexes.clear()
+        new_table.create(conn)
+        conn.exec_driver_sql(f'INSERT INTO "{new_table.name}" ({shared}) SELECT {shared} FROM "{table.name}"')
+        conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+        conn.exec_driver_sql(f'ALTER TABLE "{new_table.name}" RENAME TO "{table.name}"')
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    print(f"Table {table.name} rebuilt successfully!")
+
+def backfill_sale_item_costs():
+    """Fill product ids and unit costs of sale items recorded before they were captured at sale time"""
+    with db.engine.begin() as conn:
+        # Phones: the latest buy transaction of the serial number before the sale. Phones sold before
+        # they were kept were deleted, so the phone id is only taken while its row still exists
+        phones = conn.exec_driver_sql("""
+            UPDATE sale_item SET phone_id = buy.phone_id, unit_cost = buy.price
+            FROM (
+                SELECT si.id AS item_id, p.id AS phone_id, t.price,
+                       ROW_NUMBER() OVER (PARTITION BY si.id ORDER BY t.date_created DESC) AS newest
+                FROM sale_item si
+                JOIN sale s ON s.id = si.sale_id
+                JOIN "transaction" t ON t.serial_number = si.serial_number AND t.transaction_type = 'buy'
+                                    AND t.date_created <= s.date_created
+                LEFT JOIN phone p ON p.id = t.phone_id
+                WHERE si.product_type = 'phone' AND si.unit_cost IS NULL
+            ) AS buy
+            WHERE buy.item_id = sale_item.id AND buy.newest = 1
+        """).rowcount
+        # Phones without a buy transaction: the sold phone row still has its purchase price
+        phones += conn.exec_driver_sql("""
+            UPDATE sale_item SET phone_id = p.id, unit_cost = p.purchase_price
+            FROM phone p
+            WHERE sale_item.product_type = 'phone' AND sale_item.unit_cost IS NULL
+              AND p.serial_number = sale_item.serial_number AND p.status = 'sold'
+        """).rowcount
+        # Accessories are matched by name (the oldest of a name); only today's purchase price is known
+        accessories = conn.exec_driver_sql("""
+            UPDATE sale_item SET accessory_id = a.id, unit_cost = a.purchase_price
+            FROM (
+                SELECT name, id, purchase_price, ROW_NUMBER() OVER (PARTITION BY name ORDER BY id) AS oldest
+                FROM accessory
+            ) AS a
+            WHERE sale_item.product_type != 'phone' AND sale_item.unit_cost IS NULL
+              AND a.name = sale_item.product_name AND a.oldest = 1
+        """).rowcount
+    if phones or accessories:
+        print(f"Sale item costs backfilled: {phones} phones, {accessories} accessories")
+
 # Routes
 @app.route('/')
 def index():
@@ -410,15 +1040,21 @@ def login():
                 if not is_hashed:
                     user.password = generate_password_hash(password)
                     db.session.commit()
-                login_user(user)
-                return redirect(url_for('dashboard'))
+                if login_user(user):
+                    return redirect(url_for('dashboard'))
+                flash('تم تعطيل هذا الحساب', 'error')
+                return render_template('login.html')
         flash('اسم المستخدم أو كلمة المرور غير صحيحة', 'error')
     return render_template('login.html')
 
 @app.route('/dashboard')
 @login_required
+@response_cache.cached
 def dashboard():
-    phones = Phone.query.all()
+    # One read transaction, so the totals and the id of the last live event they include agree
+    db.session.connection().exec_driver_sql('BEGIN')
+    live_event_id = live_dashboard.last_id(db.session)
+    phones = in_stock_phones().all()
     
     # Calculate financial summaries for current inventory
     total_phones = len(phones)
@@ -429,15 +1065,16 @@ def dashboard():
     # Recent sales
     recent_sales = Sale.query.order_by(Sale.date_created.desc()).limit(10).all()
     
-    # Sales statistics
-    total_sales = Sale.query.count()
-    total_sales_amount = sum(sale.total_amount for sale in Sale.query.all())
+    # Sales statistics (archived sales are counted from the totals recorded when they were moved)
+    archived = sales_archive.totals(db.session)
+    total_sales = Sale.query.count() + archived['sales']
+    total_sales_amount = sum(sale.total_amount for sale in Sale.query.all()) + archived['total_amount']
     
     # Calculate sales subtotal and VAT
-    total_sales_subtotal = sum(sale.subtotal for sale in Sale.query.all())
-    total_vat_amount = sum(sale.vat_amount for sale in Sale.query.all())
-    # Calculate actual profit as the difference between selling and purchase prices
-    total_actual_profit = 0.0  # We'll calculate this differently if needed
+    total_sales_subtotal = sum(sale.subtotal for sale in Sale.query.all()) + archived['subtotal']
+    total_vat_amount = sum(sale.vat_amount for sale in Sale.query.all()) + archived['vat_amount']
+    # Realized profit: selling price minus the unit cost recorded with each sale item
+    total_actual_profit = analytics.realized_profit(db.session)[0]['profit'] + archived['profit']
     
     return render_template('dashboard.html', 
                          phones=phones,
@@ -450,13 +1087,37 @@ def dashboard():
                          total_sales_subtotal=total_sales_subtotal,
                          total_vat_amount=total_vat_amount,
                          total_actual_profit=total_actual_profit,
-                         recent_sales=recent_sales)
+                         recent_sales=recent_sales,
+                         live_event_id=live_event_id)
+
+@app.route('/dashboard/events')
+@login_required
+def dashboard_events():
+    """Server-Sent Events stream of changes to the dashboard totals"""
+    # Reconnects resume from Last-Event-ID; the first connection from the id the page was rendered with
+    after_id = request.headers.get('Last-Event-ID', type=int)
+    if after_id is None:
+        after_id = request.args.get('after', type=int)
+    return Response(live_dashboard.stream(after_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Transactions route removed - replaced by sales system
 
-def generate_barcode(phone_number):
-    # Create barcode with phone number only
-    barcode_class = barcode.get_barcode_class('code128')
+# Barcode images, under the app folder; Phone.barcode_path stores them relative to it
+BARCODE_FOLDER = os.path.join('static', 'barcodes')
+
+def app_path(path):
+    """Absolute path of a file stored relative to the app folder, whatever the working directory"""
+    return os.path.join(app.root_path, path)
+
+def generate_barcode(phone_number, symbology='code128'):
+    """Write the label image of ``phone_number``; returns its path relative to the app folder"""
+    import barcode
+    from barcode.writer import ImageWriter
+    from PIL import Image
+
+    # Create barcode with phone number only (accessories: their EAN-13 SKU)
+    barcode_class = barcode.get_barcode_class(symbology)
     barcode_instance = barcode_class(phone_number, writer=ImageWriter())
     
     # Set custom options for the barcode
@@ -470,11 +1131,10 @@ def generate_barcode(phone_number):
     }
     
     # Create barcodes directory if it doesn't exist
-    if not os.path.exists('static/barcodes'):
-        os.makedirs('static/barcodes')
+    os.makedirs(app_path(BARCODE_FOLDER), exist_ok=True)
     
     # Save barcode image with custom options
-    filename = f"static/barcodes/{phone_number}"
+    filename = app_path(os.path.join(BARCODE_FOLDER, phone_number))
     barcode_path = barcode_instance.save(filename, options)
     
     # Convert the saved image to the exact size (4.4cm x 2.5cm)
@@ -485,16 +1145,64 @@ def generate_barcode(phone_number):
     img = img.resize((width_px, height_px), Image.Resampling.LANCZOS)
     img.save(barcode_path)
     
-    return barcode_path
+    return os.path.relpath(barcode_path, app.root_path)
 
 @app.route('/barcode/<phone_number>')
 @login_required
 def get_barcode(phone_number):
     phone = Phone.query.filter_by(phone_number=phone_number).first()
     if phone and phone.barcode_path:
-        return send_file(phone.barcode_path, mimetype='image/png')
+        return send_file(app_path(phone.barcode_path), mimetype='image/png')
     return "Barcode not found", 404
 
+def accessory_barcode_path(accessory):
+    """Label image of an accessory's SKU, generated on first use"""
+    path = app_path(os.path.join(BARCODE_FOLDER, f'{accessory.sku}.png'))
+    if not os.path.exists(path):
+        path = app_path(generate_barcode(accessory.sku, 'ean13'))
+    return path
+
+@app.route('/accessory_barcode/<int:accessory_id>')
+@login_required
+def get_accessory_barcode(accessory_id):
+    accessory = Accessory.query.get_or_404(accessory_id)
+    return send_file(accessory_barcode_path(accessory), mimetype='image/png')
+
+@app.route('/accessory_labels/<int:accessory_id>')
+@login_required
+def accessory_labels(accessory_id):
+    """A4 sheet of SKU labels for an accessory, one per unit in stock unless ``copies`` is given"""
+    accessory = Accessory.query.get_or_404(accessory_id)
+    per_sheet = LABEL_SHEET_GRID[0] * LABEL_SHEET_GRID[1]
+    copies = request.args.get('copies', type=int) or accessory.quantity_in_stock
+    copies = min(max(copies, 1), per_sheet)
+    sheet = render_label_sheet([accessory_barcode_path(accessory)] * copies)
+    output = BytesIO()
+    sheet.save(output, 'PNG')
+    output.seek(0)
+    return send_file(output, mimetype='image/png', download_name=f'labels_{accessory.sku}.png')
+
+@app.route('/scan_lookup')
+@login_required
+def scan_lookup():
+    """Item for a code scanned at the till: accessory SKU/EAN, phone barcode or IMEI"""
+    code = gtin.normalize(request.args.get('code'))
+    if not code:
+        return jsonify({'found': False})
+    accessory = Accessory.query.filter(db.or_(Accessory.sku == code, Accessory.ean == code)).first()
+    if accessory:
+        return jsonify({'found': True, 'type': 'accessory', 'item': {
+            'id': accessory.id, 'name': accessory.name, 'category': accessory.category,
+            'description': accessory.description or '', 'selling_price': accessory.selling_price,
+            'quantity_in_stock': accessory.quantity_in_stock, 'sku': accessory.sku, 'ean': accessory.ean}})
+    phone = in_stock_phones().filter(db.or_(Phone.phone_number == code, Phone.serial_number == code)).first()
+    if phone:
+        return jsonify({'found': True, 'type': 'phone', 'item': {
+            'id': phone.id, 'brand': phone.brand, 'model': phone.model, 'serial_number': phone.serial_number,
+            'phone_number': phone.phone_number, 'selling_price': phone.selling_price,
+            'description': phone.description or ''}})
+    return jsonify({'found': False})
+
 def generate_unique_phone_number():
     # Get the highest existing phone number
     highest_phone = db.session.query(func.max(Phone.phone_number)).scalar()
@@ -533,6 +1241,76 @@ def process_barcode_input(barcode_input):
     
     return None
 
+# TAC (first 8 IMEI digits) -> phone type, held in memory by every worker so a
+# scanned IMEI pre-selects brand/model without a query. Learned from intake.
+tac_index = imei.TacIndex(TAC_INDEX_TTL)
+
+def load_tac_index():
+    tac_index.load(db.session.query(PhoneTypeTac.tac, PhoneTypeTac.phone_type_id).all(),
+                   db.session.query(PhoneType.id, PhoneType.brand, PhoneType.model).all())
+
+def lookup_tac(serial_number):
+    if tac_index.stale:
+        load_tac_index()
+    return tac_index.lookup(serial_number)
+
+def learn_tac(serial_number, brand, model):
+    """Record the phone type of a new IMEI's TAC in the caller's transaction; returns what to add to the index"""
+    code = imei.tac(serial_number)
+    if code is None or code in tac_index:
+        return None
+    phone_type = PhoneType.query.filter_by(brand=brand, model=model).first()
+    if phone_type is None:
+        return None
+    # Another worker may have learned it since our index was loaded
+    db.session.execute(sqlite_insert(PhoneTypeTac).values(
+        tac=code, phone_type_id=phone_type.id, source='intake', date_added=datetime.utcnow()
+    ).on_conflict_do_nothing())
+    return code, phone_type.id, brand, model
+
+@app.route('/imei_lookup')
+@login_required
+def imei_lookup():
+    """Validate a scanned serial number and suggest brand/model from its TAC"""
+    serial_number, error = imei.check(request.args.get('serial_number'))
+    if error:
+        return jsonify({'valid': False, 'message': error})
+    match = lookup_tac(serial_number)
+    return jsonify({'valid': True, 'serial_number': serial_number, 'is_imei': imei.is_imei(serial_number),
+                    'brand': match[1] if match else None, 'model': match[2] if match else None})
+
+@app.cli.command('import-tac')
+@click.argument('csv_file', type=click.File(encoding='utf-8-sig'))
+def import_tac_command(csv_file):
+    """Import TAC -> phone type rows from a CSV of tac,brand,model (missing phone types are created)."""
+    rows, skipped = {}, 0
+    for row in csv.reader(csv_file):
+        code, brand, model = (row + ['', '', ''])[:3]
+        code, brand, model = code.strip(), brand.strip(), model.strip()
+        if len(code) != imei.TAC_LENGTH or not code.isdigit() or not brand or not model:
+            skipped += 1  # header line, malformed rows
+            continue
+        rows[code] = (brand, model)
+    type_ids = {(brand, model): type_id for type_id, brand, model in
+                db.session.query(PhoneType.id, PhoneType.brand, PhoneType.model)}
+    created = 0
+    for brand, model in set(rows.values()) - set(type_ids):
+        phone_type = PhoneType(brand=brand, model=model)
+        db.session.add(phone_type)
+        db.session.flush()
+        type_ids[(brand, model)] = phone_type.id
+        created += 1
+    now = datetime.utcnow()
+    statement = sqlite_insert(PhoneTypeTac)
+    # Imported rows are authoritative: they replace mappings learned at intake
+    statement = statement.on_conflict_do_update(index_elements=['tac'], set_={
+        'phone_type_id': statement.excluded.phone_type_id, 'source': 'import', 'date_added': now})
+    if rows:
+        db.session.execute(statement, [{'tac': code, 'phone_type_id': type_ids[brand_model], 'source': 'import',
+                                        'date_added': now} for code, brand_model in rows.items()])
+    db.session.commit()
+    print(f'{len(rows)} TACs imported, {created} phone types created, {skipped} lines skipped')
+
 @app.route('/scan_barcode', methods=['GET', 'POST'])
 @login_required
 def scan_barcode():
@@ -581,7 +1359,10 @@ def add_new_phone():
             model = request.form.get('model')
             purchase_price = float(request.form.get('purchase_price'))  # Price without VAT
             selling_price = float(request.form.get('selling_price'))    # Price without VAT
-            serial_number = request.form.get('serial_number')
+            serial_number, serial_error = imei.check(request.form.get('serial_number'))
+            if serial_error:
+                flash(serial_error, 'error')
+                return redirect(url_for('add_new_phone'))
             warranty = int(request.form.get('warranty'))
             
             # Calculate VAT amounts
@@ -601,8 +1382,9 @@ def add_new_phone():
             phone_memory = request.form.get('phone_memory')
             buyer_name = request.form.get('buyer_name')
             
-            # Check if serial number already exists
-            existing_phone = Phone.query.filter_by(serial_number=serial_number).first()
+            # Check if serial number already exists in stock
+            existing_phone = Phone.query.filter(Phone.serial_number == serial_number,
+                                                Phone.status.in_(SELLABLE_PHONE_STATUSES)).first()
             if existing_phone:
                 flash('الرقم التسلسلي موجود بالفعل في النظام', 'error')
                 return redirect(url_for('add_new_phone'))
@@ -648,6 +1430,7 @@ def add_new_phone():
             )
             
             db.session.add(new_phone)
+            learned_tac = learn_tac(serial_number, brand, model)
             db.session.commit()
             
             # Record a buy transaction
@@ -666,6 +1449,8 @@ def add_new_phone():
             db.session.add(buy_tx)
             db.session.commit()
             
+            if learned_tac:
+                tac_index.add(*learned_tac)
             flash('تمت إضافة الهاتف الجديد بنجاح', 'success')
             return redirect(url_for('dashboard'))
         except ValueError:
@@ -699,7 +1484,10 @@ def add_used_phone():
             model = request.form.get('model')
             purchase_price = float(request.form.get('purchase_price'))  # Price without VAT
             selling_price = float(request.form.get('selling_price'))    # Price without VAT
-            serial_number = request.form.get('serial_number')
+            serial_number, serial_error = imei.check(request.form.get('serial_number'))
+            if serial_error:
+                flash(serial_error, 'error')
+                return redirect(url_for('add_used_phone'))
             phone_condition = request.form.get('phone_condition')
             age = int(request.form.get('age'))
             
@@ -716,11 +1504,13 @@ def add_used_phone():
             # Customer information fields
             customer_name = request.form.get('customer_name')
             customer_id = request.form.get('customer_id')
+            customer_phone = request.form.get('customer_phone')
             phone_color = request.form.get('phone_color')
             phone_memory = request.form.get('phone_memory')
             buyer_name = request.form.get('buyer_name')
             
-            existing_phone = Phone.query.filter_by(serial_number=serial_number).first()
+            existing_phone = Phone.query.filter(Phone.serial_number == serial_number,
+                                                Phone.status.in_(SELLABLE_PHONE_STATUSES)).first()
             if existing_phone:
                 flash('الرقم التسلسلي موجود بالفعل في النظام', 'error')
                 return redirect(url_for('add_used_phone'))
@@ -762,9 +1552,11 @@ def add_used_phone():
                 customer_id=customer_id,
                 phone_color=phone_color,
                 phone_memory=phone_memory,
-                buyer_name=buyer_name
+                buyer_name=buyer_name,
+                seller=find_or_create_customer(customer_name, phone=customer_phone, id_number=customer_id)
             )
             db.session.add(used_phone)
+            learned_tac = learn_tac(serial_number, brand, model)
             db.session.commit()
             
             # Record a buy transaction
@@ -777,12 +1569,14 @@ def add_used_phone():
                 vat_amount=purchase_vat,
                 user_id=current_user.id,
                 customer_name=customer_name,
-                customer_phone=None,
+                customer_phone=customers.normalize_phone(customer_phone) or None,
                 notes='شراء هاتف مستعمل'
             )
             db.session.add(buy_tx)
             db.session.commit()
             
+            if learned_tac:
+                tac_index.add(*learned_tac)
             flash('تمت إضافة الهاتف المستعمل بنجاح', 'success')
             return redirect(url_for('dashboard'))
         except ValueError:
@@ -812,7 +1606,11 @@ def add_used_phone():
 def delete_phone(phone_id):
     phone = Phone.query.get_or_404(phone_id)
     try:
-        db.session.delete(phone)
+        if phone.status not in SELLABLE_PHONE_STATUSES:
+            flash('لا يمكن حذف هاتف تم بيعه', 'error')
+            return redirect(url_for('dashboard'))
+        # Keep the row (and its buy transaction) for history, just take it out of stock
+        phone.status = PHONE_STATUS_REMOVED
         db.session.commit()
         flash('تم حذف الهاتف بنجاح', 'success')
     except Exception as e:
@@ -832,7 +1630,7 @@ def logout():
 @login_required
 def create_sale_page():
     """Show create sale page"""
-    phones = Phone.query.all()
+    phones = in_stock_phones().all()
     accessories = Accessory.query.all()
     
     # Convert Phone objects to dictionaries for JSON serialization
@@ -843,6 +1641,7 @@ def create_sale_page():
             'brand': phone.brand,
             'model': phone.model,
             'serial_number': phone.serial_number,
+            'phone_number': phone.phone_number,
             'selling_price': phone.selling_price,
             'description': phone.description or ''
         })
@@ -856,70 +1655,150 @@ def create_sale_page():
             'category': accessory.category,
             'description': accessory.description or '',
             'selling_price': accessory.selling_price,
-            'quantity_in_stock': accessory.quantity_in_stock
+            'quantity_in_stock': accessory.quantity_in_stock,
+            'sku': accessory.sku,
+            'ean': accessory.ean
         })
     
     return render_template('create_sale.html', phones=phones_data, accessories=accessories_data)
 
+def find_or_create_customer(name, phone=None, email=None, address=None, id_number=None):
+    """Customer for details typed at the till or on a trade-in, matched on phone (else ID number).
+
+    None for walk-ins with neither. The latest non-blank details replace what is on file.
+    """
+    phone = customers.normalize_phone(phone)
+    id_number = (id_number or '').strip()
+    name = (name or '').strip()
+    if name == customers.WALK_IN:
+        name = ''
+    if phone:
+        customer = Customer.query.filter_by(phone=phone).first()
+    elif id_number:
+        customer = Customer.query.filter_by(id_number=id_number).first()
+    else:
+        return None
+    if customer is None:
+        customer = Customer(name=name or phone or id_number, phone=phone or None)
+        db.session.add(customer)
+    elif name:
+        customer.name = name
+    customer.id_number = id_number or customer.id_number
+    customer.email = (email or '').strip() or customer.email
+    customer.address = (address or '').strip() or customer.address
+    return customer
+
+def record_sale(data, date_created=None, client_key=None):
+    """Add a sale and its items to the session, taking sold items out of stock"""
+    sale = Sale(
+        sale_number=generate_invoice_number(),
+        customer_name=data['customer_name'],
+        customer_phone=data['customer_phone'],
+        customer_email=data['customer_email'],
+        customer_address=data['customer_address'],
+        payment_method=data['payment_method'],
+        notes=data['notes'],
+        client_key=client_key,
+        customer=find_or_create_customer(data['customer_name'], phone=data['customer_phone'],
+                                         email=data['customer_email'], address=data['customer_address'])
+    )
+    if date_created is not None:
+        sale.date_created = date_created
+    
+    # Calculate totals
+    subtotal = sum(item['totalPrice'] for item in data['items'])
+    vat_amount = subtotal * 0.15
+    total_amount = subtotal + vat_amount
+    
+    sale.subtotal = subtotal
+    sale.vat_amount = vat_amount
+    sale.total_amount = total_amount
+    
+    db.session.add(sale)
+    db.session.flush()  # Get the sale ID
+    
+    # Add sale items
+    for item_data in data['items']:
+        sale_item = SaleItem(
+            sale_id=sale.id,
+            product_type=item_data['type'],
+            product_name=item_data['name'],
+            product_description=item_data['description'],
+            unit_price=item_data['unitPrice'],
+            quantity=item_data['quantity'],
+            total_price=item_data['totalPrice']
+        )
+        
+        # Add serial number for phones
+        if item_data['type'] == 'phone':
+            phone = db.session.get(Phone, int(item_data['id']))
+            if phone:
+                if phone.status not in SELLABLE_PHONE_STATUSES:
+                    raise ValueError(f'الهاتف {phone.serial_number} تم بيعه مسبقاً')
+                sale_item.serial_number = phone.serial_number
+                sale_item.phone_id = phone.id
+                sale_item.unit_cost = phone.purchase_price
+                # Take phone out of inventory, keeping its history
+                phone.status = PHONE_STATUS_SOLD
+                phone.sold_at = sale.date_created or datetime.utcnow()
+                unit_price = float(item_data['unitPrice'])
+                db.session.add(Transaction(
+                    phone_id=phone.id,
+                    transaction_type='sell',
+                    serial_number=phone.serial_number,
+                    price=unit_price,
+                    price_with_vat=calculate_price_with_vat(unit_price),
+                    vat_amount=calculate_vat(unit_price),
+                    user_id=current_user.id,
+                    customer_name=sale.customer_name,
+                    customer_phone=sale.customer_phone,
+                    notes=f'بيع - فاتورة {sale.sale_number}'
+                ))
+        elif item_data['type'] in ['accessory', 'charger', 'case', 'screen_protector']:
+            # Update accessory stock
+            accessory = Accessory.query.get(item_data['id'])
+            if accessory:
+                sale_item.accessory_id = accessory.id
+                sale_item.unit_cost = accessory.purchase_price
+                accessory.quantity_in_stock -= item_data['quantity']
+                if accessory.quantity_in_stock < 0:
+                    accessory.quantity_in_stock = 0
+        
+        db.session.add(sale_item)
+    
+    # Sales keyed in offline can land in a day whose analytics summary is already stored
+    if date_created is not None and date_created < analytics.period_start(datetime.utcnow(), 'day'):
+        analytics.invalidate_periods(db.session, date_created)
+    return sale
+
+def parse_client_time(value):
+    """Time a till recorded an offline sale (UTC ISO string); None if missing or implausible"""
+    try:
+        moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    now = datetime.utcnow()
+    if moment > now + timedelta(minutes=5) or moment < now - timedelta(days=OFFLINE_SALE_MAX_AGE_DAYS):
+        return None
+    return moment
+
 @app.route('/create_sale', methods=['POST'])
 @login_required
 def create_sale():
     """Create a new sale with multiple items"""
     try:
         data = request.get_json()
+        client_key = data.get('client_key') or None
         
-        # Create sale record
-        sale = Sale(
-            sale_number=generate_invoice_number(),
-            customer_name=data['customer_name'],
-            customer_phone=data['customer_phone'],
-            customer_email=data['customer_email'],
-            customer_address=data['customer_address'],
-            payment_method=data['payment_method'],
-            notes=data['notes']
-        )
-        
-        # Calculate totals
-        subtotal = sum(item['totalPrice'] for item in data['items'])
-        vat_amount = subtotal * 0.15
-        total_amount = subtotal + vat_amount
-        
-        sale.subtotal = subtotal
-        sale.vat_amount = vat_amount
-        sale.total_amount = total_amount
-        
-        db.session.add(sale)
-        db.session.flush()  # Get the sale ID
-        
-        # Add sale items
-        for item_data in data['items']:
-            sale_item = SaleItem(
-                sale_id=sale.id,
-                product_type=item_data['type'],
-                product_name=item_data['name'],
-                product_description=item_data['description'],
-                unit_price=item_data['unitPrice'],
-                quantity=item_data['quantity'],
-                total_price=item_data['totalPrice']
-            )
-            
-            # Add serial number for phones
-            if item_data['type'] == 'phone':
-                phone = Phone.query.get(item_data['id'])
-                if phone:
-                    sale_item.serial_number = phone.serial_number
-                    # Remove phone from inventory
-                    db.session.delete(phone)
-            elif item_data['type'] in ['accessory', 'charger', 'case', 'screen_protector']:
-                # Update accessory stock
-                accessory = Accessory.query.get(item_data['id'])
-                if accessory:
-                    accessory.quantity_in_stock -= item_data['quantity']
-                    if accessory.quantity_in_stock < 0:
-                        accessory.quantity_in_stock = 0
-            
-            db.session.add(sale_item)
+        # A retry of a sale that already reached the server returns the original sale
+        if client_key:
+            existing = Sale.query.filter_by(client_key=client_key).first()
+            if existing:
+                return jsonify({'success': True, 'sale_id': existing.id, 'duplicate': True})
         
+        sale = record_sale(data, client_key=client_key)
         db.session.commit()
         
         return jsonify({'success': True, 'sale_id': sale.id})
@@ -928,34 +1807,130 @@ def create_sale():
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/sync_sales', methods=['POST'])
+@login_required
+def sync_sales():
+    """Apply a batch of sales queued by a till while offline, at most once per client key"""
+    sales = (request.get_json(silent=True) or {}).get('sales') or []
+    if not isinstance(sales, list) or len(sales) > SYNC_BATCH_LIMIT:
+        return jsonify({'success': False, 'error': f'يجب إرسال قائمة من {SYNC_BATCH_LIMIT} عملية بيع كحد أقصى'}), 400
+    
+    # One write transaction for the whole batch. pysqlite does not open a transaction
+    # for SAVEPOINT, so without this each released savepoint would commit on its own
+    db.session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+    
+    keys = [data.get('client_key') for data in sales if isinstance(data, dict) and data.get('client_key')]
+    existing = dict(db.session.query(Sale.client_key, Sale.id).filter(Sale.client_key.in_(keys)).all()) if keys else {}
+    
+    results = []
+    for data in sales:
+        client_key = data.get('client_key') if isinstance(data, dict) else None
+        if not client_key:
+            results.append({'client_key': None, 'status': 'error', 'error': 'مفتاح العملية مفقود', 'permanent': True})
+            continue
+        if client_key in existing:
+            results.append({'client_key': client_key, 'status': 'duplicate', 'sale_id': existing[client_key]})
+            continue
+        # Each sale gets a savepoint, so one bad sale does not undo the rest of the batch
+        savepoint = db.session.begin_nested()
+        try:
+            sale = record_sale(data, date_created=parse_client_time(data.get('created_at')), client_key=client_key)
+            savepoint.commit()
+        except (ValueError, KeyError, TypeError, IntegrityError) as e:
+            # The sale itself is invalid (missing or bad fields, phone already sold): retrying cannot succeed
+            savepoint.rollback()
+            results.append({'client_key': client_key, 'status': 'error', 'error': str(e), 'permanent': True})
+            continue
+        except Exception as e:
+            savepoint.rollback()
+            results.append({'client_key': client_key, 'status': 'error', 'error': str(e), 'permanent': False})
+            continue
+        existing[client_key] = sale.id
+        results.append({'client_key': client_key, 'status': 'created', 'sale_id': sale.id,
+                        'sale_number': sale.sale_number})
+    
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify({'success': True, 'results': results})
+
+@contextmanager
+def sale_or_404(sale_id):
+    """A sale from the live database or, once archived, from the archive (usable until the block ends)"""
+    sale = db.session.get(Sale, sale_id)
+    if sale is not None:
+        yield sale
+        return
+    with sales_archive.reading() as session:
+        sale = session.get(Sale, sale_id)
+        if sale is None:
+            abort(404)
+        yield sale
+
 @app.route('/sale/<int:sale_id>')
 @login_required
 def view_sale(sale_id):
     """View sale details"""
-    sale = Sale.query.get_or_404(sale_id)
-    return render_template('view_sale.html', sale=sale)
+    with sale_or_404(sale_id) as sale:
+        return render_template('view_sale.html', sale=sale, receipt_printer=bool(app.config['RECEIPT_PRINTER']))
+
+def sale_receipt_bytes(sale):
+    return receipts.render_sale(sale, sorted(sale.items, key=lambda item: item.id),
+                                logo_path=app.config['RECEIPT_LOGO'], code_page=app.config['RECEIPT_CODE_PAGE'])
+
+@app.route('/sale/<int:sale_id>/receipt.bin')
+@login_required
+def sale_receipt(sale_id):
+    """ESC/POS receipt bytes, for a print agent or copying straight to the printer device"""
+    with sale_or_404(sale_id) as sale:
+        receipt, sale_number = sale_receipt_bytes(sale), sale.sale_number
+    return send_file(BytesIO(receipt), mimetype='application/octet-stream',
+                     as_attachment=True, download_name=f'receipt-{sale_number}.bin')
+
+@app.route('/sale/<int:sale_id>/receipt/print', methods=['POST'])
+@login_required
+def print_sale_receipt(sale_id):
+    """Send the ESC/POS receipt to the network thermal printer"""
+    with sale_or_404(sale_id) as sale:
+        receipt = sale_receipt_bytes(sale)
+    if not app.config['RECEIPT_PRINTER']:
+        flash('لم يتم إعداد الطابعة الحرارية', 'error')
+        return redirect(url_for('view_sale', sale_id=sale_id))
+    host, _, port = app.config['RECEIPT_PRINTER'].partition(':')
+    try:
+        with socket.create_connection((host, int(port or 9100)), timeout=5) as connection:
+            connection.sendall(receipt)
+        flash('تم إرسال الإيصال إلى الطابعة', 'success')
+    except OSError as e:
+        flash(f'تعذر الاتصال بالطابعة: {e}', 'error')
+    return redirect(url_for('view_sale', sale_id=sale_id))
 
 @app.route('/accessories')
 @login_required
+@response_cache.cached
 def list_accessories():
     """List all accessories"""
-    accessories = Accessory.query.order_by(Accessory.date_added.desc()).all()
-    
-    # Calculate totals considering quantity
-    total_purchase_value = sum(acc.purchase_price_with_vat * acc.quantity_in_stock for acc in accessories)
-    total_selling_value = sum(acc.selling_price_with_vat * acc.quantity_in_stock for acc in accessories)
-    total_quantity = sum(acc.quantity_in_stock for acc in accessories)
-    
-    # Get categories for display
-    categories = AccessoryCategory.query.all()
-    category_map = {cat.name: cat.arabic_name for cat in categories}
+    # Plain rows of the displayed columns, with the category's Arabic name joined in SQL
+    accessories = (db.session.query(*ACCESSORY_LIST_COLUMNS, AccessoryCategory.arabic_name.label('category_name'))
+                   .outerjoin(AccessoryCategory, AccessoryCategory.name == Accessory.category)
+                   .order_by(Accessory.date_added.desc()).all())
+    
+    # Totals considering quantity, in one pass over the table
+    totals = db.session.query(
+        func.count(Accessory.id).label('accessory_count'),
+        func.coalesce(func.sum(Accessory.quantity_in_stock), 0).label('quantity'),
+        func.coalesce(func.sum(Accessory.purchase_price_with_vat * Accessory.quantity_in_stock), 0).label('purchase_value'),
+        func.coalesce(func.sum(Accessory.selling_price_with_vat * Accessory.quantity_in_stock), 0).label('selling_value')
+    ).one()
     
     return render_template('list_accessories.html', 
                          accessories=accessories,
-                         total_purchase_value=total_purchase_value,
-                         total_selling_value=total_selling_value,
-                         total_quantity=total_quantity,
-                         category_map=category_map)
+                         total_count=totals.accessory_count,
+                         total_purchase_value=totals.purchase_value,
+                         total_selling_value=totals.selling_value,
+                         total_quantity=totals.quantity)
 
 @app.route('/add_accessory', methods=['GET', 'POST'])
 @login_required
@@ -969,8 +1944,16 @@ def add_accessory():
             purchase_price = float(request.form.get('purchase_price'))
             selling_price = float(request.form.get('selling_price'))
             quantity = int(request.form.get('quantity', 0))
+            min_quantity = int(request.form.get('min_quantity') or 5)
             supplier = request.form.get('supplier')
             notes = request.form.get('notes')
+            ean, ean_error = gtin.check(request.form.get('ean'))
+            if ean_error:
+                flash(ean_error, 'error')
+                return redirect(url_for('add_accessory'))
+            if ean and Accessory.query.filter_by(ean=ean).first():
+                flash('رمز EAN مسجل لأكسسوار آخر', 'error')
+                return redirect(url_for('add_accessory'))
             
             # Calculate VAT amounts
             purchase_vat = calculate_vat(purchase_price)
@@ -989,11 +1972,15 @@ def add_accessory():
                 purchase_price_with_vat=purchase_price_with_vat,
                 selling_price_with_vat=selling_price_with_vat,
                 quantity_in_stock=quantity,
+                min_quantity=min_quantity,
                 supplier=supplier,
-                notes=notes
+                notes=notes,
+                ean=ean
             )
             
             db.session.add(accessory)
+            db.session.flush()  # The SKU is built from the id
+            accessory.sku = gtin.sku_for(accessory.id)
             db.session.commit()
             
             flash('تمت إضافة الأكسسوار بنجاح', 'success')
@@ -1018,6 +2005,12 @@ def edit_accessory(accessory_id):
     accessory = Accessory.query.get_or_404(accessory_id)
     
     if request.method == 'POST':
+        ean, ean_error = gtin.check(request.form.get('ean'))
+        if not ean_error and ean and Accessory.query.filter(Accessory.ean == ean, Accessory.id != accessory.id).first():
+            ean_error = 'رمز EAN مسجل لأكسسوار آخر'
+        if ean_error:
+            flash(ean_error, 'error')
+            return redirect(url_for('edit_accessory', accessory_id=accessory_id))
         try:
             accessory.name = request.form.get('name')
             accessory.category = request.form.get('category')
@@ -1025,8 +2018,10 @@ def edit_accessory(accessory_id):
             accessory.purchase_price = float(request.form.get('purchase_price'))
             accessory.selling_price = float(request.form.get('selling_price'))
             accessory.quantity_in_stock = int(request.form.get('quantity', 0))
+            accessory.min_quantity = int(request.form.get('min_quantity') or 0)
             accessory.supplier = request.form.get('supplier')
             accessory.notes = request.form.get('notes')
+            accessory.ean = ean
             
             # Recalculate VAT amounts
             purchase_vat = calculate_vat(accessory.purchase_price)
@@ -1064,6 +2059,116 @@ def delete_accessory(accessory_id):
         db.session.rollback()
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/reorder')
+@login_required
+def reorder():
+    """Accessories at or below their minimum quantity or forecast to run out within the lead time"""
+    import forecasting
+
+    # Suggestions are recomputed by the reorder_forecast job every REORDER_REFRESH_HOURS
+    flagged = select(StockAlert.accessory_id).union(
+        select(ReorderSuggestion.accessory_id).where(ReorderSuggestion.suggested_quantity > 0)).subquery()
+    rows = db.session.query(Accessory, StockAlert, ReorderSuggestion).join(
+        flagged, flagged.c.accessory_id == Accessory.id).outerjoin(
+        StockAlert, StockAlert.accessory_id == Accessory.id).outerjoin(
+        ReorderSuggestion, ReorderSuggestion.accessory_id == Accessory.id).order_by(
+        ReorderSuggestion.days_of_cover.is_(None), ReorderSuggestion.days_of_cover, Accessory.name).all()
+    categories = AccessoryCategory.query.all()
+    category_map = {cat.name: cat.arabic_name for cat in categories}
+    return render_template('reorder.html', rows=rows, category_map=category_map,
+                         last_refresh=forecasting.last_refresh(db.session),
+                         lead_time=forecasting.LEAD_TIME_DAYS, cover_days=forecasting.COVER_DAYS)
+
+@app.route('/reorder/refresh', methods=['POST'])
+@login_required
+def refresh_reorder_suggestions():
+    """Queue the reorder_forecast job now instead of waiting for its schedule"""
+    job_runner.submit('reorder_forecast', user_id=current_user.id)
+    flash('تمت جدولة تحديث اقتراحات الطلب، حدّث الصفحة بعد قليل لرؤية النتائج', 'success')
+    return redirect(url_for('reorder'))
+
+def sync_vat_prices():
+    """Re-derive the VAT-inclusive selling prices of stock for sale from VAT_RATE"""
+    changed = pricing.sync_vat_prices(db.session, VAT_RATE)
+    if any(changed.values()):
+        audit_trail.record(db.session, 'reprice', 'vat', {'vat_rate': VAT_RATE, **changed})
+        response_cache.mark_dirty(db.session)
+    db.session.commit()
+    return changed
+
+@app.cli.command('sync-vat-prices')
+def sync_vat_prices_command():
+    """Recompute selling prices with VAT after VAT_RATE changed."""
+    started = time.perf_counter()
+    changed = sync_vat_prices()
+    print(f"Updated {changed['phone']} phones and {changed['accessory']} accessories "
+          f"in {time.perf_counter() - started:.3f}s")
+
+@app.route('/reprice', methods=['GET', 'POST'])
+@login_required
+def bulk_reprice():
+    """Preview, then apply, a price change to phones in stock or accessories matching a filter"""
+    form = request.form if request.method == 'POST' else request.args
+    target = form.get('target', 'phone')
+    mode = form.get('mode', 'percent')
+    if target not in pricing.TARGETS or mode not in pricing.MODES:
+        flash('خيارات غير صحيحة', 'error')
+        return redirect(url_for('bulk_reprice'))
+    filters = {column: form.get(column, '') for column in pricing.TARGETS[target]['filters']}
+    preview = None
+    if request.method == 'POST':
+        try:
+            value = float(form.get('value', ''))
+        except ValueError:
+            flash('أدخل قيمة التغيير', 'error')
+            return redirect(url_for('bulk_reprice', target=target, mode=mode, **filters))
+        preview = pricing.preview(db.session, target, filters, mode, value, VAT_RATE)
+        if form.get('action') == 'apply':
+            # Applied only if the rows still match what was previewed
+            if preview['count'] != form.get('expected_count', type=int):
+                flash('تغيرت الأصناف المطابقة منذ المعاينة، راجع المعاينة الجديدة', 'warning')
+            else:
+                started = time.perf_counter()
+                count = pricing.apply(db.session, target, filters, mode, value, VAT_RATE)
+                audit_trail.record(db.session, 'reprice', target, {
+                    'filters': {column: v for column, v in filters.items() if v}, 'mode': mode,
+                    'value': value, 'rows': count})
+                response_cache.mark_dirty(db.session)
+                if target == 'phone':
+                    live_dashboard.mark_reload(db.session)  # stock values changed outside the ORM
+                db.session.commit()
+                flash(f'تم تعديل أسعار {count} صنف خلال {(time.perf_counter() - started) * 1000:.0f} ملي ثانية',
+                      'success')
+                return redirect(url_for('bulk_reprice', target=target))
+
+    brands_models = db.session.query(Phone.brand, Phone.model).filter(PHONE_IN_STOCK).distinct().order_by(
+        Phone.brand, Phone.model).all()
+    return render_template('reprice.html', target=target, mode=mode, filters=filters,
+                         value=form.get('value', ''), preview=preview, brands_models=brands_models,
+                         categories=AccessoryCategory.query.order_by(AccessoryCategory.name).all())
+
+@app.cli.command('forecast-reorder')
+def forecast_reorder_command():
+    """Recompute accessory demand forecasts and reorder suggestions."""
+    import forecasting
+
+    started = time.perf_counter()
+    count = forecasting.refresh_suggestions(db.session, VAT_RATE)
+    print(f'Forecast {count} accessories in {time.perf_counter() - started:.3f}s')
+
+SEARCH_PREFIX_LIMIT = 50
+
+def merge_search_rows(*groups):
+    """Rows of ``groups`` in order, each id once"""
+    seen = set()
+    merged = []
+    for rows in groups:
+        for row in rows:
+            if row.id not in seen:
+                seen.add(row.id)
+                merged.append(row)
+    return merged
+
 @app.route('/search')
 @login_required
 def search():
@@ -1078,14 +2183,24 @@ def search():
     if search_term:
         # Search in phones
         if search_type in ['all', 'phones']:
-            phone_query = Phone.query
+            phone_query = in_stock_phones()
             
             # Add condition filter if specified
             if condition:
                 phone_query = phone_query.filter_by(condition=condition)
             
+            phone_query = phone_query.with_entities(*PHONE_SEARCH_COLUMNS)
+            exact = []
+            if search_term.isascii() and search_term.isdigit():
+                # Scanned or partly typed IMEIs and phone numbers, from the indexes; exact hits first
+                exact = phone_query.filter(db.or_(
+                    customers.prefix_range(Phone.serial_number, search_term),
+                    customers.prefix_range(Phone.phone_number, search_term)
+                )).order_by((Phone.serial_number == search_term).desc(), (Phone.phone_number == search_term).desc(),
+                            Phone.serial_number).limit(SEARCH_PREFIX_LIMIT).all()
+            
             # Search in multiple phone fields
-            phone_query = phone_query.filter(
+            substring = phone_query.filter(
                 db.or_(
                     Phone.phone_number.contains(search_term),
                     Phone.serial_number.contains(search_term),
@@ -1097,23 +2212,29 @@ def search():
                     Phone.customer_name.contains(search_term),
                     Phone.customer_id.contains(search_term)
                 )
-            )
+            ).all()
             
-            phones = phone_query.all()
+            # Then the closest model/colour/serial matches, tolerating typos and Arabic spellings
+            phones = merge_search_rows(exact, substring,
+                                       search_index.ranked('phone', Phone, search_term, phone_query))
         
         # Search in accessories
         if search_type in ['all', 'accessories']:
-            accessory_query = Accessory.query.filter(
+            accessory_query = db.session.query(*ACCESSORY_SEARCH_COLUMNS)
+            substring = accessory_query.filter(
                 db.or_(
+                    Accessory.sku == search_term,
+                    Accessory.ean == search_term,
                     Accessory.name.contains(search_term),
                     Accessory.category.contains(search_term),
                     Accessory.description.contains(search_term),
                     Accessory.supplier.contains(search_term),
                     Accessory.notes.contains(search_term)
                 )
-            )
+            ).order_by((Accessory.sku == search_term).desc(), (Accessory.ean == search_term).desc()).all()
             
-            accessories = accessory_query.all()
+            accessories = merge_search_rows(substring,
+                                            search_index.ranked('accessory', Accessory, search_term, accessory_query))
     
     return render_template('search.html', 
                          phones=phones, 
@@ -1122,6 +2243,64 @@ def search():
                          search_type=search_type,
                          condition=condition)
 
+CUSTOMER_LOOKUP_LIMIT = 10
+CUSTOMER_PAGE_SIZE = 100
+
+def search_customers(term, limit):
+    """Customers whose phone (when ``term`` has digits) or name starts with ``term``, from the indexes"""
+    phone = customers.normalize_phone(term)
+    if phone:
+        condition, order = customers.prefix_range(Customer.phone, phone), Customer.phone
+    else:
+        condition, order = customers.prefix_range(Customer.name, term), Customer.name
+    return Customer.query.filter(condition).order_by(order).limit(limit).all()
+
+@app.route('/customers/lookup')
+@login_required
+def lookup_customers():
+    """Checkout autocomplete"""
+    term = request.args.get('q', '').strip()
+    if not term:
+        return jsonify([])
+    return jsonify([{'id': customer.id, 'name': customer.name, 'phone': customer.phone or '',
+                     'email': customer.email or '', 'address': customer.address or ''}
+                    for customer in search_customers(term, CUSTOMER_LOOKUP_LIMIT)])
+
+@app.route('/customers')
+@login_required
+def list_customers():
+    """Customer directory: newest customers, or those matching a phone/name prefix"""
+    term = request.args.get('q', '').strip()
+    if term:
+        rows = search_customers(term, CUSTOMER_PAGE_SIZE)
+        if not rows and not customers.normalize_phone(term):
+            # No name starts with it: closest names instead, misspelt or in the other script
+            rows = search_index.ranked('customer', Customer, term, limit=CUSTOMER_PAGE_SIZE)
+    else:
+        rows = Customer.query.order_by(Customer.id.desc()).limit(CUSTOMER_PAGE_SIZE).all()
+    # Purchase totals of the listed customers only, from the (customer_id, date_created) index
+    totals = {}
+    if rows:
+        totals = {customer_id: (count, total, last) for customer_id, count, total, last in db.session.query(
+            Sale.customer_id, func.count(Sale.id), func.sum(Sale.total_amount), func.max(Sale.date_created)
+        ).filter(Sale.customer_id.in_([customer.id for customer in rows])).group_by(Sale.customer_id)}
+    return render_template('customers.html', customers=rows, totals=totals, q=term)
+
+@app.route('/customers/<int:customer_id>')
+@login_required
+def view_customer(customer_id):
+    """A customer's purchases and trade-ins"""
+    customer = Customer.query.get_or_404(customer_id)
+    trade_ins = customer.trade_ins.order_by(Phone.date_added.desc()).all()
+    # The whole purchase history, archived sales included
+    with sales_archive.reading() as session:
+        sales = session.query(Sale).options(selectinload(Sale.items)).filter(
+            Sale.customer_id == customer.id).order_by(Sale.date_created.desc()).all()
+        completed = [sale for sale in sales if sale.status == 'مكتمل']
+        return render_template('customer.html', customer=customer, sales=sales, trade_ins=trade_ins,
+                               total_spent=sum(sale.total_amount for sale in completed),
+                               completed_count=len(completed))
+
 @app.route('/sales')
 @login_required
 def list_sales():
@@ -1135,18 +2314,17 @@ def list_sales():
     filter_month_month = request.args.get('filter_month_month', '')
     filter_year = request.args.get('filter_year', '')
     
-    # Base query
-    query = Sale.query
+    # Date range filter; the archive is only attached when the range starts before its cutoff
+    start = None
+    conditions = []
     
     # Apply filters
     if filter_type == 'day' and filter_date:
         try:
             filter_date_obj = datetime.strptime(filter_date, '%Y-%m-%d')
             next_day = filter_date_obj + timedelta(days=1)
-            query = query.filter(
-                Sale.date_created >= filter_date_obj,
-                Sale.date_created < next_day
-            )
+            start = filter_date_obj
+            conditions = [Sale.date_created >= filter_date_obj, Sale.date_created < next_day]
         except ValueError:
             pass
     elif filter_type == 'month' and filter_month_year and filter_month_month:
@@ -1156,50 +2334,97 @@ def list_sales():
                 next_month = datetime(int(filter_month_year) + 1, 1, 1)
             else:
                 next_month = datetime(int(filter_month_year), int(filter_month_month) + 1, 1)
-            query = query.filter(
-                Sale.date_created >= month_start,
-                Sale.date_created < next_month
-            )
+            start = month_start
+            conditions = [Sale.date_created >= month_start, Sale.date_created < next_month]
         except ValueError:
             pass
     elif filter_type == 'year' and filter_year:
         try:
             year_start = datetime(int(filter_year), 1, 1)
             year_end = datetime(int(filter_year) + 1, 1, 1)
-            query = query.filter(
-                Sale.date_created >= year_start,
-                Sale.date_created < year_end
-            )
+            start = year_start
+            conditions = [Sale.date_created >= year_start, Sale.date_created < year_end]
         except ValueError:
             pass
     
-    # Get filtered sales
-    sales = query.order_by(Sale.date_created.desc()).all()
-    
-    # Calculate summary statistics for filtered results
-    total_sales_count = len(sales)
-    total_sales_amount = sum(sale.total_amount for sale in sales)
-    total_sales_subtotal = sum(sale.subtotal for sale in sales)
-    total_vat_amount = sum(sale.vat_amount for sale in sales)
-    
     # Get current date for default values
     now = datetime.now()
     current_year = now.year
     current_month = now.month
     
-    return render_template('list_sales.html', 
-                         sales=sales,
-                         filter_type=filter_type,
-                         filter_date=filter_date,
-                         filter_month_year=filter_month_year,
-                         filter_month_month=filter_month_month,
-                         filter_year=filter_year,
-                         total_sales_count=total_sales_count,
-                         total_sales_amount=total_sales_amount,
-                         total_sales_subtotal=total_sales_subtotal,
-                         total_vat_amount=total_vat_amount,
-                         current_year=current_year,
-                         current_month=current_month)
+    with sales_archive.reading(start) as session:
+        # Get filtered sales
+        sales = session.query(Sale).filter(*conditions).order_by(Sale.date_created.desc()).all()
+        
+        # Calculate summary statistics for filtered results
+        total_sales_count = len(sales)
+        total_sales_amount = sum(sale.total_amount for sale in sales)
+        total_sales_subtotal = sum(sale.subtotal for sale in sales)
+        total_vat_amount = sum(sale.vat_amount for sale in sales)
+        
+        return render_template('list_sales.html', 
+                             sales=sales,
+                             filter_type=filter_type,
+                             filter_date=filter_date,
+                             filter_month_year=filter_month_year,
+                             filter_month_month=filter_month_month,
+                             filter_year=filter_year,
+                             total_sales_count=total_sales_count,
+                             total_sales_amount=total_sales_amount,
+                             total_sales_subtotal=total_sales_subtotal,
+                             total_vat_amount=total_vat_amount,
+                             current_year=current_year,
+                             current_month=current_month)
+
+@app.route('/analytics')
+@login_required
+def sales_analytics():
+    """Sales analytics by period, product, product type and payment method"""
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in analytics.GRANULARITIES:
+        granularity = 'month'
+    periods = min(max(request.args.get('periods', 12, type=int), 2), 90)
+    
+    first_start = analytics.shift_period(analytics.period_start(datetime.utcnow(), granularity), granularity,
+                                         -(periods - 1))
+    with sales_archive.reading(first_start) as sales:
+        return _render_sales_analytics(sales, granularity, periods)
+
+def _render_sales_analytics(sales, granularity, periods):
+    # The open period is never archived: only the closed ones missing from the summaries read ``sales``
+    series = {dimension: analytics.period_series(db.session, granularity, periods, dimension, VAT_RATE, sales=sales)
+              for dimension in analytics.DIMENSIONS}
+    period_keys = analytics.period_keys(granularity, periods)
+    selected_period = request.args.get('period', period_keys[0])
+    if selected_period not in period_keys:
+        selected_period = period_keys[0]
+    
+    # Periods without sales have no row, show them as zeros
+    totals_by_period = {row['period']: row for row in series['total']}
+    totals = [totals_by_period.get(key, {'period': key, 'revenue': 0.0, 'units': 0, 'vat': 0.0,
+                                         'sales_count': 0, 'growth': None})
+              for key in period_keys]
+    selected_total = totals[period_keys.index(selected_period)]
+    breakdowns = {dimension: [row for row in rows if row['period'] == selected_period]
+                  for dimension, rows in series.items() if dimension != 'total'}
+    selected_start = datetime.strptime(selected_period, analytics.PERIOD_FORMATS[granularity])
+    selected_end = analytics.shift_period(selected_start, granularity, 1)
+    profit = {dimension: analytics.realized_profit(sales, dimension, selected_start, selected_end)
+              for dimension in ('brand', 'category')}
+    
+    return render_template('analytics.html',
+                         granularity=granularity,
+                         periods=periods,
+                         period_keys=period_keys,
+                         selected_period=selected_period,
+                         selected_total=selected_total,
+                         totals=totals,
+                         top_products=breakdowns['product'],
+                         product_type_breakdown=breakdowns['product_type'],
+                         payment_method_breakdown=breakdowns['payment_method'],
+                         profit_total=analytics.realized_profit(sales, None, selected_start, selected_end)[0],
+                         profit_by_brand=profit['brand'],
+                         profit_by_category=profit['category'])
 
 # Invoices route removed - replaced by sales system
 
@@ -1207,17 +2432,18 @@ def list_sales():
 
 @app.route('/inventory_summary')
 @login_required
+@response_cache.cached
 def inventory_summary():
     # Get total phones count
-    total_phones = Phone.query.count()
+    total_phones = in_stock_phones().count()
     
     # Get new and used phones counts
-    new_phones_count = Phone.query.filter_by(condition='new').count()
-    used_phones_count = Phone.query.filter_by(condition='used').count()
+    new_phones_count = in_stock_phones().filter_by(condition='new').count()
+    used_phones_count = in_stock_phones().filter_by(condition='used').count()
     
     # Get values for new and used phones
-    new_phones = Phone.query.filter_by(condition='new').all()
-    used_phones = Phone.query.filter_by(condition='used').all()
+    new_phones = in_stock_phones().filter_by(condition='new').all()
+    used_phones = in_stock_phones().filter_by(condition='used').all()
     
     # Calculate purchase and selling values
     new_phones_purchase_value = sum(phone.purchase_price for phone in new_phones)
@@ -1240,7 +2466,7 @@ def inventory_summary():
         func.sum(Phone.purchase_price).label('total_purchase_value'),
         func.sum(Phone.selling_price).label('total_selling_value'),
         func.avg(Phone.selling_price).label('average_price')
-    ).group_by(Phone.condition).all()
+    ).filter(PHONE_IN_STOCK).group_by(Phone.condition).all()
     
     # Get brand and model summary within each phone type
     new_phones_brand_summary = db.session.query(
@@ -1250,7 +2476,7 @@ def inventory_summary():
         func.sum(Phone.purchase_price).label('total_purchase_value'),
         func.sum(Phone.selling_price).label('total_selling_value'),
         func.avg(Phone.selling_price).label('average_price')
-    ).filter_by(condition='new').group_by(Phone.brand, Phone.model).all()
+    ).filter(PHONE_IN_STOCK).filter_by(condition='new').group_by(Phone.brand, Phone.model).all()
     
     used_phones_brand_summary = db.session.query(
         Phone.brand,
@@ -1259,7 +2485,7 @@ def inventory_summary():
         func.sum(Phone.purchase_price).label('total_purchase_value'),
         func.sum(Phone.selling_price).label('total_selling_value'),
         func.avg(Phone.selling_price).label('average_price')
-    ).filter_by(condition='used').group_by(Phone.brand, Phone.model).all()
+    ).filter(PHONE_IN_STOCK).filter_by(condition='used').group_by(Phone.brand, Phone.model).all()
     
     return render_template('inventory_summary.html',
                          total_phones=total_phones,
@@ -1278,6 +2504,206 @@ def inventory_summary():
                          new_phones_brand_summary=new_phones_brand_summary,
                          used_phones_brand_summary=used_phones_brand_summary)
 
+@app.route('/inventory_aging')
+@login_required
+def inventory_aging():
+    """Inventory aging and slow movers, with CSV export"""
+    phone_rows = inventory_reports.phone_aging(db.session)
+    accessory_rows = inventory_reports.accessory_aging(db.session)
+    
+    if request.args.get('format') == 'csv':
+        filename = f"inventory_aging_{datetime.now().strftime('%Y%m%d')}.csv"
+        return app.response_class(inventory_reports.aging_csv(phone_rows, accessory_rows),
+                                  mimetype='text/csv',
+                                  headers={'Content-Disposition': f'attachment; filename={filename}'})
+    
+    return render_template('inventory_aging.html',
+                         buckets=inventory_reports.AGING_BUCKETS,
+                         phone_rows=phone_rows,
+                         accessory_rows=accessory_rows,
+                         phone_totals=inventory_reports.totals(phone_rows),
+                         accessory_totals=inventory_reports.totals(accessory_rows),
+                         slow_movers=inventory_reports.slow_movers(db.session))
+
+# Background jobs
+
+LABEL_SHEET_SIZE = (794, 1123)  # A4 at 96 DPI, same scale as the label images
+LABEL_SHEET_GRID = (4, 10)      # columns x rows of 4.4cm x 2.5cm labels
+
+def phone_barcode_path(phone):
+    path = phone.barcode_path and app_path(phone.barcode_path)
+    if not path or not os.path.exists(path):
+        path = app_path(generate_barcode(phone.phone_number))
+    return path
+
+def render_label_sheet(paths):
+    """One A4 page of barcode labels from their images"""
+    from PIL import Image
+
+    sheet = Image.new('RGB', LABEL_SHEET_SIZE, 'white')
+    columns, rows = LABEL_SHEET_GRID
+    cell_width, cell_height = LABEL_SHEET_SIZE[0] // columns, LABEL_SHEET_SIZE[1] // rows
+    for index, path in enumerate(paths):
+        with Image.open(path) as label:
+            x = (index % columns) * cell_width + (cell_width - label.width) // 2
+            y = (index // columns) * cell_height + (cell_height - label.height) // 2
+            sheet.paste(label, (x, y))
+    return sheet
+
+@job_runner.job('barcode_labels', 'ملصقات باركود الهواتف المتوفرة (ZIP)')
+def barcode_labels_job(ctx):
+    """Label sheets for every phone in stock; resumes after the last finished sheet"""
+    checkpoint = ctx.checkpoint or {'last_id': 0, 'sheets': 0}
+    path = ctx.result_file('barcode_labels.zip', 'application/zip')
+    parts = path + '.parts'
+    os.makedirs(parts, exist_ok=True)
+    per_sheet = LABEL_SHEET_GRID[0] * LABEL_SHEET_GRID[1]
+    total = in_stock_phones().count()
+    done = in_stock_phones().filter(Phone.id <= checkpoint['last_id']).count()
+    while True:
+        phones = in_stock_phones().filter(Phone.id > checkpoint['last_id']).order_by(Phone.id).limit(per_sheet).all()
+        if not phones:
+            break
+        sheet_number = checkpoint['sheets'] + 1
+        render_label_sheet([phone_barcode_path(phone) for phone in phones]).save(os.path.join(parts, f'sheet_{sheet_number:04d}.png'))
+        checkpoint = {'last_id': phones[-1].id, 'sheets': sheet_number}
+        done += len(phones)
+        ctx.progress(done, total, f'صفحة {sheet_number}', checkpoint=checkpoint)
+    
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(os.listdir(parts)):
+            archive.write(os.path.join(parts, name), name)
+    shutil.rmtree(parts)
+    return f"{checkpoint['sheets']} صفحة، {done} ملصق"
+
+@job_runner.job('inventory_aging_csv', 'تصدير أعمار المخزون (CSV)')
+def inventory_aging_export_job(ctx):
+    ctx.progress(0, 3, 'الهواتف')
+    phone_rows = inventory_reports.phone_aging(db.session)
+    ctx.progress(1, 3, 'الأكسسوارات')
+    accessory_rows = inventory_reports.accessory_aging(db.session)
+    path = ctx.result_file(f"inventory_aging_{datetime.now().strftime('%Y%m%d')}.csv", 'text/csv')
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(inventory_reports.aging_csv(phone_rows, accessory_rows))
+    return f'{len(phone_rows) + len(accessory_rows)} سطر'
+
+@job_runner.job('analytics_rebuild', 'إعادة حساب ملخصات تحليل المبيعات')
+def analytics_rebuild_job(ctx):
+    """Recompute the stored period summaries, one granularity per transaction"""
+    steps = (('day', 365), ('month', 36), ('year', 10))
+    finished = (ctx.checkpoint or {}).get('finished', [])
+    for index, (granularity, periods) in enumerate(steps):
+        if granularity in finished:
+            continue
+        ctx.progress(index, len(steps), granularity, checkpoint={'finished': finished})
+        open_start = analytics.period_start(datetime.utcnow(), granularity)
+        first_start = analytics.shift_period(open_start, granularity, -periods)
+        db.session.query(SalesPeriodSummary).filter_by(granularity=granularity).delete()
+        with sales_archive.reading(first_start) as sales:
+            analytics.ensure_closed_periods(db.session, granularity, first_start, open_start, VAT_RATE, sales)
+        finished = finished + [granularity]
+    ctx.progress(len(steps), len(steps), checkpoint={'finished': finished})
+
+@job_runner.job('reorder_forecast', 'تحديث توقعات إعادة الطلب')
+def reorder_forecast_job(ctx):
+    import forecasting
+
+    count = forecasting.refresh_suggestions(db.session, VAT_RATE)
+    return f'{count} صنف'
+
+job_runner.every('reorder_forecast', REORDER_REFRESH_HOURS * 3600)
+
+@job_runner.job('rebuild_indexes', 'إعادة بناء الفهارس وتحديث الإحصائيات')
+def rebuild_indexes_job(ctx):
+    """REINDEX every model index, then ANALYZE; resumes at the next index"""
+    names = [index.name for table in db.metadata.sorted_tables for index in table.indexes]
+    for position in range((ctx.checkpoint or {}).get('next', 0), len(names)):
+        ctx.progress(position, len(names) + 1, names[position], checkpoint={'next': position})
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f'REINDEX "{names[position]}"')
+    ctx.progress(len(names), len(names) + 1, 'ANALYZE', checkpoint={'next': len(names)})
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE')
+    return f'{len(names)} فهرس'
+
+@job_runner.job('database_backup', 'نسخة احتياطية لقاعدة البيانات')
+def database_backup_job(ctx):
+    """Online snapshot of the database; sales keep being recorded while it is copied"""
+    result = backups.create_backup(db.engine.url.database, app.config['BACKUP_DIR'],
+                                   progress=lambda done, total: ctx.progress(done, total, 'نسخ الصفحات'))
+    ok, message = backups.verify_backup(result['path'])
+    if not ok:
+        raise RuntimeError(f"{result['name']}: {message}")
+    return f"{result['name']} ({result['size'] / 1024 / 1024:.1f} MB)"
+
+job_runner.every('database_backup', BACKUP_INTERVAL_HOURS * 3600)
+
+def job_as_dict(job):
+    return {
+        'id': job.id, 'kind': job.kind, 'status': job.status, 'progress': job.progress,
+        'message': job.message, 'error': job.error,
+        'download': url_for('download_job_result', job_id=job.id) if job.status == jobs.STATUS_DONE and job.result_path else None,
+    }
+
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    """Background jobs: start, follow, cancel and download"""
+    return render_template('jobs.html',
+                         jobs=job_runner.recent(),
+                         job_kinds={kind: label for kind, (label, _) in job_runner.handlers.items()},
+                         finished_statuses=jobs.FINISHED_STATUSES)
+
+@app.route('/jobs/status')
+@login_required
+def jobs_status():
+    return jsonify([job_as_dict(job) for job in job_runner.recent()])
+
+@app.route('/jobs/start/<kind>', methods=['POST'])
+@login_required
+def start_job(kind):
+    if kind not in job_runner.handlers:
+        flash('نوع المهمة غير معروف', 'error')
+    else:
+        job_runner.submit(kind, user_id=current_user.id)
+        flash(f'تمت جدولة المهمة: {job_runner.handlers[kind][0]}', 'success')
+    return redirect(url_for('list_jobs'))
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    job_runner.cancel(job_id)
+    return jsonify({'success': True})
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job_result(job_id):
+    job = db.session.get(Job, job_id)
+    if not job or job.status != jobs.STATUS_DONE or not job.result_path or not os.path.exists(job.result_path):
+        flash('الملف غير متوفر', 'error')
+        return redirect(url_for('list_jobs'))
+    return send_file(job.result_path, mimetype=job.result_mimetype, as_attachment=True,
+                     download_name=job.result_name)
+
+AUDIT_PAGE_SIZE = 100
+
+@app.route('/audit')
+@login_required
+def audit_log():
+    """Change history, filtered by entity and/or user, newest first"""
+    entity_type = request.args.get('entity_type') or None
+    entity_id = request.args.get('entity_id', type=int)
+    user_id = request.args.get('user_id', type=int)
+    action = request.args.get('action') or None
+    before_id = request.args.get('before', type=int)
+    entries = audit_trail.query(entity_type, entity_id, user_id, action, before_id, limit=AUDIT_PAGE_SIZE)
+    rows = [(entry, json.loads(entry.changes)) for entry in entries]
+    filters = {key: value for key, value in (('entity_type', entity_type), ('entity_id', entity_id),
+                                              ('user_id', user_id), ('action', action)) if value is not None}
+    next_page = url_for('audit_log', before=entries[-1].id, **filters) if len(entries) == AUDIT_PAGE_SIZE else None
+    return render_template('audit_log.html', rows=rows, filters=filters, next_page=next_page,
+                         users=User.query.order_by(User.username).all())
+
 # AJAX routes for phone types and accessory categories
 @app.route('/add_phone_type_ajax', methods=['POST'])
 @login_required
@@ -1323,14 +2749,15 @@ def delete_phone_type_ajax():
         if not phone_type:
             return jsonify({'success': False, 'message': 'الموديل غير موجود'})
         
-        # Check if any phones are using this type
-        phones_using_type = Phone.query.filter_by(brand=brand, model=model).count()
+        # Check if any phones in stock are using this type
+        phones_using_type = in_stock_phones().filter_by(brand=brand, model=model).count()
         if phones_using_type > 0:
             return jsonify({'success': False, 'message': f'لا يمكن حذف هذا الموديل لأنه مستخدم في {phones_using_type} هاتف'})
         
-        # Delete the phone type
+        # Delete the phone type (and the TACs mapped to it)
         db.session.delete(phone_type)
         db.session.commit()
+        load_tac_index()
         
         return jsonify({'success': True, 'message': f'تم حذف {brand} {model} بنجاح'})
     except Exception as e:
@@ -1428,13 +2855,198 @@ def get_accessory_categories_ajax():
 
 # sell_phone route removed - replaced by comprehensive sales system
 
+@app.cli.command('backup')
+@click.option('--verify', is_flag=True, help='Verify existing snapshots instead of taking a new one.')
+@click.option('--all', 'verify_all', is_flag=True, help='With --verify, check every snapshot, not only the newest.')
+@click.option('--list', 'list_only', is_flag=True, help='List the snapshots.')
+def backup_command(verify, verify_all, list_only):
+    """Take an online backup of the database, or verify/list the existing ones."""
+    folder = app.config['BACKUP_DIR']
+    if list_only:
+        for snapshot in backups.list_backups(folder):
+            print(f"{snapshot['name']}  {snapshot['size'] / 1024 / 1024:.1f} MB")
+        return
+    if verify:
+        snapshots = backups.list_backups(folder)
+        if not snapshots:
+            raise click.ClickException(f'No backups in {folder}')
+        failed = 0
+        for snapshot in snapshots if verify_all else snapshots[:1]:
+            ok, message = backups.verify_backup(snapshot['path'])
+            failed += not ok
+            print(f"{snapshot['name']}: {message}")
+        if failed:
+            raise click.ClickException(f'{failed} backup(s) failed verification')
+        return
+    result = backups.create_backup(db.engine.url.database, folder)
+    print(f"Wrote {result['path']} ({result['size'] / 1024 / 1024:.1f} MB, sha256 {result['sha256'][:12]}) "
+          f"in {result['seconds']:.2f}s")
+    for name in result['removed']:
+        print(f'Removed old backup {name}')
+
+@app.cli.command('archive-sales')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Archive sales dated before this day (default: ARCHIVE_AFTER_DAYS ago).')
+@click.option('--batch-size', default=archive.BATCH_SIZE, show_default=True, help='Sales moved per transaction.')
+def archive_sales_command(before, batch_size):
+    """Move old sales, their items and transactions to the archive database."""
+    import forecasting
+    latest = datetime.utcnow() - timedelta(days=forecasting.HISTORY_DAYS)
+    cutoff = before or datetime.utcnow() - timedelta(days=app.config['ARCHIVE_AFTER_DAYS'])
+    cutoff = datetime(cutoff.year, cutoff.month, cutoff.day)
+    if cutoff > latest:
+        # Demand forecasts read a year of sale items from the live database
+        raise click.ClickException(f'The cutoff must be on or before {latest:%Y-%m-%d}')
+    started = time.perf_counter()
+
+    def report(moved):
+        print(f"\r{moved['sales']} sales, {moved['items']} items, {moved['transactions']} transactions", end='')
+
+    moved = sales_archive.archive(cutoff, batch_size=batch_size, progress=report)
+    print()
+    response_cache.bump_version()  # the rows were moved with plain SQL, past the session events
+    print(f"Archived {moved['sales']} sales dated before {cutoff:%Y-%m-%d} to {sales_archive.path} "
+          f"in {time.perf_counter() - started:.2f}s")
+
+def _megabytes(size):
+    return f'{size / 1024 / 1024:.1f} MB'
+
+def maintained_databases():
+    """The database files `flask maintenance` works on: the live one and, once created, the archive"""
+    paths = [db.engine.url.database]
+    if os.path.exists(sales_archive.path):
+        paths.append(sales_archive.path)
+    return paths
+
+@app.cli.group('maintenance')
+def maintenance_cli():
+    """Database statistics, space reclamation, integrity checks and barcode cleanup (safe while open)."""
+
+@maintenance_cli.command('optimize')
+def maintenance_optimize_command():
+    """Refresh the query planner statistics (ANALYZE, then PRAGMA optimize)."""
+    for path in maintained_databases():
+        started = time.perf_counter()
+        result = maintenance.optimize(path)
+        print(f"{os.path.basename(path)}: {result['mode']}, {result['indexes']} indexes with statistics, "
+              f"{time.perf_counter() - started:.2f}s")
+
+@maintenance_cli.command('vacuum')
+@click.option('--convert', is_flag=True,
+              help='Switch a database to incremental auto-vacuum first (one full VACUUM that blocks writes).')
+def maintenance_vacuum_command(convert):
+    """Return free pages to the file system a few at a time, then truncate the WAL."""
+    for path in maintained_databases():
+        started = time.perf_counter()
+        result = maintenance.vacuum(path, convert=convert)
+        name = os.path.basename(path)
+        if not result['incremental']:
+            print(f"{name}: {result['free_pages']} free pages, incremental vacuum is off (run once with --convert)")
+            continue
+        print(f"{name}: {_megabytes(result['reclaimed'])} reclaimed, {result['free_pages']} free pages left, "
+              f"{time.perf_counter() - started:.2f}s")
+
+@maintenance_cli.command('check')
+@click.option('--quick', is_flag=True, help='Run quick_check (skips the index content checks).')
+def maintenance_check_command(quick):
+    """Run integrity_check and foreign_key_check on a snapshot of each database."""
+    failed = False
+    for path in maintained_databases():
+        # Archived rows refer to customers and phones in the live database, which the archive cannot check
+        result = maintenance.check(path, quick=quick, foreign_keys=path != sales_archive.path)
+        name = os.path.basename(path)
+        print(f"{name}: {'ok' if not result['problems'] else 'CORRUPT'}, "
+              f"{_megabytes(result['free_bytes'])} in free pages reclaimable with vacuum")
+        for problem in result['problems'][:20]:
+            print(f'  {problem}')
+        for table, parent, count in result['orphans']:
+            print(f'  {count} {table} rows refer to missing {parent} rows')
+        failed = failed or bool(result['problems'])
+    if failed:
+        raise click.ClickException('Integrity check failed; restore the newest verified backup')
+
+@maintenance_cli.command('barcodes')
+@click.option('--delete', is_flag=True, help='Delete the orphaned images.')
+@click.option('--regenerate', is_flag=True, help='Recreate the missing images of phones for sale.')
+def maintenance_barcodes_command(delete, regenerate):
+    """Find barcode images without a phone or accessory, and phones whose image is missing."""
+    folder = app_path(BARCODE_FOLDER)
+    started = time.perf_counter()
+    files = maintenance.scan_barcodes(folder)
+    phones = db.session.query(Phone.id, Phone.phone_number, Phone.barcode_path, Phone.status).all()
+    names = {f'{phone.phone_number}.png' for phone in phones}
+    names.update(os.path.basename(phone.barcode_path) for phone in phones if phone.barcode_path)
+    names.update(f'{sku}.png' for sku, in db.session.query(Accessory.sku).filter(Accessory.sku.isnot(None)))
+    orphans = maintenance.orphan_barcodes(files, names)
+    missing = maintenance.missing_files({phone.id: app_path(phone.barcode_path)
+                                         for phone in phones if phone.barcode_path})
+    print(f'{len(files)} images ({_megabytes(sum(size for size, _ in files.values()))}) scanned '
+          f'in {time.perf_counter() - started:.2f}s')
+    print(f'{len(orphans)} orphaned images ({_megabytes(sum(orphans.values()))})')
+    print(f'{len(missing)} phones whose barcode image is missing')
+    if delete:
+        print(f'{_megabytes(maintenance.remove_files(folder, orphans))} reclaimed')
+    if regenerate:
+        statuses = {phone.id: phone.status for phone in phones}
+        sellable = [phone_id for phone_id in missing if statuses[phone_id] in SELLABLE_PHONE_STATUSES]
+        for phone in Phone.query.filter(Phone.id.in_(sellable)):
+            phone.barcode_path = generate_barcode(phone.phone_number)
+        db.session.commit()
+        print(f'{len(sellable)} images regenerated')
+
+_initialized = False
+
+def init_database():
+    """Create/upgrade the schema and seed defaults; serialized across processes by a file lock"""
+    os.makedirs(app.instance_path, exist_ok=True)
+    with open(os.path.join(app.instance_path, 'init.lock'), 'w') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        with app.app_context():
+            db.create_all()  # Create tables if they do not exist
+            upgrade_schema()  # Add new columns/indexes to an existing database
+            sync_stock_alerts()  # Flag accessories already at or below their minimum quantity
+            backfill_accessory_skus()  # Shop barcodes for accessories added before they existed
+            backfill_customers()  # Customer records for sales and trade-ins made before the directory
+            search_index.sync()  # Search documents for rows added before the index or changed with plain SQL
+            backfill_sale_item_costs()  # Unit costs of sales made before they were recorded
+            analytics.drop_outdated_periods(db.session)  # Summaries stored before the per-accessory figures
+            sync_vat_prices()  # Follow a change of VAT_RATE in the prices of stock for sale
+            create_admin_user()  # Create admin user on startup if missing
+            create_default_phone_types()  # Create default phone types if they don't exist
+            create_default_accessory_categories()  # Create default accessory categories if they don't exist
+            static_assets.ensure_built(app)  # Hash and precompress vendored CSS/JS on first start
+            load_tac_index()  # Loaded before workers fork, so they share the pages until they reload
+            search_index.load()  # Same for the trigram index; workers then only apply newer documents
+            # Written now so forked workers do not inherit (and each write) the seeding entries
+            audit_trail.flush()
+            # Connections opened here must not be shared with forked workers
+            db.engine.dispose()
+
+def init_app():
+    """Prepare the database once per process and return the app.
+
+    Entry point for ``python app.py`` and gunicorn (see gunicorn.conf.py, which
+    preloads it in the master so the init runs once, before workers fork).
+    The app and its extensions are the module's, built when it is imported,
+    so settings come from the environment (PHONE_SHOP_* variables).
+    """
+    global _initialized
+    if not _initialized:
+        init_database()
+        _initialized = True
+    return app
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create and upgrade the database tables and seed the defaults."""
+    started = time.perf_counter()
+    init_database()
+    print(f'Database ready in {time.perf_counter() - started:.2f}s')
+
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()  # Create tables if they do not exist
-        create_admin_user()  # Create admin user on startup if missing
-        create_default_phone_types()  # Create default phone types if they don't exist
-        create_default_accessory_categories()  # Create default accessory categories if they don't exist
+    init_app()
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', type=int, default=5001)
     args = parser.parse_args()
-    app.run(debug=True, port=args.port) 
\ No newline at end of file
+    app.run(debug=True, port=args.port)
@@ -0,0 +1,194 @@
+"""Old sales moved out of the live database into an archive file.
+
+Sales, their items and stock transactions older than a cutoff are copied to
+a second SQLite file (the archive, same tables) and deleted from the live
+database, a batch per transaction with a pause between batches, so the till
+keeps selling while it runs. The live file, its backups and its VACUUMs then
+only carry recent history.
+
+Every run is recorded in the live database with its cutoff and the totals it
+moved, so all-time figures stay right without opening the archive. Reports
+only ATTACH the archive when the dates they ask for start before the latest
+cutoff: on that connection, temporary views named after the archived tables
+(``sale``, ``sale_item``, ``transaction``) shadow the live tables with the
+union of both, so the same queries, ORM or SQL, see the whole history.
+
+The newest row of each table is never archived, so SQLite never hands an
+archived id out again and an invoice id keeps naming one sale. Moving a batch
+writes both files in one transaction, but with WAL its commit is atomic per
+file: after a crash a batch can be left in both, and the next run replaces
+the archive's copy and deletes the live one.
+"""
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateColumn
+
+import analytics
+
+SCHEMA = 'archive'
+BATCH_SIZE = 500
+BATCH_SLEEP = 0.05  # seconds to yield to the till between batches
+
+
+class SalesArchive:
+    """Moves old sales to the archive file and attaches it for reports that reach back that far"""
+
+    def __init__(self, app, db, run_model, sale_model, item_model, transaction_model):
+        self.app = app
+        self.db = db
+        self.run_model = run_model
+        self.sale = sale_model.__table__
+        self.item = item_model.__table__
+        self.transaction = transaction_model.__table__
+        self.tables = (self.sale, self.item, self.transaction)
+        self._engine = None
+
+    @property
+    def path(self):
+        return self.app.config['ARCHIVE_DATABASE']
+
+    def boundary(self, session):
+        """Latest cutoff archived up to, None before the first run"""
+        return session.query(func.max(self.run_model.cutoff)).scalar()
+
+    def covers(self, session, start):
+        """Whether sales from ``start`` on (None: all of them) may be in the archive"""
+        boundary = self.boundary(session)
+        return boundary is not None and (start is None or start < boundary)
+
+    def totals(self, session):
+        """Sums of the archived sales, to add to all-time figures"""
+        run = self.run_model
+        row = session.query(func.sum(run.sales), func.sum(run.total_amount), func.sum(run.subtotal),
+                            func.sum(run.vat_amount), func.sum(run.profit)).one()
+        return {'sales': row[0] or 0, 'total_amount': row[1] or 0.0, 'subtotal': row[2] or 0.0,
+                'vat_amount': row[3] or 0.0, 'profit': row[4] or 0.0}
+
+    # Schema
+
+    def _connect(self):
+        """A connection of its own, closed for good afterwards: the attachment and temp views go with it"""
+        if self._engine is None:
+            self._engine = create_engine(self.db.engine.url, poolclass=NullPool)
+        return self._engine.connect()
+
+    def _attach(self, conn):
+        conn.exec_driver_sql(f'ATTACH DATABASE ? AS {SCHEMA}', (self.path,))
+        self._ensure_tables(conn)
+        conn.commit()
+
+    def _ensure_tables(self, conn):
+        """Create the archive tables, or add the columns and indexes the models gained since"""
+        for table in self.tables:
+            columns = {row[1] for row in conn.exec_driver_sql(f'PRAGMA {SCHEMA}.table_info("{table.name}")')}
+            for column in table.columns:
+                if columns and column.name not in columns:
+                    conn.exec_driver_sql(f'ALTER TABLE {SCHEMA}."{table.name}" ADD COLUMN '
+                                         f'{CreateColumn(column).compile(dialect=conn.dialect)}')
+        # Same DDL as the live tables, created in the archive (execution_options changes the connection itself)
+        conn.execution_options(schema_translate_map={None: SCHEMA})
+        try:
+            for table in self.tables:
+                table.create(conn, checkfirst=True)
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+        finally:
+            conn.execution_options(schema_translate_map=None)
+
+    @staticmethod
+    def _columns(table):
+        return ', '.join(f'"{column.name}"' for column in table.columns)
+
+    # Archiving
+
+    def archive(self, cutoff, batch_size=BATCH_SIZE, sleep=BATCH_SLEEP, progress=None):
+        """Move sales (with their items) and transactions dated before ``cutoff``; returns the counts moved"""
+        run = self.run_model.__table__
+        moved = {'sales': 0, 'items': 0, 'transactions': 0}
+        with self._connect() as conn:
+            self._attach(conn)
+            # Recorded first: reports reaching back past the cutoff attach the archive while rows move
+            run_id = conn.execute(run.insert().values(cutoff=cutoff)).inserted_primary_key[0]
+            conn.commit()
+            while True:
+                conn.exec_driver_sql('BEGIN IMMEDIATE')
+                batch = self._move_batch(conn, cutoff, batch_size)
+                conn.execute(run.update().where(run.c.id == run_id).values(
+                    {run.c[key]: run.c[key] + value for key, value in batch.items()}))
+                conn.commit()
+                for key in moved:
+                    moved[key] += batch[key]
+                if progress:
+                    progress(moved)
+                if not batch['sales'] and not batch['transactions']:
+                    break
+                time.sleep(sleep)
+        return moved
+
+    def _batch_ids(self, conn, table, cutoff, batch_size):
+        # Never the newest row: SQLite would give its id to the next new row
+        return conn.execute(select(table.c.id).where(
+            table.c.date_created < cutoff,
+            table.c.id < select(func.max(table.c.id)).scalar_subquery()
+        ).order_by(table.c.id).limit(batch_size)).scalars().all()
+
+    def _move(self, conn, table, key, ids):
+        """Copy the rows of ``table`` whose ``key`` is in ``ids`` to the archive and delete them here"""
+        if not ids:
+            return 0
+        columns = self._columns(table)
+        placeholders = ', '.join('?' * len(ids))
+        conn.exec_driver_sql(
+            f'INSERT OR REPLACE INTO {SCHEMA}."{table.name}" ({columns}) '
+            f'SELECT {columns} FROM main."{table.name}" WHERE "{key}" IN ({placeholders})', tuple(ids))
+        return conn.exec_driver_sql(
+            f'DELETE FROM main."{table.name}" WHERE "{key}" IN ({placeholders})', tuple(ids)).rowcount
+
+    def _move_batch(self, conn, cutoff, batch_size):
+        sale_ids = self._batch_ids(conn, self.sale, cutoff, batch_size)
+        batch = {'sales': len(sale_ids), 'total_amount': 0.0, 'subtotal': 0.0, 'vat_amount': 0.0, 'profit': 0.0}
+        if sale_ids:
+            # Figures the moved sales take out of the live database, for all-time totals
+            placeholders = ', '.join('?' * len(sale_ids))
+            batch['total_amount'], batch['subtotal'], batch['vat_amount'] = conn.exec_driver_sql(
+                f'SELECT COALESCE(SUM(total_amount), 0), COALESCE(SUM(subtotal), 0), COALESCE(SUM(vat_amount), 0) '
+                f'FROM main.sale WHERE id IN ({placeholders})', tuple(sale_ids)).one()
+            batch['profit'] = conn.exec_driver_sql(
+                f'SELECT COALESCE(SUM(si.total_price - si.unit_cost * si.quantity), 0) '
+                f'FROM main.sale s JOIN main.sale_item si ON si.sale_id = s.id '
+                f'WHERE s.id IN ({placeholders}) AND {analytics.COMPLETED_SALE}', tuple(sale_ids)).scalar()
+        batch['items'] = self._move(conn, self.item, 'sale_id', sale_ids)
+        self._move(conn, self.sale, 'id', sale_ids)
+        batch['transactions'] = self._move(
+            conn, self.transaction, 'id', self._batch_ids(conn, self.transaction, cutoff, batch_size))
+        return batch
+
+    # Reading
+
+    @contextmanager
+    def reading(self, start=None):
+        """Session for reading sales from ``start`` on (None: all of them).
+
+        The app's session when the live database holds them all; otherwise a
+        read-only session on a connection with the archive attached and merged
+        in. Writes (report summaries included) belong on the app's session.
+        """
+        if not self.covers(self.db.session, start):
+            yield self.db.session
+            return
+        with self._connect() as conn:
+            self._attach(conn)
+            for table in self.tables:
+                columns = self._columns(table)
+                conn.exec_driver_sql(
+                    f'CREATE TEMP VIEW "{table.name}" AS SELECT {columns} FROM main."{table.name}" '
+                    f'UNION ALL SELECT {columns} FROM {SCHEMA}."{table.name}"')
+            session = Session(bind=conn)
+            try:
+                yield session
+            finally:
+                session.close()
@@ -0,0 +1,233 @@
+"""Append-only audit trail of changes to stock, sales, catalogue and users.
+
+Changes are captured from SQLAlchemy session events: after each flush the
+column-level before/after values of every tracked object that was inserted,
+updated or deleted are collected on the session, together with the logged-in
+user and the endpoint. On commit they are handed to an in-memory buffer (on
+rollback, or when their savepoint is rolled back, they are dropped), so a
+request only pays for building a few dicts.
+
+A background thread per process drains the buffer and inserts the entries in
+batches, one transaction per batch. Entries still buffered when the process
+exits normally are written by an atexit hook; a crash can lose at most the
+last FLUSH_INTERVAL seconds of entries. A batch that keeps failing for
+another reason than a busy database is retried, then written entry by entry
+so only the entries that cannot be stored are dropped (and logged). Triggers
+on the table reject UPDATE and DELETE.
+"""
+import atexit
+import json
+import os
+import threading
+from collections import deque
+from datetime import date, datetime
+
+from flask import has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, scoped_session
+
+PENDING = 'audit_pending'
+FLUSH_INTERVAL = 1.0   # seconds between writes of the buffer
+BATCH_SIZE = 500       # entries per insert transaction
+WRITE_ATTEMPTS = 3     # tries of a failing batch (database busy aside) before its entries go one by one
+REDACTED = '***'
+
+ACTION_CREATE = 'create'
+ACTION_UPDATE = 'update'
+ACTION_DELETE = 'delete'
+
+
+class AuditTrail:
+    """Session-event capture plus the per-process batched writer"""
+
+    def __init__(self, app, db, model, tracked_models, redacted_columns=('password',)):
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+        # model -> attribute naming the row for people reading the log (kept after a delete)
+        self.tracked_models = dict(tracked_models)
+        self.redacted_columns = set(redacted_columns)
+        self._buffer = deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._failures = 0
+        for model_class in self.tracked_models:
+            for column in sa_inspect(model_class).column_attrs:
+                # Load the old value when an expired attribute is assigned, so the diff has a "before"
+                event.listen(getattr(model_class, column.key), 'set', _keep_history, active_history=True)
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_soft_rollback)
+        atexit.register(self.flush)
+        app.extensions['audit'] = self
+
+    # Capture
+
+    def _after_flush(self, session, flush_context):
+        entries = []
+        for action, objects in ((ACTION_CREATE, session.new), (ACTION_UPDATE, session.dirty),
+                                (ACTION_DELETE, session.deleted)):
+            for obj in objects:
+                if type(obj) in self.tracked_models:
+                    entry = self._entry(action, obj)
+                    if entry is not None:
+                        entries.append(entry)
+        if entries:
+            user_id, username, source = self._actor()
+            for entry in entries:
+                entry.update(user_id=user_id, username=username, source=source)
+            # Tagged with the savepoint they were flushed in, if any, so rolling it back drops them
+            session.info.setdefault(PENDING, []).append((session.get_nested_transaction(), entries))
+
+    def _entry(self, action, obj):
+        state = sa_inspect(obj)
+        changes = {}
+        for column in state.mapper.column_attrs:
+            key = column.key
+            if action == ACTION_UPDATE:
+                history = state.attrs[key].history
+                if not history.has_changes():
+                    continue
+                old = history.deleted[0] if history.deleted else None
+                new = history.added[0] if history.added else None
+                if old == new:
+                    continue
+                changes[key] = [self._value(key, old), self._value(key, new)]
+            else:
+                value = state.dict.get(key)
+                if value is not None:
+                    changes[key] = [None, self._value(key, value)] if action == ACTION_CREATE else \
+                        [self._value(key, value), None]
+        if not changes:
+            return None
+        identity = state.mapper.primary_key_from_instance(obj)
+        label = getattr(obj, self.tracked_models[type(obj)], None)
+        return {
+            'created_at': datetime.utcnow(), 'action': action, 'entity_type': state.mapper.local_table.name,
+            'entity_id': identity[0] if len(identity) == 1 else None,
+            'entity_label': str(label)[:200] if label is not None else None,
+            'changes': json.dumps(changes, ensure_ascii=False),
+        }
+
+    def _value(self, key, value):
+        if key in self.redacted_columns:
+            return REDACTED
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        return str(value)
+
+    def _actor(self):
+        if not has_request_context():
+            return None, None, 'system'
+        user = current_user
+        if user and user.is_authenticated:
+            return user.id, user.username, request.endpoint
+        return None, None, request.endpoint
+
+    def record(self, session, action, entity_type, changes, entity_id=None, entity_label=None):
+        """Log a change made by a bulk statement (which flush events never see) with ``session``'s transaction"""
+        if isinstance(session, scoped_session):
+            session = session()
+        user_id, username, source = self._actor()
+        entry = {'created_at': datetime.utcnow(), 'action': action, 'entity_type': entity_type,
+                 'entity_id': entity_id, 'entity_label': entity_label,
+                 'changes': json.dumps(changes, ensure_ascii=False),
+                 'user_id': user_id, 'username': username, 'source': source}
+        session.info.setdefault(PENDING, []).append((session.get_nested_transaction(), [entry]))
+
+    def _after_commit(self, session):
+        pending = session.info.pop(PENDING, None)
+        if pending:
+            self._buffer.extend(entry for _, entries in pending for entry in entries)
+            self._ensure_started()
+            if len(self._buffer) >= BATCH_SIZE:
+                self._wake.set()
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop(PENDING, None)
+        elif session.info.get(PENDING):
+            session.info[PENDING] = [(savepoint, entries) for savepoint, entries in session.info[PENDING]
+                                     if savepoint is not previous_transaction]
+
+    # Writer
+
+    def _ensure_started(self):
+        # One writer thread per process; after a fork the parent's thread does not exist
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._write_loop, name='audit-writer', daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OperationalError:
+                pass  # database busy; the entries were put back and go with the next batch
+            except Exception:
+                # The batch was put back for another try; the writer must outlive any bad entry
+                self.app.logger.exception('Audit trail write failed')
+
+    def flush(self):
+        """Write every buffered entry now"""
+        while self._buffer:
+            batch = []
+            while self._buffer and len(batch) < BATCH_SIZE:
+                batch.append(self._buffer.popleft())
+            try:
+                with self.app.app_context(), self.db.engine.begin() as conn:
+                    conn.execute(self.table.insert(), batch)
+            except OperationalError:
+                self._buffer.extendleft(reversed(batch))
+                raise
+            except Exception:
+                self._failures += 1
+                if self._failures < WRITE_ATTEMPTS:
+                    self._buffer.extendleft(reversed(batch))
+                    raise
+                self._failures = 0
+                self._write_each(batch)
+            else:
+                self._failures = 0
+
+    def _write_each(self, batch):
+        """Insert entries one per transaction, dropping those that cannot be written"""
+        for position, entry in enumerate(batch):
+            try:
+                with self.app.app_context(), self.db.engine.begin() as conn:
+                    conn.execute(self.table.insert(), [entry])
+            except OperationalError:
+                self._buffer.extendleft(reversed(batch[position:]))
+                raise
+            except Exception:
+                self.app.logger.exception('Dropped audit entry %s %s', entry.get('entity_type'), entry.get('entity_id'))
+
+    def query(self, entity_type=None, entity_id=None, user_id=None, action=None, before_id=None, limit=100):
+        """Newest entries first, filtered on the indexed columns; ``before_id`` continues a previous page"""
+        audit_table = self.table
+        statement = audit_table.select().order_by(audit_table.c.id.desc()).limit(limit)
+        if entity_type:
+            statement = statement.where(audit_table.c.entity_type == entity_type)
+        if entity_id is not None:
+            statement = statement.where(audit_table.c.entity_id == entity_id)
+        if user_id is not None:
+            statement = statement.where(audit_table.c.user_id == user_id)
+        if action:
+            statement = statement.where(audit_table.c.action == action)
+        if before_id:
+            statement = statement.where(audit_table.c.id < before_id)
+        return self.db.session.execute(statement).all()
+
+
+def _keep_history(target, value, oldvalue, initiator):
+    """No-op set listener; registering it with active_history is what loads the old value"""
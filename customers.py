@@ -0,0 +1,35 @@
+"""Customer phone numbers in one stored form, and prefix lookups on them.
+
+Numbers are typed at the till in every shape (+966 50..., 00966..., 050-...,
+Arabic-Indic digits), so they are stored as local digits only: Saudi numbers
+as 05XXXXXXXX, others as 00 + country code. One customer per stored number,
+and autocomplete is a range scan on its index (``phone >= prefix AND phone <
+next prefix``), which SQLite serves from the index where LIKE 'x%' would not.
+"""
+COUNTRY_CODE = '966'
+LOCAL_MOBILE_LENGTH = 9  # 5XXXXXXXX without the trunk 0
+
+DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+
+WALK_IN = 'عميل نقدي'  # name the till puts on sales without customer details
+
+
+def normalize_phone(value):
+    """Stored form of a phone number, or a prefix of one; '' when there are no digits"""
+    value = (value or '').strip().translate(DIGITS)
+    digits = ''.join(char for char in value if char.isdigit())
+    if value.startswith('+'):
+        digits = '00' + digits
+    if digits.startswith('00' + COUNTRY_CODE):
+        digits = '0' + digits[2 + len(COUNTRY_CODE):]
+    elif digits.startswith(COUNTRY_CODE) and len(digits) > LOCAL_MOBILE_LENGTH:
+        digits = '0' + digits[len(COUNTRY_CODE):]
+    elif len(digits) == LOCAL_MOBILE_LENGTH and digits.startswith('5'):
+        digits = '0' + digits
+    return digits
+
+
+def prefix_range(column, prefix):
+    """Index-friendly condition for values of ``column`` starting with ``prefix``"""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (column >= prefix) & (column < upper)
@@ -0,0 +1,122 @@
+"""Accessory demand forecasting and reorder suggestions.
+
+Daily unit sales per accessory are read in one query (closed days from the
+stored sales_period_summary rows, today live from sale_item), keyed on the
+sale item's accessory id, and laid out as a SKU x day NumPy matrix. Forecasts
+for every SKU are then computed at once: a moving average over the recent
+window and simple exponential smoothing, whose final level is a single
+matrix-vector product with the smoothing weights. Suggested order quantities follow from the
+forecast, the supplier lead time, a safety stock and the accessory's
+min_quantity. Results replace the reorder_suggestion table in one transaction.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import text, bindparam, DateTime
+
+import analytics
+
+HISTORY_DAYS = 365
+WINDOW_DAYS = 28          # moving average / demand variability window
+SMOOTHING_ALPHA = 0.1     # exponential smoothing weight of the most recent day
+LEAD_TIME_DAYS = 7        # days between placing an order and receiving it
+COVER_DAYS = 14           # stock to hold after a delivery arrives
+SERVICE_LEVEL_Z = 1.65    # ~95% chance of not running out during the lead time
+
+
+def daily_demand(session, start, days, vat_rate):
+    """Accessory stock rows and their SKU x day matrix of units sold over ``days`` days from ``start``"""
+    accessories = session.execute(text(
+        'SELECT id, name, quantity_in_stock, COALESCE(min_quantity, 0) FROM accessory ORDER BY id')).all()
+    stock = np.array([(row[0], row[2], row[3]) for row in accessories], dtype=np.int64).reshape(-1, 3)
+    # Sale items reference their accessory by id; older ones only by name, counted for the first of that name
+    rows_by_key = {}
+    for index, row in enumerate(accessories):
+        rows_by_key[str(row.id)] = index
+        rows_by_key.setdefault(f'name:{row.name}', index)
+
+    # Closed days come from the per-accessory daily summaries kept by the analytics
+    # module (computed once per day), only today is aggregated from sale_item
+    today = start + timedelta(days=days - 1)
+    analytics.ensure_closed_periods(session, 'day', start, today, vat_rate)
+    query = text(f"""
+        SELECT CAST(julianday(period) - julianday(:first) AS INTEGER), dim_key, units
+        FROM sales_period_summary
+        WHERE granularity = 'day' AND dimension = 'accessory' AND period >= :first AND period < :today
+        UNION ALL
+        SELECT :days - 1, {analytics.SUMMARY_DIMENSIONS['accessory']} AS dim_key, SUM(si.quantity)
+        FROM sale s JOIN sale_item si ON si.sale_id = s.id
+        WHERE s.date_created >= :today_start AND {analytics.COMPLETED_SALE}
+        GROUP BY dim_key
+    """).bindparams(bindparam('today_start', today, type_=DateTime))
+    sku_rows, day_columns, units = [], [], []
+    for day, key, quantity in session.execute(query, {
+            'first': analytics.period_key(start, 'day'), 'today': analytics.period_key(today, 'day'),
+            'days': days}):
+        index = rows_by_key.get(key)
+        if index is not None:
+            sku_rows.append(index)
+            day_columns.append(day)
+            units.append(quantity)
+
+    demand = np.zeros((len(accessories), days), dtype=np.float64)
+    np.add.at(demand, (np.array(sku_rows, dtype=np.int64), np.array(day_columns, dtype=np.int64)),
+              np.array(units, dtype=np.float64))
+    return stock, demand
+
+
+def forecast(demand, alpha=SMOOTHING_ALPHA, window=WINDOW_DAYS):
+    """Moving average, exponentially smoothed level and recent std-dev of daily demand per row"""
+    days = demand.shape[1]
+    recent = demand[:, -window:]
+    # Level after smoothing the whole series, seeded with the first day:
+    # l = sum(alpha * (1 - alpha)^(days - 1 - t) * x_t) + (1 - alpha)^days * x_0
+    weights = alpha * (1 - alpha) ** np.arange(days - 1, -1, -1)
+    level = demand @ weights + (1 - alpha) ** days * demand[:, 0]
+    return recent.mean(axis=1), level, recent.std(axis=1)
+
+
+def suggest(on_hand, min_quantity, daily_rate, deviation, lead_time=LEAD_TIME_DAYS, cover=COVER_DAYS,
+            z=SERVICE_LEVEL_Z):
+    """Safety stock, reorder point and order quantity per SKU"""
+    safety_stock = z * deviation * np.sqrt(lead_time)
+    reorder_point = np.maximum(daily_rate * lead_time + safety_stock, min_quantity)
+    # Without sales history, fall back to ordering up to twice the configured minimum
+    order_up_to = np.maximum(daily_rate * (lead_time + cover) + safety_stock, 2 * min_quantity)
+    quantity = np.where(on_hand <= reorder_point, np.ceil(order_up_to - on_hand), 0)
+    return safety_stock, reorder_point, np.maximum(quantity, 0).astype(np.int64)
+
+
+def refresh_suggestions(session, vat_rate, now=None, history_days=HISTORY_DAYS, lead_time=LEAD_TIME_DAYS,
+                        cover=COVER_DAYS):
+    """Recompute and store reorder suggestions for every accessory; returns the number of SKUs"""
+    now = now or datetime.utcnow()
+    start = analytics.period_start(now, 'day') - timedelta(days=history_days - 1)
+    stock, demand = daily_demand(session, start, history_days, vat_rate)
+    moving_average, level, deviation = forecast(demand)
+    on_hand, min_quantity = stock[:, 1], stock[:, 2]
+    safety_stock, reorder_point, quantity = suggest(on_hand, min_quantity, level, deviation, lead_time, cover)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_cover = np.where(level > 0, on_hand / level, np.nan)
+
+    rows = [{'accessory_id': int(accessory_id), 'daily_demand': float(rate), 'moving_average': float(average),
+             'safety_stock': float(safety), 'reorder_point': float(point), 'suggested_quantity': int(units),
+             'days_of_cover': None if np.isnan(days) else float(days), 'computed_at': now}
+            for accessory_id, rate, average, safety, point, units, days in zip(
+                stock[:, 0], level, moving_average, safety_stock, reorder_point, quantity, days_of_cover)]
+    session.execute(text('DELETE FROM reorder_suggestion'))
+    if rows:
+        session.execute(text(
+            'INSERT INTO reorder_suggestion (accessory_id, daily_demand, moving_average, safety_stock, '
+            'reorder_point, suggested_quantity, days_of_cover, computed_at) '
+            'VALUES (:accessory_id, :daily_demand, :moving_average, :safety_stock, :reorder_point, '
+            ':suggested_quantity, :days_of_cover, :computed_at)'
+        ).bindparams(bindparam('computed_at', type_=DateTime)), rows)
+    session.commit()
+    return len(rows)
+
+
+def last_refresh(session):
+    """When suggestions were last computed, or None"""
+    value = session.execute(text('SELECT MAX(computed_at) FROM reorder_suggestion')).scalar()
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
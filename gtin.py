@@ -0,0 +1,48 @@
+"""EAN/UPC (GTIN) barcodes for accessories.
+
+Every accessory gets a shop SKU printed on its labels: an EAN-13 in the 20-29
+prefix range GS1 reserves for in-store numbering, built from the accessory id
+so it is unique without a lookup. Accessories that already carry a
+manufacturer's EAN-13, EAN-8 or UPC-A can have that code recorded as well, and
+a scan of either code finds the accessory.
+"""
+GTIN_LENGTHS = (8, 12, 13)
+SKU_PREFIX = '20'  # GS1 "restricted circulation" range, never assigned to manufacturers
+SKU_LENGTH = 13
+
+SEPARATORS = str.maketrans('', '', ' -')
+
+
+def normalize(code):
+    return (code or '').strip().translate(SEPARATORS)
+
+
+def check_digit(digits):
+    """GTIN check digit of ``digits`` (the code without its last digit)"""
+    total = sum((3 if position % 2 == 0 else 1) * (ord(char) - 48)
+                for position, char in enumerate(reversed(digits)))
+    return str(-total % 10)
+
+
+def is_gtin(code):
+    return len(code) in GTIN_LENGTHS and code.isdigit() and check_digit(code[:-1]) == code[-1]
+
+
+def check(code):
+    """Normalized manufacturer code and an error message (None when it can be stored; empty is allowed)"""
+    code = normalize(code)
+    if not code:
+        return None, None
+    if not code.isdigit() or len(code) not in GTIN_LENGTHS:
+        return code, 'رمز EAN يجب أن يتكون من 8 أو 12 أو 13 رقماً'
+    if not is_gtin(code):
+        return code, 'رمز EAN غير صحيح (خانة التحقق لا تطابق)'
+    if code.startswith(SKU_PREFIX) and len(code) == SKU_LENGTH:
+        return code, 'هذا الرمز من رموز المحل الداخلية وليس رمز الشركة المصنعة'
+    return code, None
+
+
+def sku_for(accessory_id):
+    """Shop EAN-13 of an accessory"""
+    digits = f'{SKU_PREFIX}{accessory_id:0{SKU_LENGTH - len(SKU_PREFIX) - 1}d}'
+    return digits + check_digit(digits)
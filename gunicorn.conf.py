@@ -0,0 +1,34 @@
+"""Gunicorn settings: ``gunicorn -c gunicorn.conf.py``
+
+The app is loaded once in the master (preload_app), which also creates/upgrades
+the database and seeds it, and workers are forked from it. They share the
+master's imported code and templates copy-on-write instead of each importing
+the app again. SQLite connections must not cross a fork, so each worker drops
+the pool it inherited; the job dispatcher, audit writer and response cache
+connection are per-process already and start on first use.
+
+Workers are threaded: an open dashboard keeps a Server-Sent Events connection
+(see live_updates.py) that mostly sits idle, and with sync workers each one
+would take a whole worker away from the tills.
+"""
+import multiprocessing
+import os
+
+wsgi_app = 'app:init_app()'
+preload_app = True
+
+bind = os.environ.get('BIND', '0.0.0.0:5001')
+# SQLite has a single writer, so more workers mostly add memory
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+worker_class = 'gthread'
+# Per worker: open dashboards plus concurrent requests
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+timeout = 60
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    from app import app, db
+    with app.app_context():
+        # close=False: the parent's connections belong to the parent, just forget them here
+        db.engine.dispose(close=False)
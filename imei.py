@@ -0,0 +1,116 @@
+"""IMEI validation and the in-memory TAC index used on phone intake.
+
+An IMEI is 15 digits: the first 8 are the Type Allocation Code (TAC), which
+identifies the make and model, and the last is a Luhn check digit. Serial
+numbers that are all digits are treated as IMEIs and must pass the check;
+anything else (Wi-Fi tablets, accessories with a maker's serial) is accepted
+as a free-form serial.
+
+TacIndex holds the TAC -> phone type table as one sorted ``array('Q')`` of
+``tac << 32 | phone_type_id`` (8 bytes per TAC, looked up with bisect), so a
+scanned IMEI resolves to a brand/model without touching the database.
+"""
+import bisect
+import threading
+import time
+from array import array
+
+IMEI_LENGTH = 15
+TAC_LENGTH = 8
+_ID_BITS = 32
+_ID_MASK = (1 << _ID_BITS) - 1
+
+SEPARATORS = str.maketrans('', '', ' -/.')
+
+
+def normalize(serial):
+    """Serial number as stored: separators removed, letters upper-cased"""
+    return (serial or '').strip().translate(SEPARATORS).upper()
+
+
+def luhn_valid(digits):
+    total = 0
+    for position, char in enumerate(reversed(digits)):
+        digit = ord(char) - 48
+        if position % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def is_imei(serial):
+    return len(serial) == IMEI_LENGTH and serial.isdigit() and luhn_valid(serial)
+
+
+def check(serial):
+    """Normalized serial and an error message (None when it can be stored)"""
+    serial = normalize(serial)
+    if not serial:
+        return serial, 'يرجى إدخال الرقم التسلسلي'
+    if serial.isdigit():
+        if len(serial) != IMEI_LENGTH:
+            return serial, f'رقم IMEI يجب أن يتكون من {IMEI_LENGTH} رقماً'
+        if not luhn_valid(serial):
+            return serial, 'رقم IMEI غير صحيح (خانة التحقق لا تطابق)'
+    return serial, None
+
+
+def tac(serial):
+    """TAC of a valid IMEI, else None"""
+    return serial[:TAC_LENGTH] if is_imei(serial) else None
+
+
+class TacIndex:
+    """Per-process TAC -> (phone type id, brand, model) table"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl  # seconds before rows added by other workers or imports are picked up
+        self._keys = array('Q')
+        self._types = {}  # phone type id -> (brand, model)
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self, tac_rows, type_rows):
+        """Replace the table from (tac, phone_type_id) and (id, brand, model) rows"""
+        keys = array('Q', sorted(int(code) << _ID_BITS | type_id for code, type_id in tac_rows))
+        types = {type_id: (brand, model) for type_id, brand, model in type_rows}
+        with self._lock:
+            self._keys, self._types = keys, types
+            self._loaded_at = time.monotonic()
+
+    def add(self, code, type_id, brand, model):
+        with self._lock:
+            self._types[type_id] = (brand, model)
+            key = int(code) << _ID_BITS
+            position = bisect.bisect_left(self._keys, key)
+            if position < len(self._keys) and self._keys[position] >> _ID_BITS == int(code):
+                self._keys[position] = key | type_id
+            else:
+                self._keys.insert(position, key | type_id)
+
+    def lookup(self, serial):
+        """(phone type id, brand, model) for the TAC of ``serial``, or None"""
+        code = tac(serial)
+        if code is None:
+            return None
+        keys = self._keys
+        position = bisect.bisect_left(keys, int(code) << _ID_BITS)
+        if position == len(keys) or keys[position] >> _ID_BITS != int(code):
+            return None
+        type_id = keys[position] & _ID_MASK
+        brand_model = self._types.get(type_id)
+        return (type_id,) + brand_model if brand_model else None
+
+    def __contains__(self, code):
+        keys = self._keys
+        position = bisect.bisect_left(keys, int(code) << _ID_BITS)
+        return position < len(keys) and keys[position] >> _ID_BITS == int(code)
+
+    def __len__(self):
+        return len(self._keys)
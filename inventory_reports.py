@@ -0,0 +1,140 @@
+"""Inventory aging: how long stock has been sitting and how much capital it ties up.
+
+Phones in stock and accessories with quantity on hand are bucketed by days in
+inventory (0-30, 31-60, 61-90, 90+) with one grouped query each, using
+conditional aggregation. For phones the query is answered entirely from the
+partial ix_phone_in_stock_age index, already ordered for the GROUP BY.
+"""
+import csv
+from datetime import datetime, timedelta
+from io import StringIO
+
+from sqlalchemy import text, bindparam, DateTime
+
+# (key, label, lowest age in days, highest age in days or None)
+AGING_BUCKETS = (
+    ('0_30', '0-30', 0, 30),
+    ('31_60', '31-60', 31, 60),
+    ('61_90', '61-90', 61, 90),
+    ('90_plus', '90+', 91, None),
+)
+AGE_DAYS = "CAST(julianday(:now) - julianday({column}) AS INTEGER)"
+
+
+def _bucket_columns(units_expr, capital_expr):
+    # Buckets compare date_added against precomputed cutoffs rather than computing
+    # each row's age, which keeps the scan cheap
+    columns = []
+    for key, _, low, high in AGING_BUCKETS:
+        conditions = []
+        if low > 0:
+            conditions.append(f'date_added <= :older_{key}')
+        if high is not None:
+            conditions.append(f'date_added > :newer_{key}')
+        condition = ' AND '.join(conditions)
+        columns.append(f'SUM(CASE WHEN {condition} THEN {units_expr} ELSE 0 END) AS units_{key}')
+        columns.append(f'SUM(CASE WHEN {condition} THEN {capital_expr} ELSE 0 END) AS capital_{key}')
+    return ',\n               '.join(columns)
+
+
+def _bucket_params(now):
+    params = [bindparam('now', now, type_=DateTime)]
+    for key, _, low, high in AGING_BUCKETS:
+        if low > 0:
+            params.append(bindparam(f'older_{key}', now - timedelta(days=low), type_=DateTime))
+        if high is not None:
+            params.append(bindparam(f'newer_{key}', now - timedelta(days=high + 1), type_=DateTime))
+    return params
+
+
+def phone_aging(session, now=None):
+    """Phones in stock per brand/model/condition, oldest stock lines first"""
+    query = text(f"""
+        SELECT brand, model, condition,
+               {_bucket_columns('1', 'purchase_price')},
+               COUNT(*) AS units,
+               SUM(purchase_price) AS capital,
+               SUM(selling_price) AS selling_value,
+               MIN(date_added) AS oldest,
+               julianday(:now) - AVG(julianday(date_added)) AS average_age
+        FROM phone
+        WHERE status = 'in_stock'
+        GROUP BY brand, model, condition
+        ORDER BY average_age DESC
+    """).bindparams(*_bucket_params(now or datetime.utcnow()))
+    return [dict(row._mapping) for row in session.execute(query)]
+
+
+def accessory_aging(session, now=None):
+    """Accessories with stock on hand per category"""
+    query = text(f"""
+        SELECT category,
+               {_bucket_columns('quantity_in_stock', 'quantity_in_stock * purchase_price')},
+               SUM(quantity_in_stock) AS units,
+               SUM(quantity_in_stock * purchase_price) AS capital,
+               SUM(quantity_in_stock * selling_price) AS selling_value,
+               MIN(date_added) AS oldest,
+               julianday(:now) - AVG(julianday(date_added)) AS average_age
+        FROM accessory
+        WHERE quantity_in_stock > 0
+        GROUP BY category
+        ORDER BY average_age DESC
+    """).bindparams(*_bucket_params(now or datetime.utcnow()))
+    return [dict(row._mapping) for row in session.execute(query)]
+
+
+def slow_movers(session, min_days=91, limit=100, now=None):
+    """Individual phones in stock for at least ``min_days`` days, oldest first"""
+    now = now or datetime.utcnow()
+    query = text(f"""
+        SELECT id, phone_number, serial_number, brand, model, condition, purchase_price, selling_price,
+               date_added, {AGE_DAYS.format(column='date_added')} AS age_days
+        FROM phone
+        WHERE status = 'in_stock' AND date_added <= :cutoff
+        ORDER BY date_added
+        LIMIT :limit
+    """).bindparams(bindparam('now', now, type_=DateTime),
+                    bindparam('cutoff', now - timedelta(days=min_days), type_=DateTime))
+    return [dict(row._mapping) for row in session.execute(query, {'limit': limit})]
+
+
+def totals(rows):
+    """Sum the bucket and total columns of an aging report"""
+    summary = {'units': 0, 'capital': 0.0, 'selling_value': 0.0}
+    for key, _, _, _ in AGING_BUCKETS:
+        summary[f'units_{key}'] = 0
+        summary[f'capital_{key}'] = 0.0
+    for row in rows:
+        for column in summary:
+            summary[column] += row[column] or 0
+    return summary
+
+
+def aging_csv(phone_rows, accessory_rows):
+    """CSV export of both aging tables (UTF-8 with BOM so Excel shows Arabic correctly)"""
+    output = StringIO()
+    output.write('\ufeff')
+    writer = csv.writer(output)
+    bucket_headers = []
+    for _, label, _, _ in AGING_BUCKETS:
+        bucket_headers += [f'units {label}', f'capital {label}']
+    writer.writerow(['type', 'brand/category', 'model', 'condition'] + bucket_headers +
+                    ['units', 'capital', 'selling_value', 'oldest', 'average_age_days'])
+    for row in phone_rows:
+        writer.writerow(['phone', row['brand'], row['model'], row['condition']] + _bucket_values(row) +
+                        _total_values(row))
+    for row in accessory_rows:
+        writer.writerow(['accessory', row['category'], '', ''] + _bucket_values(row) + _total_values(row))
+    return output.getvalue()
+
+
+def _bucket_values(row):
+    values = []
+    for key, _, _, _ in AGING_BUCKETS:
+        values += [row[f'units_{key}'], round(row[f'capital_{key}'] or 0, 2)]
+    return values
+
+
+def _total_values(row):
+    return [row['units'], round(row['capital'] or 0, 2), round(row['selling_value'] or 0, 2),
+            str(row['oldest'] or '')[:10], round(row['average_age'] or 0)]
@@ -0,0 +1,304 @@
+"""Background jobs for long-running reports, exports and rebuilds.
+
+Jobs are rows in the ``job`` table. Every web worker process runs one
+dispatcher thread (started on its first request) that claims queued jobs and
+executes them on a small thread pool inside an application context, so the
+request that submitted a job returns immediately. A job is claimed with an
+UPDATE guarded on its status, so two workers never run the same job.
+
+Handlers receive a JobContext to report progress, save a checkpoint and
+produce a result file. A job whose worker died stops sending heartbeats; it is
+queued again and its handler resumes from the last saved checkpoint.
+Cancellation sets a flag on the row that the handler sees at its next
+progress report. Periodic jobs are queued by the dispatcher when no job of
+their kind was created within the interval; the check and the insert are one
+statement, so several workers queue a due job only once.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, exists, literal
+from sqlalchemy.exc import OperationalError
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+POLL_INTERVAL = 2          # seconds between looks at the job table when idle
+HEARTBEAT_INTERVAL = 10    # seconds between heartbeats of running jobs
+STALE_AFTER = 60           # a running job without heartbeat for this long is requeued
+PROGRESS_INTERVAL = 1      # seconds between progress writes
+MAX_ATTEMPTS = 3
+RESULT_MAX_AGE_DAYS = 7
+
+
+class JobCancelled(Exception):
+    """Raised in a handler when its job has been cancelled"""
+
+
+class JobContext:
+    """What a running handler sees of its job"""
+
+    def __init__(self, runner, job):
+        self.runner = runner
+        self.id = job.id
+        self.params = json.loads(job.params or '{}')
+        self.checkpoint = json.loads(job.checkpoint) if job.checkpoint else None
+        self.attempt = job.attempts
+        self._last_saved = 0.0
+
+    def progress(self, done, total=None, message=None, checkpoint=None):
+        """Report progress and optionally the state to resume from; raises JobCancelled when cancelled"""
+        values = {'progress': min(done / total, 1.0) if total else done}
+        if message is not None:
+            values['message'] = message
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+            values['checkpoint'] = json.dumps(checkpoint)
+        now = time.monotonic()
+        if now - self._last_saved < PROGRESS_INTERVAL:
+            return
+        self._last_saved = now
+        if self.runner.save_progress(self.id, values):
+            raise JobCancelled()
+
+    def result_file(self, download_name, mimetype):
+        """Path to write the job's result to; it becomes downloadable once the job is done"""
+        folder = self.runner.app.config['JOB_RESULTS_DIR']
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f'{self.id}-{download_name}')
+        self.runner.update(self.id, result_path=path, result_name=download_name, result_mimetype=mimetype)
+        return path
+
+
+class JobRunner:
+    """Registry of job handlers plus the per-process dispatcher"""
+
+    def __init__(self, app, db, model):
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+        self.handlers = {}
+        self.schedules = {}
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = set()
+        self.worker_name = None
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_RESULTS_DIR', os.path.join(app.instance_path, 'job_results'))
+        app.before_request(self.ensure_started)
+        app.extensions['jobs'] = self
+
+    def job(self, kind, label):
+        """Register a handler: ``@runner.job('export', 'تصدير')`` on ``def handler(ctx)``"""
+        def register(handler):
+            self.handlers[kind] = (label, handler)
+            return handler
+        return register
+
+    def every(self, kind, seconds, params=None):
+        """Queue a ``kind`` job automatically every ``seconds`` while the app is running"""
+        self.schedules[kind] = (seconds, params or {})
+
+    def submit(self, kind, params=None, user_id=None):
+        """Queue a job and return its id"""
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job type: {kind}')
+        with self.db.engine.begin() as conn:
+            job_id = conn.execute(self.table.insert().values(
+                kind=kind, params=json.dumps(params or {}), status=STATUS_QUEUED, progress=0.0,
+                created_by=user_id, created_at=datetime.utcnow())).inserted_primary_key[0]
+        self.ensure_started()
+        self._wake.set()
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a queued job now, or ask a running one to stop at its next progress report"""
+        with self.db.engine.begin() as conn:
+            conn.execute(update(self.table).where(
+                self.table.c.id == job_id, self.table.c.status == STATUS_QUEUED).values(
+                status=STATUS_CANCELLED, finished_at=datetime.utcnow()))
+            conn.execute(update(self.table).where(
+                self.table.c.id == job_id, self.table.c.status == STATUS_RUNNING).values(cancel_requested=True))
+
+    def update(self, job_id, **values):
+        with self.db.engine.begin() as conn:
+            conn.execute(update(self.table).where(self.table.c.id == job_id).values(**values))
+
+    def save_progress(self, job_id, values):
+        """Write progress and heartbeat; returns True if the job has been cancelled"""
+        values['heartbeat_at'] = datetime.utcnow()
+        try:
+            with self.db.engine.begin() as conn:
+                conn.execute(update(self.table).where(self.table.c.id == job_id).values(**values))
+                return bool(conn.execute(select(self.table.c.cancel_requested).where(
+                    self.table.c.id == job_id)).scalar())
+        except OperationalError:
+            # Database busy with the handler's own write; the next report will get through
+            return False
+
+    # Dispatcher
+
+    def ensure_started(self):
+        """Start this process's dispatcher (after a fork the parent's thread does not exist)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._running = set()
+            self.worker_name = f'{socket.gethostname()}:{self._pid}'
+            self._executor = ThreadPoolExecutor(max_workers=self.app.config['JOB_WORKERS'],
+                                                thread_name_prefix='job')
+            threading.Thread(target=self._dispatch_loop, name='job-dispatcher', daemon=True).start()
+
+    def _dispatch_loop(self):
+        with self.app.app_context():
+            try:
+                self._purge_results()
+            except Exception:
+                self.app.logger.exception('Purging old job results failed')
+            last_heartbeat = 0.0
+            while True:
+                try:
+                    if time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                        self._heartbeat()
+                        self._requeue_stale()
+                        self._submit_due()
+                        last_heartbeat = time.monotonic()
+                    while len(self._running) < self.app.config['JOB_WORKERS']:
+                        job = self._claim()
+                        if job is None:
+                            break
+                        self._running.add(job.id)
+                        self._executor.submit(self._execute, job)
+                except OperationalError:
+                    pass  # database busy, try again on the next round
+                except Exception:
+                    # Without this thread no job or schedule would run again in this process
+                    self.app.logger.exception('Job dispatcher round failed')
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+
+    def _submit_due(self):
+        job_table = self.table
+        with self.db.engine.begin() as conn:
+            for kind, (seconds, params) in self.schedules.items():
+                now = datetime.utcnow()
+                recent = exists().where(job_table.c.kind == kind,
+                                        job_table.c.created_at > now - timedelta(seconds=seconds))
+                row = select(literal(kind), literal(json.dumps(params)), literal(STATUS_QUEUED), literal(0.0),
+                             literal(now)).where(~recent)
+                if conn.execute(job_table.insert().from_select(
+                        ['kind', 'params', 'status', 'progress', 'created_at'], row)).rowcount:
+                    self._wake.set()
+
+    def _claim(self):
+        job_table = self.table
+        with self.db.engine.begin() as conn:
+            candidates = conn.execute(select(job_table.c.id).where(
+                job_table.c.status == STATUS_QUEUED, job_table.c.kind.in_(list(self.handlers))).order_by(
+                job_table.c.id).limit(5)).scalars().all()
+            for job_id in candidates:
+                now = datetime.utcnow()
+                claimed = conn.execute(update(job_table).where(
+                    job_table.c.id == job_id, job_table.c.status == STATUS_QUEUED).values(
+                    status=STATUS_RUNNING, worker=self.worker_name, started_at=now, heartbeat_at=now,
+                    attempts=job_table.c.attempts + 1)).rowcount
+                if claimed:
+                    return conn.execute(select(job_table).where(job_table.c.id == job_id)).one()
+        return None
+
+    def _execute(self, job):
+        try:
+            with self.app.app_context():
+                context = JobContext(self, job)
+                label, handler = self.handlers[job.kind]
+                try:
+                    message = handler(context)
+                except JobCancelled:
+                    self.db.session.rollback()
+                    self.update(job.id, status=STATUS_CANCELLED, finished_at=datetime.utcnow(),
+                                message='تم الإلغاء')
+                except Exception as e:
+                    self.db.session.rollback()
+                    self.update(job.id, status=STATUS_FAILED, finished_at=datetime.utcnow(), error=str(e))
+                else:
+                    self.update(job.id, status=STATUS_DONE, progress=1.0, finished_at=datetime.utcnow(),
+                                message=message or 'تم')
+        finally:
+            self._running.discard(job.id)
+            self._wake.set()
+
+    def _heartbeat(self):
+        if not self._running:
+            return
+        with self.db.engine.begin() as conn:
+            conn.execute(update(self.table).where(self.table.c.id.in_(list(self._running))).values(
+                heartbeat_at=datetime.utcnow()))
+
+    def _requeue_stale(self):
+        """Queue again the jobs whose worker died, or fail them after MAX_ATTEMPTS"""
+        job_table = self.table
+        with self.db.engine.begin() as conn:
+            running = conn.execute(select(job_table.c.id, job_table.c.worker, job_table.c.heartbeat_at,
+                                          job_table.c.attempts, job_table.c.cancel_requested).where(
+                job_table.c.status == STATUS_RUNNING)).all()
+            stale_before = datetime.utcnow() - timedelta(seconds=STALE_AFTER)
+            for job in running:
+                if job.id in self._running:
+                    continue
+                if not (self._worker_gone(job.worker) or (job.heartbeat_at or stale_before) <= stale_before):
+                    continue
+                if job.cancel_requested:
+                    values = {'status': STATUS_CANCELLED, 'finished_at': datetime.utcnow(), 'message': 'تم الإلغاء'}
+                elif job.attempts < MAX_ATTEMPTS:
+                    values = {'status': STATUS_QUEUED, 'worker': None}
+                else:
+                    values = {'status': STATUS_FAILED, 'finished_at': datetime.utcnow(),
+                              'error': 'توقف العامل عدة مرات أثناء التنفيذ'}
+                conn.execute(update(job_table).where(
+                    job_table.c.id == job.id, job_table.c.status == STATUS_RUNNING).values(**values))
+
+    def _worker_gone(self, worker):
+        # A dead process on this host does not need to wait for STALE_AFTER
+        host, _, pid = (worker or '').rpartition(':')
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        if int(pid) == self._pid:
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            return False
+        return False
+
+    def _purge_results(self):
+        job_table = self.table
+        cutoff = datetime.utcnow() - timedelta(days=RESULT_MAX_AGE_DAYS)
+        with self.db.engine.begin() as conn:
+            old = conn.execute(select(job_table.c.id, job_table.c.result_path).where(
+                job_table.c.status.in_(FINISHED_STATUSES), job_table.c.finished_at < cutoff,
+                job_table.c.result_path.isnot(None))).all()
+            for job in old:
+                if os.path.exists(job.result_path):
+                    os.remove(job.result_path)
+            if old:
+                conn.execute(update(job_table).where(job_table.c.id.in_([job.id for job in old])).values(
+                    result_path=None))
+
+    def recent(self, limit=50):
+        """Latest jobs, newest first"""
+        return self.db.session.execute(select(self.table).order_by(self.table.c.id.desc()).limit(limit)).all()
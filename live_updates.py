@@ -0,0 +1,212 @@
+"""Live dashboard updates pushed to browsers as Server-Sent Events.
+
+Every commit that changes the dashboard totals (a sale, phones taken into or
+out of stock) stores one small event in the same transaction: the deltas of
+the affected totals, built by the app's collector from the objects the commit
+flushed. Because the event commits with the data, a dashboard rendered in one
+read transaction can embed the id of the newest event it already includes and
+the browser continues the stream from there, so no change is missed or
+counted twice. Changes that are not expressed as deltas (bulk statements,
+cancelled sales) send a ``reload`` event instead.
+
+Each process has one thread that, while it has clients, polls the table for
+new ids every POLL_INTERVAL seconds and fans the events out from memory; a
+connected client costs an idle thread waiting on a condition, plus a comment
+line every KEEPALIVE seconds to keep proxies from closing the connection.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, scoped_session
+
+PENDING = 'live_updates_pending'
+WRITTEN = 'live_updates_written'
+
+DELTA = 'delta'
+RELOAD = 'reload'
+
+POLL_INTERVAL = 1.0    # seconds between checks for events committed by other processes
+KEEPALIVE = 15         # seconds between comment lines on an idle stream
+STREAM_SECONDS = 3600  # a stream then ends and the browser reconnects where it left off
+RETRY_MS = 3000        # browser reconnect delay
+BUFFER_SIZE = 500      # recent events held in memory per process
+KEEP_EVENTS = 5000     # rows kept in the table for clients reconnecting later
+PRUNE_EVERY = 100      # events between deletions of older rows
+
+
+class LiveUpdates:
+    """Per-commit delta events and the per-process fan-out to SSE clients"""
+
+    def __init__(self, app, db, model, collector):
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+        # (action, obj) -> dict of deltas, RELOAD, or None for objects that do not affect the totals
+        self.collector = collector
+        self._buffer = deque(maxlen=BUFFER_SIZE)  # (id, kind, data) newest last
+        self._position = 0  # id of the newest event read by this process
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        self._subscribers = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'before_commit', self._before_commit)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_soft_rollback)
+        app.extensions['live_updates'] = self
+
+    # Capture
+
+    def _after_flush(self, session, flush_context):
+        changes = []
+        for action, objects in (('create', session.new), ('update', session.dirty), ('delete', session.deleted)):
+            for obj in objects:
+                change = self.collector(action, obj)
+                if change:
+                    changes.append(change)
+        if changes:
+            # Tagged with their savepoint, so rolling it back drops them
+            session.info.setdefault(PENDING, []).append((session.get_nested_transaction(), changes))
+
+    def mark_reload(self, session):
+        """Make dashboards reload when the current transaction of ``session`` commits (bulk statements)"""
+        if isinstance(session, scoped_session):
+            session = session()
+        session.info.setdefault(PENDING, []).append((session.get_nested_transaction(), [RELOAD]))
+
+    def _before_commit(self, session):
+        if session.in_nested_transaction():
+            return  # releasing a savepoint; the outer commit writes the event
+        # The commit's own flush runs after this hook: flush now so its changes are in the event
+        session.flush()
+        pending = session.info.pop(PENDING, None)
+        if not pending:
+            return
+        changes = [change for _, group in pending for change in group]
+        kind, data = (RELOAD, {}) if RELOAD in changes else (DELTA, merge(changes))
+        event_id = session.execute(self.table.insert().values(
+            created_at=datetime.utcnow(), kind=kind, data=json.dumps(data, ensure_ascii=False, default=str)
+        )).inserted_primary_key[0]
+        if event_id % PRUNE_EVERY == 0:
+            session.execute(self.table.delete().where(self.table.c.id <= event_id - KEEP_EVENTS))
+        session.info[WRITTEN] = True
+
+    def _after_commit(self, session):
+        if session.info.pop(WRITTEN, False):
+            self._wake.set()  # clients on this process hear of it without waiting for the poll
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop(PENDING, None)
+            session.info.pop(WRITTEN, None)
+        elif session.info.get(PENDING):
+            session.info[PENDING] = [(savepoint, changes) for savepoint, changes in session.info[PENDING]
+                                     if savepoint is not previous_transaction]
+
+    def last_id(self, session):
+        """Id of the newest event visible to ``session`` (embed it in the page the stream continues)"""
+        return session.execute(select(func.max(self.table.c.id))).scalar() or 0
+
+    # Fan-out
+
+    def _read_after(self, after_id, limit):
+        table = self.table
+        with self.app.app_context(), self.db.engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(
+                select(table.c.id, table.c.kind, table.c.data).where(table.c.id > after_id)
+                .order_by(table.c.id).limit(limit))]
+
+    def _ensure_polling(self):
+        # One poller per process; after a fork the parent's thread does not exist
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                with self.app.app_context():
+                    self._position = self.last_id(self.db.session)
+                    self.db.session.remove()
+                self._buffer.clear()
+                self._pid = os.getpid()
+                threading.Thread(target=self._poll_loop, name='live-updates', daemon=True).start()
+
+    def _poll_loop(self):
+        while True:
+            self._wake.wait(POLL_INTERVAL)
+            self._wake.clear()
+            if not self._subscribers:
+                continue
+            try:
+                rows = self._read_after(self._position, BUFFER_SIZE)
+            except OperationalError:
+                continue  # database busy, next poll
+            if rows:
+                with self._condition:
+                    self._buffer.extend(rows)
+                    self._position = rows[-1][0]
+                    self._condition.notify_all()
+                if len(rows) == BUFFER_SIZE:
+                    self._wake.set()
+
+    def stream(self, after_id=None):
+        """SSE body for one client: events after ``after_id`` (default: from now on)"""
+        self._ensure_polling()
+        with self._condition:
+            self._subscribers += 1
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            with self._condition:
+                last = self._position if after_id is None else after_id
+                buffered = last >= self._position or (self._buffer and self._buffer[0][0] <= last + 1)
+            if not buffered:
+                # Older than this process's buffer: catch up from the table
+                backlog = self._read_after(last, BUFFER_SIZE + 1)
+                if len(backlog) > BUFFER_SIZE or (backlog and backlog[0][0] != last + 1):
+                    yield format_event(None, RELOAD, '{}')  # too far behind, or pruned
+                    return
+                for event_id, kind, data in backlog:
+                    yield format_event(event_id, kind, data)
+                    last = event_id
+            deadline = time.monotonic() + STREAM_SECONDS
+            while time.monotonic() < deadline:
+                with self._condition:
+                    if not (self._buffer and self._buffer[-1][0] > last):
+                        self._condition.wait(KEEPALIVE)
+                    if self._buffer and self._buffer[0][0] > last + 1:
+                        events = None  # fell out of the buffer while this client was not reading
+                    else:
+                        events = [entry for entry in self._buffer if entry[0] > last]
+                if events is None:
+                    yield format_event(None, RELOAD, '{}')
+                    return
+                if not events:
+                    yield ': keepalive\n\n'
+                for event_id, kind, data in events:
+                    yield format_event(event_id, kind, data)
+                    last = event_id
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+
+
+def merge(changes):
+    """Sum numeric deltas and concatenate lists"""
+    merged = {}
+    for change in changes:
+        for key, value in change.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def format_event(event_id, kind, data):
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {kind}\ndata: {data}\n\n'
@@ -0,0 +1,174 @@
+"""Database housekeeping and barcode image cleanup, for ``flask maintenance``.
+
+Everything here runs against the live files while the shop is open. Each step
+is its own short transaction on a connection that waits for the till's
+writes (busy timeout) instead of failing:
+
+- ``optimize`` refreshes the query planner's statistics. ANALYZE is bounded
+  by ``analysis_limit`` (rows sampled per index), so it takes a moment even
+  on large tables; later runs use ``PRAGMA optimize``, which only
+  re-analyzes tables whose statistics have gone stale.
+- ``vacuum`` returns free pages to the file system a few at a time with
+  ``incremental_vacuum``, then truncates the WAL file. That needs
+  ``auto_vacuum=INCREMENTAL``, which an existing database only gets from one
+  full VACUUM: that run rewrites the file and blocks writers while it does.
+- ``check`` runs ``integrity_check`` inside a read transaction, which in WAL
+  mode sees a fixed snapshot and does not block writers.
+
+Barcode PNGs are named after the phone number (phones) or SKU (accessories)
+they encode. Images matching neither, and older than an hour, are orphans.
+The directory listing is stat'ed and phone image paths are checked on a
+thread pool, since on slow disks most of the time is spent waiting for the
+file system.
+"""
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ANALYSIS_LIMIT = 1000  # rows ANALYZE samples per index
+VACUUM_STEP_PAGES = 256
+VACUUM_STEP_SLEEP = 0.05  # seconds to yield to writers between steps
+BUSY_TIMEOUT = 30
+SCAN_WORKERS = 8
+SCAN_CHUNK = 256
+ORPHAN_GRACE = 3600  # seconds a new image may wait for its phone to be saved
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def connect(path):
+    # Autocommit: every statement (or explicit BEGIN ... COMMIT) is its own short transaction
+    return sqlite3.connect(path, isolation_level=None, timeout=BUSY_TIMEOUT)
+
+
+def file_size(path):
+    """Bytes used by a database, its WAL and shared-memory files"""
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal', '-shm') if os.path.exists(path + suffix))
+
+
+def page_counts(connection):
+    """(page size, pages, free pages) of a database"""
+    return tuple(connection.execute(f'PRAGMA {pragma}').fetchone()[0]
+                 for pragma in ('page_size', 'page_count', 'freelist_count'))
+
+
+def optimize(path, analysis_limit=ANALYSIS_LIMIT):
+    """Refresh the planner statistics; returns a summary"""
+    connection = connect(path)
+    try:
+        connection.execute(f'PRAGMA analysis_limit={int(analysis_limit)}')
+        analyzed = connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'").fetchone()[0]
+        if analyzed:
+            connection.execute('PRAGMA optimize')
+        else:
+            connection.execute('ANALYZE')
+        indexes = connection.execute('SELECT COUNT(DISTINCT idx) FROM sqlite_stat1').fetchone()[0]
+    finally:
+        connection.close()
+    return {'mode': 'optimize' if analyzed else 'analyze', 'indexes': indexes}
+
+
+def vacuum(path, convert=False, pages=VACUUM_STEP_PAGES, sleep=VACUUM_STEP_SLEEP, progress=None):
+    """Give free pages back to the file system; returns the bytes reclaimed and the free pages left.
+
+    Without incremental auto-vacuum nothing can be freed step by step; with
+    ``convert`` the database is switched to it by one full, blocking VACUUM.
+    """
+    connection = connect(path)
+    try:
+        # Measured with an empty WAL at both ends, so only the pages given back count
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        before = file_size(path)
+        mode = connection.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if mode != AUTO_VACUUM_INCREMENTAL:
+            if not convert:
+                _, _, free = page_counts(connection)
+                return {'reclaimed': 0, 'free_pages': free, 'incremental': False}
+            connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            connection.execute('VACUUM')
+        while True:
+            _, _, free = page_counts(connection)
+            if not free:
+                break
+            # execute() would step the pragma once, freeing a single page; executescript runs it to the end
+            connection.executescript(f'BEGIN IMMEDIATE; PRAGMA incremental_vacuum({int(pages)}); COMMIT;')
+            if progress:
+                progress(free)
+            time.sleep(sleep)
+        # The pages left the database file; the WAL still holds their last copies until truncated
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+        _, _, free = page_counts(connection)
+    finally:
+        connection.close()
+    return {'reclaimed': before - file_size(path), 'free_pages': free, 'incremental': True}
+
+
+def check(path, quick=False, foreign_keys=True):
+    """Integrity and foreign key problems of a database, with its free space; empty lists mean none"""
+    connection = connect(path)
+    try:
+        connection.execute('BEGIN')
+        problems = [row[0] for row in connection.execute('PRAGMA quick_check' if quick else 'PRAGMA integrity_check')]
+        # SQLite does not enforce the models' foreign keys, so rows can point at deleted parents
+        orphans = {}
+        for table, _, parent, _ in connection.execute('PRAGMA foreign_key_check') if foreign_keys else ():
+            orphans[(table, parent)] = orphans.get((table, parent), 0) + 1
+        page_size, _, free = page_counts(connection)
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+    return {'problems': [] if problems == ['ok'] else problems,
+            'orphans': [(table, parent, count) for (table, parent), count in sorted(orphans.items())],
+            'free_bytes': page_size * free}
+
+
+def _stat_chunk(entries):
+    stats = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue  # removed since it was listed
+        stats.append((entry.name, stat.st_size, stat.st_mtime))
+    return stats
+
+
+def scan_barcodes(folder, workers=SCAN_WORKERS):
+    """{file name: (size, modified time)} of the PNG files in ``folder``"""
+    if not os.path.isdir(folder):
+        return {}
+    with os.scandir(folder) as listing:
+        entries = [entry for entry in listing if entry.name.endswith('.png') and entry.is_file()]
+    chunks = [entries[start:start + SCAN_CHUNK] for start in range(0, len(entries), SCAN_CHUNK)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return {name: (size, modified) for stats in pool.map(_stat_chunk, chunks) for name, size, modified in stats}
+
+
+def missing_files(paths, workers=SCAN_WORKERS):
+    """The ``paths`` (ids mapped to file paths) whose file does not exist"""
+    items = list(paths.items())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        exists = pool.map(os.path.exists, [path for _, path in items])
+        return {key: path for (key, path), found in zip(items, exists) if not found}
+
+
+def orphan_barcodes(files, names, grace=ORPHAN_GRACE, now=None):
+    """{name: size} of the ``files`` not in ``names`` and older than ``grace`` seconds"""
+    # A phone's image is written before its row commits: a new file may not have its phone yet
+    newest = (now or time.time()) - grace
+    return {name: size for name, (size, modified) in files.items() if name not in names and modified < newest}
+
+
+def remove_files(folder, names):
+    """Delete ``names`` from ``folder``; returns the bytes freed"""
+    freed = 0
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+    return freed
@@ -0,0 +1,85 @@
+"""Set-based price maintenance: bulk repricing and VAT-inclusive selling prices.
+
+Selling prices with VAT are derived from the VAT-exclusive ones. Both operations
+here are one UPDATE statement each instead of a Python loop over rows:
+repricing the phones in stock or accessories matching a filter by a percentage
+or a fixed amount, and re-deriving selling_price_with_vat for everything still
+for sale after VAT_RATE changes. Purchase prices with VAT are left alone (they
+record the VAT paid at purchase), as are the prices of sold phones.
+"""
+from sqlalchemy import text
+
+MODES = ('percent', 'amount')
+
+# target -> table, columns it can be filtered on, rows repricing applies to,
+# rows whose VAT-inclusive price follows the VAT rate
+TARGETS = {
+    'phone': {'table': 'phone', 'label': "brand || ' ' || model || ' - ' || phone_number",
+              'filters': ('brand', 'model', 'condition'),
+              # inline literal so SQLite can use the partial ix_phone_in_stock index
+              'scope': "status = 'in_stock'",
+              'vat_scope': "status IN ('in_stock', 'reserved')"},
+    'accessory': {'table': 'accessory', 'label': 'name', 'filters': ('category',),
+                  'scope': '1 = 1', 'vat_scope': '1 = 1'},
+}
+
+
+def _where(target, filters):
+    spec = TARGETS[target]
+    clauses, params = [spec['scope']], {}
+    for column in spec['filters']:
+        value = (filters.get(column) or '').strip()
+        if value:
+            clauses.append(f'{column} = :{column}')
+            params[column] = value
+    return ' AND '.join(clauses), params
+
+
+def _new_price(mode):
+    if mode == 'percent':
+        expression = 'selling_price * (1 + :value / 100.0)'
+    elif mode == 'amount':
+        expression = 'selling_price + :value'
+    else:
+        raise ValueError(f'Unknown repricing mode: {mode}')
+    return f'ROUND(MAX({expression}, 0), 2)'
+
+
+def preview(session, target, filters, mode, value, vat_rate, sample=20):
+    """Number of rows a repricing would change, totals before/after and the first rows"""
+    spec = TARGETS[target]
+    where, params = _where(target, filters)
+    params.update(value=value, rate=vat_rate)
+    new_price = _new_price(mode)
+    count, current_total, new_total = session.execute(text(
+        f'SELECT COUNT(*), COALESCE(SUM(selling_price), 0), COALESCE(SUM({new_price}), 0) '
+        f'FROM {spec["table"]} WHERE {where}'), params).one()
+    rows = session.execute(text(
+        f'SELECT id, {spec["label"]} AS label, selling_price, selling_price_with_vat, {new_price} AS new_price, '
+        f'ROUND({new_price} * (1 + :rate), 2) AS new_price_with_vat '
+        f'FROM {spec["table"]} WHERE {where} ORDER BY id LIMIT :sample'), {**params, 'sample': sample}).all()
+    return {'count': count, 'current_total': current_total, 'new_total': new_total, 'rows': rows}
+
+
+def apply(session, target, filters, mode, value, vat_rate):
+    """Reprice every matching row in one UPDATE; returns the number of rows (the caller commits)"""
+    spec = TARGETS[target]
+    where, params = _where(target, filters)
+    params.update(value=value, rate=vat_rate)
+    new_price = _new_price(mode)
+    # SET expressions all read the old selling_price
+    return session.execute(text(
+        f'UPDATE {spec["table"]} SET selling_price = {new_price}, '
+        f'selling_price_with_vat = ROUND({new_price} * (1 + :rate), 2) WHERE {where}'), params).rowcount
+
+
+def sync_vat_prices(session, vat_rate):
+    """Re-derive selling_price_with_vat where it does not match the VAT rate; returns rows changed per target"""
+    changed = {}
+    for target, spec in TARGETS.items():
+        # Rows already within rounding of the rate are left untouched, so this is a no-op on every start
+        changed[target] = session.execute(text(
+            f'UPDATE {spec["table"]} SET selling_price_with_vat = ROUND(selling_price * (1 + :rate), 2) '
+            f'WHERE {spec["vat_scope"]} AND ABS(selling_price_with_vat - selling_price * (1 + :rate)) > 0.005'),
+            {'rate': vat_rate}).rowcount
+    return changed
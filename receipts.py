@@ -0,0 +1,312 @@
+"""ESC/POS receipts for 80mm thermal printers, rendered on the server.
+
+A sale is turned into the raw bytes the printer consumes, so the same sale
+always produces the same bytes (no print date, no randomness) and the output
+can be compared byte for byte without a printer attached.
+
+Arabic is printed in the printer's PC864 code page, which holds the Arabic
+presentation forms rather than plain letters. Text is therefore shaped here
+(each letter replaced by its isolated/initial/medial/final form, lam-alef
+ligatures joined) and reordered into visual left-to-right order, keeping
+numbers and Latin words such as model names in their reading order.
+
+The header (logo raster plus company name, VAT number, address and phone) is
+the same on every receipt of a company, so it is built once and cached per
+company and logo file. The ZATCA simplified-invoice QR code (base64 TLV of
+seller, VAT number, time, total and VAT) is drawn by the printer's own QR
+command, so no image is generated for it.
+"""
+import base64
+import os
+from functools import lru_cache
+
+LINE_WIDTH = 48      # characters per line, font A on 80mm paper
+RASTER_WIDTH = 576   # printable dots per line on 80mm paper at 203 dpi
+CODE_PAGE = 37       # ESC t number of PC864; some printers use 22 or 28
+QR_MODULE_SIZE = 5
+TLV_MAX_LENGTH = 255  # a TLV length is one byte
+
+ESC = b'\x1b'
+GS = b'\x1d'
+INIT = ESC + b'@'
+ALIGN_LEFT, ALIGN_CENTER, ALIGN_RIGHT = 0, 1, 2
+CUT = GS + b'V\x42\x03'  # feed 3 lines and partial cut
+
+# Letter -> (first presentation form, dual-joining). Dual-joining letters have
+# isolated, final, initial and medial forms at +0..+3; the others only +0, +1.
+ARABIC_FORMS = {
+    'ء': (0xFE80, False), 'آ': (0xFE81, False), 'أ': (0xFE83, False),
+    'ؤ': (0xFE85, False), 'إ': (0xFE87, False), 'ئ': (0xFE89, True),
+    'ا': (0xFE8D, False), 'ب': (0xFE8F, True), 'ة': (0xFE93, False),
+    'ت': (0xFE95, True), 'ث': (0xFE99, True), 'ج': (0xFE9D, True),
+    'ح': (0xFEA1, True), 'خ': (0xFEA5, True), 'د': (0xFEA9, False),
+    'ذ': (0xFEAB, False), 'ر': (0xFEAD, False), 'ز': (0xFEAF, False),
+    'س': (0xFEB1, True), 'ش': (0xFEB5, True), 'ص': (0xFEB9, True),
+    'ض': (0xFEBD, True), 'ط': (0xFEC1, True), 'ظ': (0xFEC5, True),
+    'ع': (0xFEC9, True), 'غ': (0xFECD, True), 'ف': (0xFED1, True),
+    'ق': (0xFED5, True), 'ك': (0xFED9, True), 'ل': (0xFEDD, True),
+    'م': (0xFEE1, True), 'ن': (0xFEE5, True), 'ه': (0xFEE9, True),
+    'و': (0xFEED, False), 'ى': (0xFEEF, False), 'ي': (0xFEF1, True),
+}
+NON_JOINING = {'ء'}
+TATWEEL = 'ـ'
+LAM = 'ل'
+LAM_ALEF = {'آ': 0xFEF5, 'أ': 0xFEF7, 'إ': 0xFEF9, 'ا': 0xFEFB}
+ISOLATED, FINAL, INITIAL, MEDIAL = range(4)
+# PC864 lacks some forms: these stand in for them
+SUBSTITUTES = {0xFE87: 0xFE8D, 0xFE88: 0xFE8E, 0xFE89: 0xFEEF, 0xFE8A: 0xFEF0, 0xFE86: 0xFE85,
+               0xFEF9: 0xFEFB, 0xFEFA: 0xFEFC}
+# Persian/Urdu letters typed for their Arabic counterparts, and characters PC864 has in another form
+NORMALIZE = str.maketrans({'ک': 'ك', 'ی': 'ي', '%': '٪'})
+MIRRORED = str.maketrans('()[]{}<>', ')(][}{><')
+
+
+def _encodable(code_point):
+    try:
+        chr(code_point).encode('cp864')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _glyph(base, form):
+    """Best PC864 presentation form for letter ``base`` in ``form``"""
+    # PC864 mostly has two shapes per letter: one joining the next letter, one that does not
+    candidates = [base + form, base + INITIAL] if form == MEDIAL else [base + form]
+    candidates.append(base)
+    for code_point in candidates:
+        code_point = SUBSTITUTES.get(code_point, code_point)
+        if _encodable(code_point):
+            return chr(code_point)
+    return '?'
+
+
+def shape(text):
+    """Replace Arabic letters by their contextual presentation forms (logical order kept)"""
+    # Diacritics are not printed; tatweel only stretches the join
+    letters = [char for char in text.translate(NORMALIZE) if not 'ً' <= char <= 'ْ']
+    shaped = []
+    i = 0
+    while i < len(letters):
+        char = letters[i]
+        if char not in ARABIC_FORMS:
+            shaped.append(char)
+            i += 1
+            continue
+        previous = letters[i - 1] if i else ''
+        joins_previous = (previous == TATWEEL or previous in ARABIC_FORMS and ARABIC_FORMS[previous][1])
+        if char == LAM and i + 1 < len(letters) and letters[i + 1] in LAM_ALEF:
+            shaped.append(_glyph(LAM_ALEF[letters[i + 1]], FINAL if joins_previous else ISOLATED))
+            i += 2
+            continue
+        base, dual = ARABIC_FORMS[char]
+        following = letters[i + 1] if i + 1 < len(letters) else ''
+        joins_next = dual and (following == TATWEEL or following in ARABIC_FORMS and following not in NON_JOINING)
+        joins_previous = joins_previous and char not in NON_JOINING
+        form = (MEDIAL if joins_next else FINAL) if joins_previous else (INITIAL if joins_next else ISOLATED)
+        shaped.append(_glyph(base, form if dual else min(form, FINAL)))
+        i += 1
+    return ''.join(shaped)
+
+
+NUMBER_AFFIXES = '%٪+-'
+
+
+def _direction(char):
+    if char in NUMBER_AFFIXES:
+        return None
+    if '؀' <= char <= 'ۿ' or 'ﹰ' <= char <= '﻿':
+        return 'R'
+    if char.isalnum():
+        return 'L'
+    return None
+
+
+def visual(text):
+    """Shaped text in left-to-right display order for a right-to-left line"""
+    shaped = shape(text)
+    directions = [_direction(char) for char in shaped]
+    resolved = []
+    for i, direction in enumerate(directions):
+        if direction is None:
+            before = next((d for d in reversed(directions[:i]) if d), None)
+            after = next((d for d in directions[i + 1:] if d), None)
+            # Neutrals between two left-to-right characters (spaces in "iPhone 15", the dot in 12.50)
+            # and signs next to a digit (15%, -50) stay with them
+            next_to_digit = shaped[i] in NUMBER_AFFIXES and (
+                i and shaped[i - 1].isdigit() or i + 1 < len(shaped) and shaped[i + 1].isdigit())
+            direction = 'L' if before == after == 'L' or next_to_digit else 'R'
+        resolved.append(direction)
+    runs = []
+    for char, direction in zip(shaped, resolved):
+        if runs and runs[-1][0] == direction:
+            runs[-1][1].append(char)
+        else:
+            runs.append((direction, [char]))
+    return ''.join(''.join(chars) if direction == 'L' else ''.join(reversed(chars)).translate(MIRRORED)
+                   for direction, chars in reversed(runs))
+
+
+def wrap(text, width=LINE_WIDTH):
+    """Split on spaces into lines of at most ``width`` characters (logical order)"""
+    lines, line = [], ''
+    for word in text.split():
+        while len(word) > width:
+            if line:
+                lines.append(line)
+                line = ''
+            lines.append(word[:width])
+            word = word[width:]
+        if line and len(line) + 1 + len(word) > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f'{line} {word}' if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+
+def encode(text):
+    return text.encode('cp864', errors='replace')
+
+
+def money(amount):
+    return f'{amount or 0:.2f}'
+
+
+class Receipt:
+    """Builder of ESC/POS bytes; Arabic text is shaped and right-aligned"""
+
+    def __init__(self, width=LINE_WIDTH, code_page=CODE_PAGE):
+        self.width = width
+        # Without a code page: a block to be embedded in a receipt
+        self.data = bytearray(INIT + ESC + b't' + bytes([code_page]) if code_page is not None else b'')
+
+    def raw(self, data):
+        self.data += data
+        return self
+
+    def align(self, alignment):
+        return self.raw(ESC + b'a' + bytes([alignment]))
+
+    def bold(self, on=True):
+        return self.raw(ESC + b'E' + bytes([1 if on else 0]))
+
+    def size(self, width=1, height=1):
+        return self.raw(GS + b'!' + bytes([(width - 1) << 4 | (height - 1)]))
+
+    def text(self, text, alignment=ALIGN_RIGHT, width=None):
+        """Paragraph wrapped to the line width; ``width`` is smaller for double-width text"""
+        self.align(alignment)
+        for line in wrap(text, width or self.width):
+            self.raw(encode(visual(line)) + b'\n')
+        return self
+
+    def row(self, label, value):
+        """Label on the right, value on the left edge"""
+        label, value = visual(label), visual(str(value))
+        space = max(self.width - len(label) - len(value), 1)
+        return self.align(ALIGN_LEFT).raw(encode(value + ' ' * space + label) + b'\n')
+
+    def rule(self, char='-'):
+        return self.align(ALIGN_LEFT).raw(encode(char * self.width) + b'\n')
+
+    def feed(self, lines=1):
+        return self.raw(ESC + b'd' + bytes([lines]))
+
+    def qr(self, payload, module_size=QR_MODULE_SIZE):
+        data = payload.encode('utf-8')
+        length = len(data) + 3
+        self.align(ALIGN_CENTER)
+        self.raw(GS + b'(k\x04\x001A2\x00')                           # model 2
+        self.raw(GS + b'(k\x03\x001C' + bytes([module_size]))         # module size in dots
+        self.raw(GS + b'(k\x03\x001E1')                               # error correction M
+        self.raw(GS + b'(k' + bytes([length & 0xFF, length >> 8]) + b'1P0' + data)
+        return self.raw(GS + b'(k\x03\x001Q0' + b'\n')
+
+    def cut(self):
+        return self.raw(CUT)
+
+    def output(self):
+        return bytes(self.data)
+
+
+def raster(path, max_width=RASTER_WIDTH):
+    """GS v 0 raster image of the picture at ``path``, scaled down to ``max_width`` dots and dithered"""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, 'white')
+        image = Image.alpha_composite(background, image).convert('L')
+        if image.width > max_width:
+            image = image.resize((max_width, round(image.height * max_width / image.width)), Image.LANCZOS)
+        image = image.convert('1')  # Floyd-Steinberg dithering
+    width_bytes = (image.width + 7) // 8
+    padded = Image.new('1', (width_bytes * 8, image.height), 1)
+    padded.paste(image, (0, 0))
+    # In mode 1 a set bit is white; the printer burns set bits
+    data = bytes(byte ^ 0xFF for byte in padded.tobytes())
+    return (GS + b'v0\x00' + bytes([width_bytes & 0xFF, width_bytes >> 8, image.height & 0xFF, image.height >> 8])
+            + data)
+
+
+@lru_cache(maxsize=16)
+def header_block(company_name, vat_number, address, phone, logo_path=None, logo_mtime=None, width=LINE_WIDTH):
+    """Logo and company details, built once per company (``logo_mtime`` is part of the cache key)"""
+    block = Receipt(width, code_page=None)
+    if logo_path:
+        block.align(ALIGN_CENTER).raw(raster(logo_path) + b'\n')
+    block.bold().size(2, 2).text(company_name, ALIGN_CENTER, width // 2).size().bold(False)
+    block.text(f'الرقم الضريبي: {vat_number}', ALIGN_CENTER)
+    block.text(address, ALIGN_CENTER)
+    block.text(f'هاتف: {phone}', ALIGN_CENTER)
+    return block.output()
+
+
+def zatca_qr(seller, vat_number, timestamp, total, vat_total):
+    """ZATCA simplified tax invoice QR payload: base64 of tag-length-value fields 1-5"""
+    fields = [seller, vat_number, timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'), money(total), money(vat_total)]
+    tlv = bytearray()
+    for tag, value in enumerate(fields, start=1):
+        # Cut on a character boundary: a long Arabic seller name must not split a letter's bytes
+        value = value.encode('utf-8')[:TLV_MAX_LENGTH].decode('utf-8', 'ignore').encode('utf-8')
+        tlv += bytes([tag, len(value)]) + value
+    return base64.b64encode(bytes(tlv)).decode('ascii')
+
+
+def render_sale(sale, items, logo_path=None, width=LINE_WIDTH, code_page=CODE_PAGE):
+    """ESC/POS bytes of a sale receipt; ``sale.date_created`` is UTC"""
+    logo_mtime = os.path.getmtime(logo_path) if logo_path and os.path.exists(logo_path) else None
+    receipt = Receipt(width, code_page)
+    receipt.raw(header_block(sale.company_name, sale.company_vat_number, sale.company_address,
+                             sale.company_phone, logo_path if logo_mtime else None, logo_mtime, width))
+    receipt.rule()
+    receipt.bold().text('فاتورة ضريبية مبسطة', ALIGN_CENTER).bold(False)
+    receipt.row('رقم الفاتورة:', sale.sale_number)
+    receipt.row('التاريخ:', sale.date_created.strftime('%Y-%m-%d %H:%M'))
+    receipt.row('طريقة الدفع:', sale.payment_method or '')
+    if sale.customer_name and sale.customer_name != 'عميل نقدي':
+        receipt.row('العميل:', sale.customer_name)
+    if sale.customer_phone:
+        receipt.row('الهاتف:', sale.customer_phone)
+    if sale.status and sale.status != 'مكتمل':
+        receipt.bold().text(f'الحالة: {sale.status}', ALIGN_CENTER).bold(False)
+    receipt.rule()
+    for item in items:
+        receipt.text(item.product_name)
+        if item.serial_number:
+            receipt.row('IMEI:', item.serial_number)
+        receipt.row(f'{item.quantity} × {money(item.unit_price)}', money(item.total_price))
+    receipt.rule()
+    receipt.row('المجموع قبل الضريبة:', money(sale.subtotal))
+    # The rate the sale was charged at, not today's
+    vat_rate = sale.vat_amount / sale.subtotal if sale.subtotal else 0
+    receipt.row(f'ضريبة القيمة المضافة ({vat_rate * 100:.0f}%):', money(sale.vat_amount))
+    receipt.bold().row('الإجمالي شامل الضريبة:', money(sale.total_amount)).bold(False)
+    receipt.rule()
+    receipt.qr(zatca_qr(sale.company_name, sale.company_vat_number, sale.date_created,
+                        sale.total_amount, sale.vat_amount))
+    receipt.text('شكراً لزيارتكم', ALIGN_CENTER)
+    return receipt.feed(2).cut().output()
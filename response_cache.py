@@ -0,0 +1,144 @@
+"""Response cache for read-heavy report pages, shared by all gunicorn workers.
+
+Rendered pages are stored in a small SQLite file next to the main database,
+keyed by endpoint and query string. Every entry also records the global data
+version it was rendered at; the version is bumped from SQLAlchemy session events
+whenever a commit touches one of the watched models, so stale pages are never
+served and nothing has to be invalidated by hand.
+"""
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+from itertools import chain
+from urllib.parse import urlencode
+
+from flask import request, session, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+DIRTY_FLAG = 'response_cache_dirty'
+
+
+class ResponseCache:
+    """Cross-worker page cache invalidated by a data version counter"""
+
+    def __init__(self, app=None, watched_models=(), timeout=300):
+        self.path = None
+        self.timeout = timeout
+        self.watched_models = tuple(watched_models)
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get('RESPONSE_CACHE_PATH') or os.path.join(app.instance_path, 'cache.db')
+        self.timeout = app.config.get('RESPONSE_CACHE_TIMEOUT', self.timeout)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS data_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    version INTEGER NOT NULL,
+                    changed_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    mimetype TEXT NOT NULL,
+                    body BLOB NOT NULL
+                );
+            """)
+            if 'changed_at' not in {row[1] for row in conn.execute('PRAGMA table_info(data_version)')}:
+                conn.execute('ALTER TABLE data_version ADD COLUMN changed_at REAL')
+                conn.execute('UPDATE data_version SET changed_at = ?', (time.time(),))
+            conn.execute('INSERT OR IGNORE INTO data_version (id, version, changed_at) VALUES (1, 0, ?)', (time.time(),))
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'after_commit', self._after_commit)
+        event.listen(Session, 'after_rollback', self._after_rollback)
+        app.extensions['response_cache'] = self
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # Data version
+    def data_version(self):
+        return self._connect().execute('SELECT version FROM data_version WHERE id = 1').fetchone()[0]
+
+    def version_info(self):
+        """(version, unix time it was last bumped) - for ETag/Last-Modified headers"""
+        return tuple(self._connect().execute('SELECT version, changed_at FROM data_version WHERE id = 1').fetchone())
+
+    def bump_version(self):
+        """Invalidate every cached page (call after bulk statements that bypass the ORM unit of work)"""
+        conn = self._connect()
+        conn.execute('UPDATE data_version SET version = version + 1, changed_at = ? WHERE id = 1', (time.time(),))
+        conn.execute('DELETE FROM response_cache WHERE version < (SELECT version FROM data_version WHERE id = 1)')
+
+    def mark_dirty(self, session):
+        """Bump the version when the current transaction of ``session`` commits"""
+        session.info[DIRTY_FLAG] = True
+
+    def _after_flush(self, session, flush_context):
+        if session.info.get(DIRTY_FLAG):
+            return
+        for obj in chain(session.new, session.dirty, session.deleted):
+            if isinstance(obj, self.watched_models):
+                session.info[DIRTY_FLAG] = True
+                return
+
+    def _after_commit(self, session):
+        if session.info.pop(DIRTY_FLAG, False):
+            self.bump_version()
+
+    def _after_rollback(self, session):
+        session.info.pop(DIRTY_FLAG, None)
+
+    # Entries
+    def get(self, key, version):
+        row = self._connect().execute(
+            'SELECT mimetype, body, created FROM response_cache WHERE key = ? AND version = ?',
+            (key, version)).fetchone()
+        if row is None or time.time() - row[2] > self.timeout:
+            return None
+        return row[0], row[1]
+
+    def set(self, key, version, mimetype, body):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO response_cache (key, version, created, mimetype, body) VALUES (?, ?, ?, ?, ?)',
+            (key, version, time.time(), mimetype, body))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM response_cache')
+
+    def cached(self, view):
+        """Serve a GET view from the cache while the data version is unchanged"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pages carrying flashed messages are one-off renders
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            key = f'{request.endpoint}?{urlencode(sorted(request.args.items(multi=True)))}'
+            version = self.data_version()
+            hit = self.get(key, version)
+            if hit is not None:
+                response = make_response(hit[1])
+                response.mimetype = hit[0]
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                self.set(key, version, response.mimetype, response.get_data())
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
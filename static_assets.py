@@ -0,0 +1,176 @@
+"""Self-hosted static assets and response compression.
+
+Third-party CSS/JS/fonts are vendored under ``static/vendor``. ``build_assets``
+copies them to ``static/dist`` with content-hashed file names (CSS ``url()``
+references are rewritten to the hashed names), writes gzip/brotli variants next
+to each text file and records the mapping in ``static/dist/manifest.json``.
+Hashed files are served from ``/assets`` with immutable cache headers, picking
+the precompressed variant the browser accepts. Large HTML/JSON responses are
+gzipped on the fly.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, send_file, url_for, abort
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli variants are skipped, gzip is always built
+    brotli = None
+
+VENDOR_DIR = 'vendor'
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.ttf', '.json')
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/csv',
+                          'application/json', 'application/javascript')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+CSS_URL_RE = re.compile(r'url\((["\']?)([^)"\']+)\1\)')
+SOURCE_MAP_RE = re.compile(r'\n?(/\*# sourceMappingURL=[^*]*\*/|//# sourceMappingURL=\S*)')
+
+
+def build_assets(static_folder):
+    """Build static/dist from static/vendor and return the manifest"""
+    vendor_root = os.path.join(static_folder, VENDOR_DIR)
+    dist_root = os.path.join(static_folder, DIST_DIR)
+    if os.path.isdir(dist_root):
+        shutil.rmtree(dist_root)
+
+    sources = []
+    for dirpath, _, filenames in os.walk(vendor_root):
+        for filename in sorted(filenames):
+            sources.append(os.path.relpath(os.path.join(dirpath, filename), static_folder).replace(os.sep, '/'))
+    # Stylesheets last, so the files they reference already have their hashed names
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    for source in sources:
+        with open(os.path.join(static_folder, source), 'rb') as f:
+            data = f.read()
+        if source.endswith(('.css', '.js')):
+            # Source maps are not vendored
+            data = SOURCE_MAP_RE.sub('', data.decode('utf-8')).encode('utf-8')
+        if source.endswith('.css'):
+            data = _rewrite_css_urls(source, data.decode('utf-8'), manifest).encode('utf-8')
+
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        stem, ext = os.path.splitext(source[len(VENDOR_DIR) + 1:])
+        target = f'{DIST_DIR}/{stem}.{digest}{ext}'
+        target_path = os.path.join(static_folder, target)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        with open(target_path, 'wb') as f:
+            f.write(data)
+        if ext in PRECOMPRESS_EXTENSIONS:
+            _write_compressed(target_path, data)
+        manifest[source] = target
+
+    with open(os.path.join(dist_root, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def _rewrite_css_urls(source, css, manifest):
+    base = os.path.dirname(source)
+
+    def replace(match):
+        quote, url = match.groups()
+        path, _, suffix = url.partition('?')
+        resolved = os.path.normpath(os.path.join(base, path)).replace(os.sep, '/')
+        if url.startswith(('data:', 'http:', 'https:', '/')) or resolved not in manifest:
+            return match.group(0)
+        # dist/ mirrors the vendor/ layout, so only the file name changes
+        hashed = os.path.join(os.path.dirname(path), os.path.basename(manifest[resolved])).replace(os.sep, '/')
+        return f'url({quote}{hashed}{"?" + suffix if suffix else ""}{quote})'
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def _write_compressed(path, data):
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gzipped) < len(data):
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzipped)
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            with open(path + '.br', 'wb') as f:
+                f.write(compressed)
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def init_app(app):
+    """Register the /assets route, the asset_url() template helper and response compression"""
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    state = {'manifest': load_manifest(app.static_folder)}
+
+    def asset_url(path):
+        """URL of a vendored file: hashed copy when built, plain static file otherwise"""
+        target = state['manifest'].get(path)
+        if target is None:
+            return url_for('static', filename=path)
+        return url_for('asset', filename=target[len(DIST_DIR) + 1:])
+
+    def asset(filename):
+        path = safe_join(os.path.join(app.static_folder, DIST_DIR), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        encoding = None
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in request.accept_encodings and os.path.isfile(path + suffix):
+                path, encoding = path + suffix, candidate
+                break
+        response = send_file(path, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE, conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def compress_response(response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        if 'gzip' not in request.accept_encodings:
+            return response
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    @app.cli.command('build-assets')
+    def build_assets_command():
+        """Hash and precompress the vendored static files."""
+        state['manifest'] = build_assets(app.static_folder)
+        print(f"Built {len(state['manifest'])} assets into static/{DIST_DIR}")
+
+    app.add_url_rule('/assets/<path:filename>', 'asset', asset)
+    app.add_template_global(asset_url)
+    app.after_request(compress_response)
+    app.extensions['static_assets'] = state
+
+
+def ensure_built(app):
+    """Build the hashed assets on first start if no manifest exists yet"""
+    state = app.extensions['static_assets']
+    if not state['manifest']:
+        state['manifest'] = build_assets(app.static_folder)
@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+# Before the app module is imported: it binds the database to the instance folder
+os.environ.setdefault('PHONE_SHOP_INSTANCE_PATH', tempfile.mkdtemp(prefix='phone-shop-tests-'))
+
+import pytest
+
+import app as phone_shop
+
+
+@pytest.fixture(scope='session')
+def app():
+    return phone_shop.init_app()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return client
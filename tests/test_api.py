@@ -0,0 +1,46 @@
+import pytest
+
+from app import db, Phone, Sale
+
+API_KEY = 'test-store-key'
+
+
+@pytest.fixture
+def store(app):
+    app.config['API_KEYS'] = [API_KEY]
+    client = app.test_client()
+    client.environ_base['HTTP_X_API_KEY'] = API_KEY
+    return client
+
+
+def phone(serial, status):
+    return Phone(brand='Apple', model='iPhone api', condition='used', purchase_price=1000, selling_price=1300,
+                 purchase_price_with_vat=1150, selling_price_with_vat=1495, serial_number=serial,
+                 phone_number=f'API-{serial}', status=status)
+
+
+def test_api_keys_cannot_read_costs_or_customer_details(app, store, client):
+    with app.app_context():
+        db.session.add_all([phone('API-1', 'in_stock'), phone('API-2', 'sold')])
+        sale = Sale(sale_number='API-SALE', customer_name='عميل', customer_phone='0500000000',
+                    subtotal=100, vat_amount=15, total_amount=115)
+        db.session.add(sale)
+        db.session.commit()
+        sale_id = sale.id
+
+    for url in ('/api/v1/phones?fields=id,purchase_price', '/api/v1/accessories?fields=id,supplier',
+                '/api/v1/sales?customer_phone=0500000000', f'/api/v1/sales/{sale_id}?fields=customer_name'):
+        assert store.get(url).status_code == 403
+
+    phones = store.get('/api/v1/phones?model=iPhone api').get_json()['data']
+    assert [row['phone_number'] for row in phones] == ['API-API-1']
+    assert 'serial_number' not in phones[0]
+    sold = store.get('/api/v1/phones?model=iPhone api&status=sold').get_json()['data']
+    assert [row['phone_number'] for row in sold] == ['API-API-2']
+    sale = store.get(f'/api/v1/sales/{sale_id}').get_json()
+    assert 'customer_name' not in sale and sale['total_amount'] == 115
+
+    # A signed-in user still sees everything
+    assert len(client.get('/api/v1/phones?model=iPhone api').get_json()['data']) == 2
+    assert client.get(f'/api/v1/sales/{sale_id}?fields=customer_name').get_json()['customer_name'] == 'عميل'
+    assert client.get('/api/v1/phones?fields=id,purchase_price').status_code == 200
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import app as phone_shop
+from app import db, Accessory, Sale, SaleItem, Transaction
+
+
+def accessory(name, purchase_price):
+    return Accessory(name=name, category='charger', purchase_price=purchase_price,
+                     purchase_price_with_vat=purchase_price * 1.15, selling_price=50, selling_price_with_vat=57.5,
+                     quantity_in_stock=5, min_quantity=1)
+
+
+def test_backfill_skips_deleted_phones_and_takes_accessory_cost_from_the_same_row(app):
+    bought = datetime.utcnow() - timedelta(days=30)
+    with app.app_context():
+        # A phone sold before sold phones were kept: its row was deleted, its buy transaction remains
+        db.session.add(Transaction(phone_id=999999, transaction_type='buy', serial_number='BACKFILL-IMEI',
+                                   price=700, price_with_vat=805, vat_amount=105, user_id=1, date_created=bought))
+        first, second = accessory('شاحن backfill', 20), accessory('شاحن backfill', 35)
+        db.session.add_all([first, second])
+        sale = Sale(sale_number='BACKFILL-1', customer_name='عميل نقدي', subtotal=800, vat_amount=120,
+                    total_amount=920, date_created=bought + timedelta(days=1))
+        phone_item = SaleItem(product_type='phone', product_name='هاتف', serial_number='BACKFILL-IMEI',
+                              unit_price=750, quantity=1, total_price=750)
+        accessory_item = SaleItem(product_type='charger', product_name='شاحن backfill', unit_price=50, quantity=1,
+                                  total_price=50)
+        sale.items.extend([phone_item, accessory_item])
+        db.session.add(sale)
+        db.session.commit()
+
+        phone_shop.backfill_sale_item_costs()
+        db.session.expire_all()
+
+        assert (phone_item.phone_id, phone_item.unit_cost) == (None, 700)
+        assert (accessory_item.accessory_id, accessory_item.unit_cost) == (first.id, 20)
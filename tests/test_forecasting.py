@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+import analytics
+import forecasting
+from app import db, Accessory, Sale, SaleItem, VAT_RATE
+
+
+def accessory(name):
+    return Accessory(name=name, category='case', purchase_price=10, purchase_price_with_vat=11.5, selling_price=20,
+                     selling_price_with_vat=23, quantity_in_stock=5, min_quantity=1)
+
+
+def sell(when, name, quantity, accessory_id=None):
+    sale = Sale(sale_number=f'FC-{accessory_id}-{when:%Y%m%d%H%M%S%f}', customer_name='عميل نقدي', subtotal=20 * quantity,
+                vat_amount=3 * quantity, total_amount=23 * quantity, date_created=when)
+    sale.items.append(SaleItem(product_type='case', product_name=name, accessory_id=accessory_id, unit_price=20,
+                               quantity=quantity, total_price=20 * quantity))
+    db.session.add(sale)
+    analytics.invalidate_periods(db.session, when)  # as record_sale does for back-dated sales
+
+
+def test_demand_follows_accessory_ids_across_renames_and_shared_names(app):
+    now = datetime.utcnow()
+    start = analytics.period_start(now, 'day') - timedelta(days=9)
+    with app.app_context():
+        renamed, first, second = accessory('غطاء جديد fc'), accessory('غطاء fc'), accessory('غطاء fc')
+        db.session.add_all([renamed, first, second])
+        db.session.flush()
+        sell(now - timedelta(days=3), 'غطاء قديم fc', 2, renamed.id)  # sold under its old name
+        sell(now - timedelta(days=2), 'غطاء fc', 3, second.id)
+        sell(now - timedelta(days=2), 'غطاء fc', 1)  # recorded before sale items kept the id
+        sell(now, 'غطاء fc', 4, second.id)
+        db.session.commit()
+
+        stock, demand = forecasting.daily_demand(db.session, start, 10, VAT_RATE)
+        totals = dict(zip(stock[:, 0].tolist(), demand.sum(axis=1).tolist()))
+        assert (totals[renamed.id], totals[first.id], totals[second.id]) == (2, 1, 7)
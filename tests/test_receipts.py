@@ -0,0 +1,24 @@
+import base64
+from datetime import datetime
+
+import receipts
+
+
+def tlv_fields(payload):
+    data = base64.b64decode(payload)
+    fields = {}
+    while data:
+        tag, length = data[0], data[1]
+        fields[tag] = data[2:2 + length].decode('utf-8')
+        data = data[2 + length:]
+    return fields
+
+
+def test_zatca_qr_cuts_long_arabic_seller_name_on_a_character_boundary():
+    seller = 'شركة الاتصالات المتقدمة لبيع الهواتف والإكسسوارات ' * 5
+    payload = receipts.zatca_qr(seller, '300000000000003', datetime(2026, 1, 2, 3, 4, 5), 1150, 150)
+    fields = tlv_fields(payload)
+    assert len(fields[1].encode('utf-8')) <= receipts.TLV_MAX_LENGTH
+    assert seller.startswith(fields[1]) and len(fields[1]) > 100
+    assert [fields[tag] for tag in (2, 3)] == ['300000000000003', '2026-01-02T03:04:05Z']
+    assert fields[4] == receipts.money(1150) and fields[5] == receipts.money(150)
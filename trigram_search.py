@@ -0,0 +1,302 @@
+"""Typo-tolerant search over phones, accessories and customers.
+
+Every searchable row has one document in the search_document table: the text
+of its searchable fields, written by session events in the transaction that
+changes the row (a delete or a phone leaving stock writes an empty
+tombstone). Document ids only grow, so each process keeps an in-memory
+trigram index and catches up by reading the documents with an id above the
+last one it applied.
+
+Text is indexed twice. The folded form (Arabic letter variants unified,
+Latin lower-cased) catches typos within one script: "iphon 15 pro". A
+phonetic skeleton catches a name written in the other script: Arabic letters
+are transliterated, Latin spellings folded the same way (ph/v -> f, p -> b,
+j -> g, x -> ks, ...) and vowels dropped, so "ايفون 15 برو" and "iPhone 15 Pro"
+both become "fn 15 br". Words are split into trigrams padded like pg_trgm.
+A document matches when it holds at least THRESHOLD of the query's trigrams
+in either form, ranked by that share, then by Dice similarity.
+"""
+import re
+import threading
+from array import array
+from functools import lru_cache
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+PENDING = 'trigram_search_pending'
+
+THRESHOLD = 0.5      # share of the query's trigrams a match must contain
+DEFAULT_LIMIT = 200
+SKELETON_MARK = '~'  # skeleton trigrams are kept apart from folded ones
+
+ARABIC_FOLD = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ة': 'ه', 'ى': 'ي', 'ؤ': 'و', 'ئ': 'ي', 'ک': 'ك', 'ی': 'ي',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+})
+DIACRITICS = re.compile('[ـً-ٰٟ]')
+WORDS = re.compile(r'\w+')
+
+TRANSLITERATION = str.maketrans({
+    'ا': 'a', 'ب': 'b', 'ت': 't', 'ث': 's', 'ج': 'g', 'ح': 'h', 'خ': 'k', 'د': 'd', 'ذ': 'z', 'ر': 'r',
+    'ز': 'z', 'س': 's', 'ش': 's', 'ص': 's', 'ض': 'd', 'ط': 't', 'ظ': 'z', 'ع': 'a', 'غ': 'g', 'ف': 'f',
+    'ق': 'k', 'ك': 'k', 'ل': 'l', 'م': 'm', 'ن': 'n', 'ه': 'h', 'و': 'w', 'ي': 'y', 'ء': None,
+})
+LATIN_SOUNDS = (('ph', 'f'), ('ck', 'k'), ('sh', 's'), ('x', 'ks'), ('q', 'k'), ('c', 'k'), ('v', 'f'),
+                ('p', 'b'), ('j', 'g'))
+VOWELS = re.compile('[aeiouwy]')
+REPEATS = re.compile(r'([a-z])\1+')  # letters only: serials keep their repeated digits
+
+
+def fold(text):
+    """Words of ``text`` with Arabic letter variants and diacritics unified, lower-cased"""
+    text = DIACRITICS.sub('', (text or '').translate(ARABIC_FOLD)).lower()
+    return WORDS.findall(text.replace('_', ' '))
+
+
+def skeleton(word):
+    """Script-independent consonant skeleton of a folded word ('' when nothing is left)"""
+    if word.isdigit():
+        return word
+    word = word.translate(TRANSLITERATION)
+    for spelling, sound in LATIN_SOUNDS:
+        word = word.replace(spelling, sound)
+    return REPEATS.sub(r'\1', VOWELS.sub('', word))
+
+
+def _padded_trigrams(word, mark=''):
+    padded = f'  {word} '
+    return [mark + padded[start:start + 3] for start in range(len(padded) - 2)]
+
+
+@lru_cache(maxsize=65536)
+def word_trigrams(word):
+    """Trigrams of a folded word and of its skeleton; brands, models and colours repeat, so this is cached"""
+    word_skeleton = skeleton(word)
+    # A one-letter skeleton ("zzz", "هواوي") would match every word starting with that letter
+    return (frozenset(_padded_trigrams(word)),
+            frozenset(_padded_trigrams(word_skeleton, SKELETON_MARK)) if len(word_skeleton) > 1 else frozenset())
+
+
+def trigrams(text):
+    """(folded trigrams, skeleton trigrams) of ``text``"""
+    folded, skeletal = set(), set()
+    for word in fold(text):
+        word_folded, word_skeletal = word_trigrams(word)
+        folded |= word_folded
+        skeletal |= word_skeletal
+    return folded, skeletal
+
+
+class TrigramSearch:
+    """Document table upkeep from session events, plus the per-process trigram index"""
+
+    def __init__(self, app, db, model, sources):
+        self.app = app
+        self.db = db
+        self.table = model.__table__
+        # model -> (kind, column names, text(row) -> str, or None when the row is not searchable);
+        # ``text`` gets ORM objects and plain rows of those columns alike
+        self.sources = {source_model: (kind, tuple(columns), text)
+                        for source_model, (kind, columns, text) in sources.items()}
+        self.kind_codes = {kind: code for code, (kind, _, _) in enumerate(self.sources.values())}
+        self._lock = threading.Lock()
+        self._position = None  # id of the newest document applied, None before the first load
+        self._reset()
+        event.listen(Session, 'after_flush', self._after_flush)
+        event.listen(Session, 'before_commit', self._before_commit)
+        event.listen(Session, 'after_soft_rollback', self._after_soft_rollback)
+        app.extensions['trigram_search'] = self
+
+    # Capture
+
+    def _after_flush(self, session, flush_context):
+        documents = []
+        for action, objects in (('create', session.new), ('update', session.dirty), ('delete', session.deleted)):
+            for obj in objects:
+                source = self.sources.get(type(obj))
+                if source is None:
+                    continue
+                kind, columns, text = source
+                if action == 'delete':
+                    documents.append((kind, obj.id, None))
+                elif action == 'create' or self._changed(obj, columns):
+                    documents.append((kind, obj.id, text(obj)))
+        if documents:
+            # Tagged with their savepoint, so rolling it back drops them
+            session.info.setdefault(PENDING, []).append((session.get_nested_transaction(), documents))
+
+    @staticmethod
+    def _changed(obj, columns):
+        state = inspect(obj)
+        return any(state.attrs[column].history.has_changes() for column in columns)
+
+    def _before_commit(self, session):
+        if session.in_nested_transaction():
+            return
+        session.flush()
+        pending = session.info.pop(PENDING, None)
+        if not pending:
+            return
+        latest = {}
+        for _, documents in pending:
+            for kind, entity_id, text in documents:
+                latest[(kind, entity_id)] = text
+        self._write(session, latest)
+
+    def _after_soft_rollback(self, session, previous_transaction):
+        if not previous_transaction.nested:
+            session.info.pop(PENDING, None)
+        elif session.info.get(PENDING):
+            session.info[PENDING] = [(savepoint, documents) for savepoint, documents in session.info[PENDING]
+                                     if savepoint is not previous_transaction]
+
+    def _write(self, connection, documents):
+        """Replace the documents of ``{(kind, entity_id): text or None}``, each under a new id"""
+        table = self.table
+        keys = list(documents)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            for kind in {kind for kind, _ in batch}:
+                connection.execute(table.delete().where(
+                    table.c.kind == kind, table.c.entity_id.in_([entity_id for k, entity_id in batch if k == kind])))
+        if keys:
+            connection.execute(table.insert(), [{'kind': kind, 'entity_id': entity_id, 'text': documents[(kind, entity_id)]}
+                                                for kind, entity_id in keys])
+
+    # Startup
+
+    def sync(self):
+        """Bring the documents in line with the source tables (first run, changes made with plain SQL)"""
+        table = self.table
+        with self.db.engine.begin() as conn:
+            stored = {(kind, entity_id): text for kind, entity_id, text in conn.execute(
+                select(table.c.kind, table.c.entity_id, table.c.text).where(table.c.text.isnot(None)))}
+            current = {}
+            for source_model, (kind, columns, text) in self.sources.items():
+                query = select(source_model.id, *[getattr(source_model, column) for column in columns])
+                for row in conn.execute(query):
+                    document = text(row)
+                    if document is not None:
+                        current[(kind, row.id)] = document
+            changes = {key: document for key, document in current.items() if stored.get(key) != document}
+            changes.update({key: None for key in stored.keys() - current.keys()})
+            self._write(conn, changes)
+            # Tombstones only matter to processes that loaded the documents before they were written
+            conn.execute(table.delete().where(table.c.text.is_(None)))
+        return len(changes)
+
+    # Index
+
+    def _reset(self):
+        self._kinds = array('B')        # slot -> kind code
+        self._entity_ids = array('Q')   # slot -> row id
+        self._gram_counts = array('H')  # slot -> number of trigrams (both forms)
+        self._alive = array('B')        # slot -> 0 once replaced or deleted
+        self._texts = []                # slot -> text, for compaction
+        self._slots = {}                # (kind code, row id) -> slot
+        self._postings = {}             # trigram -> array('I') of slots
+        self._dead = 0
+
+    def _add(self, kind_code, entity_id, text):
+        folded, skeletal = trigrams(text)
+        slot = len(self._entity_ids)
+        self._kinds.append(kind_code)
+        self._entity_ids.append(entity_id)
+        self._gram_counts.append(min(len(folded) + len(skeletal), 0xFFFF))
+        self._alive.append(1)
+        self._texts.append(text)
+        self._slots[(kind_code, entity_id)] = slot
+        postings = self._postings
+        for gram in folded | skeletal:
+            posting = postings.get(gram)
+            if posting is None:
+                postings[gram] = array('I', (slot,))
+            else:
+                posting.append(slot)
+
+    def _apply(self, rows):
+        for _, kind, entity_id, text in rows:
+            kind_code = self.kind_codes.get(kind)
+            if kind_code is None:
+                continue
+            slot = self._slots.pop((kind_code, entity_id), None)
+            if slot is not None:
+                self._alive[slot] = 0
+                self._dead += 1
+            if text is not None:
+                self._add(kind_code, entity_id, text)
+        if self._dead > len(self._texts) // 2:
+            self._compact()
+
+    def _compact(self):
+        live = [(self._kinds[slot], self._entity_ids[slot], self._texts[slot])
+                for slot in range(len(self._texts)) if self._alive[slot]]
+        self._reset()
+        for kind_code, entity_id, text in live:
+            self._add(kind_code, entity_id, text)
+
+    def _catch_up(self):
+        table = self.table
+        with self.app.app_context(), self.db.engine.connect() as conn:
+            newest = conn.execute(select(func.max(table.c.id))).scalar() or 0
+            if self._position is not None and newest <= self._position:
+                return
+            query = select(table.c.id, table.c.kind, table.c.entity_id, table.c.text).order_by(table.c.id)
+            if self._position is None:
+                query = query.where(table.c.text.isnot(None))
+            else:
+                query = query.where(table.c.id > self._position)
+            rows = conn.execute(query.where(table.c.id <= newest)).all()
+        with self._lock:
+            if self._position is None:
+                self._reset()
+            self._apply(rows)
+            self._position = max(newest, self._position or 0)
+
+    def load(self):
+        """Build this process's index (before forking, so workers share it until they change it)"""
+        self._position = None
+        self._catch_up()
+
+    def search(self, kind, text, limit=DEFAULT_LIMIT, threshold=THRESHOLD):
+        """[(row id, score)] of ``kind`` best matching ``text``, best first"""
+        import numpy as np
+
+        folded, skeletal = trigrams(text)
+        if not folded:
+            return []
+        self._catch_up()
+        with self._lock:
+            slot_count = len(self._entity_ids)
+            if not slot_count:
+                return []
+            shares, common = [], np.zeros(slot_count, dtype=np.int32)
+            for grams in (folded, skeletal):
+                postings = [np.frombuffer(self._postings[gram], dtype=np.uint32)
+                            for gram in grams if gram in self._postings]
+                counts = (np.bincount(np.concatenate(postings), minlength=slot_count) if postings
+                          else np.zeros(slot_count, dtype=np.int64))
+                del postings
+                common += counts.astype(np.int32)
+                shares.append(counts / max(len(grams), 1))
+            share = np.maximum(*shares)
+            matches = (share >= threshold)
+            matches &= np.frombuffer(self._alive, dtype=np.uint8).astype(bool)
+            matches &= np.frombuffer(self._kinds, dtype=np.uint8) == self.kind_codes[kind]
+            candidates = np.nonzero(matches)[0]
+            gram_counts = np.frombuffer(self._gram_counts, dtype=np.uint16)[candidates].astype(np.float64)
+            entity_ids = np.frombuffer(self._entity_ids, dtype=np.uint64)[candidates].copy()
+        dice = 2 * common[candidates] / (len(folded) + len(skeletal) + gram_counts)
+        order = np.lexsort((-dice, -share[candidates]))[:limit]
+        return [(int(entity_ids[index]), round(float(share[candidates][index]), 3)) for index in order]
+
+    def ranked(self, kind, model, text, query=None, limit=DEFAULT_LIMIT):
+        """Rows of ``model`` (or of ``query``) matching ``text``, best first"""
+        matches = self.search(kind, text, limit)
+        if not matches:
+            return []
+        rank = {entity_id: position for position, (entity_id, _) in enumerate(matches)}
+        query = query if query is not None else self.db.session.query(model)
+        rows = query.filter(model.id.in_(list(rank))).all()
+        return sorted(rows, key=lambda row: rank[row.id])